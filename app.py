@@ -1,18 +1,27 @@
 import os
 import base64
+import codecs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import stripe
 import json
 import re
 import traceback
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from urllib.parse import urljoin, urlparse
+from html.parser import HTMLParser
 from flask import Flask, session, redirect, request, url_for, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
-from openai import OpenAI
+from googleapiclient.errors import HttpError
+from openai_gateway import OPENAI_GATEWAY
 from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -154,6 +163,79 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
 WHATSAPP_NUMBER = "33750384314"
 
+# ════════════════════════════════════════════════════════════════
+# 🤖 PASSERELLE OPENAI PARTAGÉE (openai_gateway.py)
+# ════════════════════════════════════════════════════════════════
+# Tous les appels LLM passent par OPENAI_GATEWAY.chat(<appelant>, ...) : un seul client
+# par process (pool HTTP réutilisé), quota par modèle, retry/backoff 429/5xx,
+# métriques latence/tokens/coût par appelant → /admin/openai
+
+# Client HTTP sortant partagé (Détective, recherches web, Telegram, refresh OAuth)
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", "32"))  # Nb d'hôtes gardés en keep-alive
+HTTP_POOL_PER_HOST = int(os.environ.get("HTTP_POOL_PER_HOST", "10"))  # Connexions max par hôte
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", "0.3"))
+HTTP_DEFAULT_TIMEOUT = float(os.environ.get("HTTP_DEFAULT_TIMEOUT", "10"))
+# Détective : pas de retry urllib3 (chaque essai reprendrait le timeout complet et
+# ferait dépasser DETECTIVE_DEADLINE_SECONDS) - il a ses propres fallbacks
+HTTP_DETECTIVE_MAX_RETRIES = int(os.environ.get("HTTP_DETECTIVE_MAX_RETRIES", "0"))
+HTTP_SESSION_PROFILES = {"default": HTTP_MAX_RETRIES, "detective": HTTP_DETECTIVE_MAX_RETRIES}
+_HTTP_SESSIONS = {}  # profil → session
+_HTTP_SESSION_LOCK = threading.Lock()
+
+class PooledHTTPSession(requests.Session):
+    """requests.Session avec un timeout par défaut (aucun appel sortant sans timeout)"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", HTTP_DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+def build_http_session(max_retries=HTTP_MAX_RETRIES):
+    """
+    Session keep-alive : pool par hôte + retries courts avec backoff (GET/HEAD, 429/5xx).
+    Retry-After ignoré (urllib3 le dormirait sans plafond) ; aucun cookie conservé
+    (la session est partagée entre marchands, moteurs de recherche et OAuth).
+    """
+    from http.cookiejar import DefaultCookiePolicy
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, max_retries=retry)
+    session = PooledHTTPSession()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))  # Rejette tous les cookies
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_http_session(profile="default"):
+    """Retourne la session HTTP partagée du profil ('default' ou 'detective'), créée au premier appel"""
+    session = _HTTP_SESSIONS.get(profile)
+    if session is None:
+        with _HTTP_SESSION_LOCK:
+            session = _HTTP_SESSIONS.get(profile)
+            if session is None:
+                session = _HTTP_SESSIONS[profile] = build_http_session(HTTP_SESSION_PROFILES[profile])
+    return session
+
+def set_http_session(session, profile=None):
+    """
+    Point d'injection : remplace la session d'un profil - ou de tous si profile=None
+    (ex: session avec un adapter bouchon monté pour tester le Détective hors ligne).
+    Retourne l'ancienne session (du profil, ou 'default').
+    """
+    with _HTTP_SESSION_LOCK:
+        previous = _HTTP_SESSIONS.get(profile or "default")
+        for name in ([profile] if profile else HTTP_SESSION_PROFILES):
+            _HTTP_SESSIONS[name] = session
+    return previous
+
 if STRIPE_SK:
     stripe.api_key = STRIPE_SK
 
@@ -172,125 +254,83 @@ SUPPORT_EMAIL = "support@justicio.fr"
 # ════════════════════════════════════════════════════════════════════════════════
 # 🤖 AGENT AVOCAT VIRTUEL - Génération de Mises en Demeure via GPT-4
 # ════════════════════════════════════════════════════════════════════════════════
+# Moteur à 2 étages :
+#   1. L'argumentaire juridique (faits, fondement, demande, conséquences) est rédigé
+#      par GPT UNE fois par (entreprise, loi, type de litige, version du prompt),
+#      avec des marqueurs {{CLIENT_NAME}}, {{AMOUNT}}... → table letter_section_cache.
+#   2. Chaque lettre = gabarits pré-découpés remplis localement (quelques ms, sans API).
+# ⚠️ Incrémenter LETTER_PROMPT_VERSION à chaque modification du prompt !
+
+LETTER_PROMPT_VERSION = "letter-v2"
+LETTER_CACHE_TTL_DAYS = int(os.environ.get("LETTER_CACHE_TTL_DAYS", "90"))
+LETTER_CACHE_MAX_ENTRIES = int(os.environ.get("LETTER_CACHE_MAX_ENTRIES", "2000"))
+LETTER_CACHE_STATS = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "errors": 0, "rejected": 0}
+
+# Type de litige déduit du motif : 1re classe dont un motif (regex, ancré en début de mot)
+# apparaît → les classes SPÉCIFIQUES d'abord ("bagage perdu" n'est pas un colis non reçu)
+LETTER_MOTIF_CLASSES = [
+    ("bagage", [r"bagages?\b", r"valises?\b", r"luggage", r"baggage", r"suitcase"]),
+    ("annulation", [r"annul", r"cancel"]),
+    ("retard", [r"retard", r"delay"]),
+    ("non_recu", [r"(?:non|pas|jamais) (?:re[çc]u|livr[ée])", r"not received", r"never (?:arrived|received)",
+                  r"perdu", r"lost\b"]),
+    ("defectueux", [r"d[ée]fectueu", r"cass[ée]e?s?\b", r"ab[iî]m[ée]", r"endommag", r"en panne\b", r"broken", r"damaged"]),
+    ("non_conforme", [r"non[- ]conforme", r"erreur de taille", r"mauvais article", r"wrong item"]),
+    ("retour_refuse", [r"retour", r"r[ée]tractation"]),
+    ("remboursement", [r"rembours", r"refund"]),
+]
+LETTER_MOTIF_PATTERNS = [
+    (motif_class, re.compile(r"\b(?:" + "|".join(patterns) + ")", re.IGNORECASE))
+    for motif_class, patterns in LETTER_MOTIF_CLASSES
+]
 
-def generate_legal_letter_gpt(company, amount, motif, law, client_name, client_email, order_ref=None):
-    """
-    ⚖️ AGENT AVOCAT VIRTUEL - Génère une mise en demeure personnalisée via GPT-4
-    
-    Args:
-        company: Nom de l'entreprise visée
-        amount: Montant réclamé (ex: "42.99€")
-        motif: Nature du litige (ex: "Colis non reçu depuis 3 semaines")
-        law: Article de loi applicable (ex: "Règlement UE 261/2004")
-        client_name: Nom du client
-        client_email: Email du client
-        order_ref: Numéro de commande (optionnel)
-    
-    Returns:
-        dict: {"success": bool, "html_body": str, "text_body": str, "subject": str, "error": str}
-    """
-    
-    if not OPENAI_API_KEY:
-        DEBUG_LOGS.append("⚖️ Agent Avocat: ❌ Pas de clé API OpenAI")
-        return {
-            "success": False,
-            "error": "API OpenAI non configurée",
-            "html_body": None,
-            "text_body": None,
-            "subject": None
-        }
-    
-    from datetime import timedelta
-    today = datetime.now()
-    today_str = today.strftime("%d/%m/%Y")
-    deadline = (today + timedelta(days=8)).strftime("%d/%m/%Y")
-    
-    # Nettoyer le montant
-    amount_clean = str(amount).replace('€', '').replace('EUR', '').strip()
-    try:
-        amount_num = float(amount_clean.replace(',', '.'))
-        amount_formatted = f"{amount_num:.2f}"
-    except:
-        amount_formatted = amount_clean
-    
-    # Référence commande
-    ref_text = f"Référence commande : {order_ref}" if order_ref else ""
-    
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
-    system_prompt = """Tu es un avocat tenace et expérimenté, spécialisé en droit de la consommation et droit des transports européen.
-
-TON RÔLE : Rédiger des mises en demeure formelles, professionnelles et juridiquement solides.
-
-STYLE :
-- Ton FROID et JURIDIQUE (jamais familier)
-- Phrases courtes et percutantes
-- Citations PRÉCISES des articles de loi
-- Menaces légales claires (DGCCRF, Médiateur, Tribunal)
-- Délai de réponse : 8 jours ouvrés
-
-STRUCTURE OBLIGATOIRE :
-1. Entête (Objet, Références)
-2. Rappel des faits
-3. Fondement juridique (articles PRÉCIS)
-4. Demande formelle (remboursement/livraison)
-5. Mise en demeure avec délai
-6. Conséquences en cas de non-réponse
-7. Formule de politesse sobre
-
-SIGNATURE : "L'équipe Juridique Justicio, pour le compte de [NOM CLIENT]"
+LETTER_MOTIF_LABELS = {
+    "annulation": "annulation d'une prestation (vol, train, commande) sans remboursement",
+    "retard": "retard important (transport ou livraison)",
+    "non_recu": "commande ou colis jamais reçu",
+    "defectueux": "produit défectueux ou endommagé",
+    "non_conforme": "produit non conforme à la commande",
+    "retour_refuse": "retour / droit de rétractation refusé",
+    "remboursement": "remboursement dû mais non effectué",
+    "bagage": "bagage perdu, retardé ou endommagé",
+    "autre": "litige commercial",
+}
 
-FORMAT : Réponds UNIQUEMENT avec le corps de la lettre en HTML bien formaté (utilise <p>, <strong>, <ul>, <li>). Pas de balises <html> ou <body>."""
+LETTER_PLACEHOLDER_RE = re.compile(r"\{\{\s*([A-Z_]+)\s*\}\}")
 
-    user_prompt = f"""Rédige une mise en demeure formelle pour les éléments suivants :
 
-ENTREPRISE VISÉE : {company.upper()}
-MONTANT RÉCLAMÉ : {amount_formatted} €
-NATURE DU LITIGE : {motif}
-FONDEMENT JURIDIQUE : {law}
-{ref_text}
+class LetterTemplate:
+    """Gabarit à marqueurs {{NOM}} découpé UNE fois : render() n'est plus qu'un join"""
 
-CLIENT :
-- Nom : {client_name}
-- Email : {client_email}
+    def __init__(self, source: str):
+        parts = LETTER_PLACEHOLDER_RE.split(source)
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
 
-DATE : {today_str}
-DÉLAI DE RÉPONSE : {deadline}
+    def render(self, values: dict) -> str:
+        out = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            out.append(values.get(name, ""))
+            out.append(literal)
+        return "".join(out)
 
-Génère une mise en demeure percutante et menaçante, avec les articles de loi précis."""
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # ou gpt-4 pour plus de qualité
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.3,  # Consistance juridique
-            max_tokens=1500
-        )
-        
-        letter_content = response.choices[0].message.content.strip()
-        
-        DEBUG_LOGS.append(f"⚖️ Agent Avocat: ✅ Lettre générée ({len(letter_content)} chars)")
-        
-        # Construire le HTML complet
-        html_body = f"""<!DOCTYPE html>
+LETTER_DOCUMENT_TEMPLATE = LetterTemplate("""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="utf-8">
     <style>
-        body {{ font-family: Georgia, serif; line-height: 1.6; color: #1e293b; max-width: 700px; margin: 0 auto; padding: 20px; }}
-        .header {{ background: linear-gradient(135deg, #dc2626, #991b1b); color: white; padding: 25px; border-radius: 10px 10px 0 0; text-align: center; }}
-        .header h1 {{ margin: 0; font-size: 24px; letter-spacing: 2px; }}
-        .content {{ background: white; padding: 30px; border: 1px solid #e2e8f0; }}
-        .warning {{ background: #fef2f2; border: 1px solid #fecaca; border-radius: 8px; padding: 15px; margin: 20px 0; }}
-        .warning strong {{ color: #dc2626; }}
-        .footer {{ background: #1e293b; color: #94a3b8; padding: 20px; text-align: center; border-radius: 0 0 10px 10px; font-size: 12px; }}
-        .amount {{ font-size: 24px; color: #dc2626; font-weight: bold; }}
-        .deadline {{ color: #dc2626; font-weight: bold; }}
-        ul {{ margin: 10px 0; padding-left: 20px; }}
-        li {{ margin: 5px 0; }}
+        body { font-family: Georgia, serif; line-height: 1.6; color: #1e293b; max-width: 700px; margin: 0 auto; padding: 20px; }
+        .header { background: linear-gradient(135deg, #dc2626, #991b1b); color: white; padding: 25px; border-radius: 10px 10px 0 0; text-align: center; }
+        .header h1 { margin: 0; font-size: 24px; letter-spacing: 2px; }
+        .content { background: white; padding: 30px; border: 1px solid #e2e8f0; }
+        .warning { background: #fef2f2; border: 1px solid #fecaca; border-radius: 8px; padding: 15px; margin: 20px 0; }
+        .warning strong { color: #dc2626; }
+        .footer { background: #1e293b; color: #94a3b8; padding: 20px; text-align: center; border-radius: 0 0 10px 10px; font-size: 12px; }
+        .amount { font-size: 24px; color: #dc2626; font-weight: bold; }
+        .deadline { color: #dc2626; font-weight: bold; }
+        ul { margin: 10px 0; padding-left: 20px; }
+        li { margin: 5px 0; }
     </style>
 </head>
 <body>
@@ -300,16 +340,16 @@ Génère une mise en demeure percutante et menaçante, avec les articles de loi
     </div>
     
     <div class="content">
-        <p style="text-align:right; color:#64748b;">Paris, le {today_str}</p>
+        <p style="text-align:right; color:#64748b;">Paris, le {{DATE}}</p>
         
-        <p><strong>À l'attention de :</strong> {company.upper()}</p>
-        <p><strong>Objet :</strong> Mise en demeure - {motif[:60]}...</p>
+        <p><strong>À l'attention de :</strong> {{COMPANY}}</p>
+        <p><strong>Objet :</strong> Mise en demeure - {{MOTIF_SHORT}}...</p>
         
-        {letter_content}
+        {{LETTER_CONTENT}}
         
         <div class="warning">
             <p><strong>⚠️ MISE EN DEMEURE</strong></p>
-            <p>Sans réponse satisfaisante avant le <span class="deadline">{deadline}</span>, je me réserve le droit de :</p>
+            <p>Sans réponse satisfaisante avant le <span class="deadline">{{DEADLINE}}</span>, je me réserve le droit de :</p>
             <ul>
                 <li>Saisir le <strong>Médiateur de la Consommation</strong></li>
                 <li>Signaler cette pratique à la <strong>DGCCRF</strong></li>
@@ -318,13 +358,13 @@ Génère une mise en demeure percutante et menaçante, avec les articles de loi
         </div>
         
         <p>Cordialement,</p>
-        <p><strong>{client_name}</strong><br>
-        <span style="color:#64748b;">{client_email}</span></p>
+        <p><strong>{{CLIENT_NAME}}</strong><br>
+        <span style="color:#64748b;">{{CLIENT_EMAIL}}</span></p>
         
         <hr style="margin:25px 0; border:none; border-top:1px solid #e2e8f0;">
         <p style="font-size:12px; color:#64748b;">
-            <strong>Montant réclamé :</strong> <span class="amount">{amount_formatted} €</span><br>
-            <strong>Fondement juridique :</strong> {law}
+            <strong>Montant réclamé :</strong> <span class="amount">{{AMOUNT}} €</span><br>
+            <strong>Fondement juridique :</strong> {{LAW}}
         </p>
     </div>
     
@@ -333,48 +373,424 @@ Génère une mise en demeure percutante et menaçante, avec les articles de loi
         <p>Ce document constitue une mise en demeure au sens juridique du terme.</p>
     </div>
 </body>
-</html>"""
+</html>""")
 
-        # Version texte brut pour fallback
-        text_body = f"""MISE EN DEMEURE
+LETTER_TEXT_TEMPLATE = LetterTemplate("""MISE EN DEMEURE
 
-Date : {today_str}
-À l'attention de : {company.upper()}
+Date : {{DATE}}
+À l'attention de : {{COMPANY}}
 
-{motif}
+{{MOTIF}}
 
-Montant réclamé : {amount_formatted} €
-Fondement juridique : {law}
+Montant réclamé : {{AMOUNT}} €
+Fondement juridique : {{LAW}}
 
-Délai de réponse : {deadline}
+Délai de réponse : {{DEADLINE}}
 
 Sans réponse satisfaisante, je me réserve le droit de saisir le Médiateur de la Consommation, la DGCCRF, ou d'engager une procédure judiciaire.
 
-{client_name}
-{client_email}
+{{CLIENT_NAME}}
+{{CLIENT_EMAIL}}
 
 ---
 Justicio.fr - Protection des droits des consommateurs
-"""
+""")
 
-        return {
-            "success": True,
-            "html_body": html_body,
-            "text_body": text_body,
-            "subject": f"⚖️ MISE EN DEMEURE - {company.upper()} - {motif[:50]}",
-            "error": None
-        }
-        
+LETTER_SYSTEM_PROMPT = """Tu es un avocat tenace et expérimenté, spécialisé en droit de la consommation et droit des transports européen.
+
+TON RÔLE : Rédiger des mises en demeure formelles, professionnelles et juridiquement solides.
+
+STYLE :
+- Ton FROID et JURIDIQUE (jamais familier)
+- Phrases courtes et percutantes
+- Citations PRÉCISES des articles de loi
+- Menaces légales claires (DGCCRF, Médiateur, Tribunal)
+- Délai de réponse : 8 jours ouvrés
+
+STRUCTURE OBLIGATOIRE :
+1. Entête (Objet, Références)
+2. Rappel des faits
+3. Fondement juridique (articles PRÉCIS)
+4. Demande formelle (remboursement/livraison)
+5. Mise en demeure avec délai
+6. Conséquences en cas de non-réponse
+7. Formule de politesse sobre
+
+SIGNATURE : "L'équipe Juridique Justicio, pour le compte de {{CLIENT_NAME}}"
+
+MARQUEURS : la lettre sert de modèle pour plusieurs clients. N'invente AUCUN nom, montant,
+date ou référence : écris EXACTEMENT ces marqueurs, ils seront remplacés ensuite :
+{{CLIENT_NAME}} (nom du client), {{CLIENT_EMAIL}}, {{AMOUNT}} (montant en euros, sans le symbole €),
+{{MOTIF}} (description du litige par le client), {{REFERENCE}} (ligne de référence commande, peut être vide),
+{{DATE}} (date du jour), {{DEADLINE}} (date limite de réponse).
+
+FORMAT : Réponds UNIQUEMENT avec le corps de la lettre en HTML bien formaté (utilise <p>, <strong>, <ul>, <li>). Pas de balises <html> ou <body>."""
+
+_LETTER_SECTIONS_MEMO = {}  # cache_key → LetterTemplate (sections déjà découpées)
+
+# Un argumentaire n'est mis en cache (donc réutilisé pour d'AUTRES clients) que s'il
+# contient les marqueurs obligatoires et aucune donnée personnelle inventée en dur
+LETTER_REQUIRED_MARKERS = ("CLIENT_NAME", "AMOUNT", "DATE")
+LETTER_LITERAL_AMOUNT_RE = re.compile(r"\d(?:[\d\s.,\u00a0\u202f]*\d)?\s*(?:€|euros?\b|EUR\b)", re.IGNORECASE)
+# Montants fixés par la loi, identiques pour tous les clients : indemnisation forfaitaire
+# du Règlement CE 261/2004 (art. 7 §1) et sa réduction de 50 % (art. 7 §2)
+LETTER_STATUTORY_AMOUNTS = {125, 200, 250, 300, 400, 600}
+LETTER_LITERAL_DATE_RE = re.compile(
+    r"\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b"
+    r"|\b\d{1,2}(?:er)?\s+(?:janvier|février|fevrier|mars|avril|mai|juin|juillet|août|aout|septembre|octobre|novembre|décembre|decembre)\s+\d{4}\b",
+    re.IGNORECASE
+)
+
+
+def _letter_amount_value(literal: str):
+    """ "600 €" / "1 000,00 euros" → 600.0 / 1000.0 (None si illisible)"""
+    digits = re.sub(r"[\s\u00a0\u202f]", "", re.sub(r"(?i)\s*(?:€|euros?|EUR)$", "", literal.strip()))
+    digits = re.sub(r"[.,](?=\d{3}(?:[.,]|$))", "", digits).replace(",", ".")
+    try:
+        return float(digits)
+    except ValueError:
+        return None
+
+
+def letter_sections_issues(sections_html: str) -> list:
+    """Raisons de NE PAS mettre un argumentaire en cache (liste vide = réutilisable)"""
+    issues = []
+    markers = set(LETTER_PLACEHOLDER_RE.findall(sections_html or ""))
+    missing = [name for name in LETTER_REQUIRED_MARKERS if name not in markers]
+    if missing:
+        issues.append("marqueurs absents: " + ", ".join(missing))
+    if any(_letter_amount_value(m.group()) not in LETTER_STATUTORY_AMOUNTS
+           for m in LETTER_LITERAL_AMOUNT_RE.finditer(sections_html or "")):
+        issues.append("montant en dur")
+    if LETTER_LITERAL_DATE_RE.search(sections_html or ""):
+        issues.append("date en dur")
+    return issues
+
+
+def _cache_letter_sections(cache_key, company, law, motif_class, sections_html):
+    """Met l'argumentaire en cache s'il est générique ; sinon il ne sert qu'à la lettre en cours"""
+    issues = letter_sections_issues(sections_html)
+    if issues:
+        LETTER_CACHE_STATS["rejected"] += 1
+        DEBUG_LOGS.append(f"⚖️ Agent Avocat: ⚠️ Argumentaire non mis en cache ({'; '.join(issues)})")
+        return False
+    letter_cache_set(cache_key, company, law, motif_class, sections_html)
+    return True
+
+
+def classify_letter_motif(motif) -> str:
+    """Type de litige pour le cache d'argumentaires (ex: 'non_recu', 'retard'...)"""
+    for motif_class, pattern in LETTER_MOTIF_PATTERNS:
+        if pattern.search(motif or ""):
+            return motif_class
+    return "autre"
+
+
+def _letter_cache_key(company, law, motif_class):
+    """Clé sha256 (version prompt, entreprise normalisée, loi, type de litige)"""
+    import hashlib
+    raw = json.dumps([LETTER_PROMPT_VERSION, normalize_company_key(company), (law or "").strip(), motif_class],
+                     ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def letter_cache_get(cache_key):
+    """Retourne le LetterTemplate de l'argumentaire en cache ou None - expiré = absent"""
+    from datetime import timedelta
+    try:
+        entry = LetterSectionCache.query.get(cache_key)
+        if entry and datetime.utcnow() - entry.created_at <= timedelta(days=LETTER_CACHE_TTL_DAYS):
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_hit_at = datetime.utcnow()
+            db.session.commit()
+            LETTER_CACHE_STATS["hits"] += 1
+            template = _LETTER_SECTIONS_MEMO.get(cache_key)
+            if template is None:
+                if len(_LETTER_SECTIONS_MEMO) >= LETTER_CACHE_MAX_ENTRIES:
+                    _LETTER_SECTIONS_MEMO.clear()
+                template = _LETTER_SECTIONS_MEMO[cache_key] = LetterTemplate(entry.sections_html)
+            return template
+    except Exception as e:
+        db.session.rollback()
+        LETTER_CACHE_STATS["errors"] += 1
+        _dbg(f"⚠️ Cache lettres lecture: {type(e).__name__}: {str(e)[:60]}")
+    LETTER_CACHE_STATS["misses"] += 1
+    return None
+
+
+def letter_cache_set(cache_key, company, law, motif_class, sections_html):
+    """Enregistre un argumentaire et applique TTL + borne de taille (éviction LRU)"""
+    from datetime import timedelta
+    try:
+        entry = LetterSectionCache.query.get(cache_key)
+        if entry is None:
+            entry = LetterSectionCache(cache_key=cache_key)
+            db.session.add(entry)
+        entry.company = normalize_company_key(company)[:200]
+        entry.law = (law or "")[:300]
+        entry.motif_class = motif_class
+        entry.prompt_version = LETTER_PROMPT_VERSION
+        entry.sections_html = sections_html
+        entry.created_at = datetime.utcnow()
+        entry.last_hit_at = datetime.utcnow()
+        db.session.commit()
+        LETTER_CACHE_STATS["stores"] += 1
+
+        # Éviction périodique (1 écriture sur 20) : expirés puis moins récemment utilisés
+        if LETTER_CACHE_STATS["stores"] % 20 == 1:
+            expired_before = datetime.utcnow() - timedelta(days=LETTER_CACHE_TTL_DAYS)
+            evicted = LetterSectionCache.query.filter(
+                LetterSectionCache.created_at < expired_before).delete(synchronize_session=False)
+            overflow = LetterSectionCache.query.count() - LETTER_CACHE_MAX_ENTRIES
+            if overflow > 0:
+                oldest = [row.cache_key for row in LetterSectionCache.query
+                          .with_entities(LetterSectionCache.cache_key)
+                          .order_by(LetterSectionCache.last_hit_at.asc()).limit(overflow)]
+                evicted += LetterSectionCache.query.filter(
+                    LetterSectionCache.cache_key.in_(oldest)).delete(synchronize_session=False)
+            db.session.commit()
+            LETTER_CACHE_STATS["evictions"] += evicted
+    except Exception as e:
+        db.session.rollback()
+        LETTER_CACHE_STATS["errors"] += 1
+        _dbg(f"⚠️ Cache lettres écriture: {type(e).__name__}: {str(e)[:60]}")
+
+
+def _letter_sections_prompt(company, law, motif_class):
+    """Prompt utilisateur de l'argumentaire : ne dépend QUE de la clé de cache"""
+    return f"""Rédige une mise en demeure formelle pour les éléments suivants :
+
+ENTREPRISE VISÉE : {company.upper()}
+MONTANT RÉCLAMÉ : {{{{AMOUNT}}}} €
+TYPE DE LITIGE : {LETTER_MOTIF_LABELS.get(motif_class, LETTER_MOTIF_LABELS["autre"])}
+NATURE DU LITIGE (décrite par le client) : {{{{MOTIF}}}}
+FONDEMENT JURIDIQUE : {law}
+{{{{REFERENCE}}}}
+
+CLIENT :
+- Nom : {{{{CLIENT_NAME}}}}
+- Email : {{{{CLIENT_EMAIL}}}}
+
+DATE : {{{{DATE}}}}
+DÉLAI DE RÉPONSE : {{{{DEADLINE}}}}
+
+Génère une mise en demeure percutante et menaçante, avec les articles de loi précis."""
+
+
+class LetterStreamRenderer:
+    """Remplit les marqueurs {{NOM}} au fil du flux GPT (retient la fin du tampon tant qu'un marqueur est incomplet)"""
+
+    MAX_HELD_CHARS = 200  # Un "{{" jamais refermé ne bloque pas le flux
+
+    def __init__(self, values: dict):
+        self.values = values
+        self.pending = ""
+        self.raw = []
+
+    def _render(self, text: str) -> str:
+        return LETTER_PLACEHOLDER_RE.sub(lambda m: self.values.get(m.group(1), ""), text)
+
+    def feed(self, text: str) -> str:
+        self.raw.append(text)
+        self.pending += text
+        split = len(self.pending)
+        start = self.pending.rfind("{{")
+        if start != -1 and self.pending.find("}}", start) == -1:
+            split = start
+        elif self.pending.endswith("{"):
+            split -= 1
+        if len(self.pending) - split > self.MAX_HELD_CHARS:
+            split = len(self.pending)
+        ready, self.pending = self.pending[:split], self.pending[split:]
+        return self._render(ready)
+
+    def flush(self) -> str:
+        ready, self.pending = self.pending, ""
+        return self._render(ready)
+
+    @property
+    def sections_html(self) -> str:
+        return "".join(self.raw).strip()
+
+
+def _prepare_letter(company, amount, motif, law, client_name, client_email, order_ref=None):
+    """Valeurs des marqueurs (HTML échappé + texte brut) et clé de cache de l'argumentaire"""
+    from datetime import timedelta
+    from html import escape
+    today = datetime.now()
+    today_str = today.strftime("%d/%m/%Y")
+    deadline = (today + timedelta(days=8)).strftime("%d/%m/%Y")
+    
+    # Nettoyer le montant
+    amount_clean = str(amount).replace('€', '').replace('EUR', '').strip()
+    try:
+        amount_num = float(amount_clean.replace(',', '.'))
+        amount_formatted = f"{amount_num:.2f}"
+    except:
+        amount_formatted = amount_clean
+    
+    motif = motif or ""
+    motif_class = classify_letter_motif(motif)
+    values = {
+        "COMPANY": escape(company.upper()),
+        "CLIENT_NAME": escape(client_name or ""),
+        "CLIENT_EMAIL": escape(client_email or ""),
+        "AMOUNT": escape(amount_formatted),
+        "MOTIF": escape(motif),
+        "MOTIF_SHORT": escape(motif[:60]),
+        "REFERENCE": escape(f"Référence commande : {order_ref}") if order_ref else "",
+        "LAW": escape(law or ""),
+        "DATE": today_str,
+        "DEADLINE": deadline,
+    }
+    text_values = {
+        **values,
+        "COMPANY": company.upper(),
+        "CLIENT_NAME": client_name or "",
+        "CLIENT_EMAIL": client_email or "",
+        "MOTIF": motif,
+        "LAW": law or "",
+        "AMOUNT": amount_formatted,
+    }
+    return {
+        "motif": motif,
+        "motif_class": motif_class,
+        "cache_key": _letter_cache_key(company, law, motif_class),
+        "values": values,
+        "text_values": text_values,
+    }
+
+
+def _request_letter_sections(company, law, motif_class, stream=False):
+    """Appel GPT de l'argumentaire (complet, ou itérateur de fragments si stream=True)"""
+    request_args = dict(
+        model="gpt-4o-mini",  # ou gpt-4 pour plus de qualité
+        messages=[
+            {"role": "system", "content": LETTER_SYSTEM_PROMPT},
+            {"role": "user", "content": _letter_sections_prompt(company, law, motif_class)}
+        ],
+        temperature=0.3,  # Consistance juridique
+        max_tokens=1500
+    )
+    if stream:
+        return OPENAI_GATEWAY.chat_stream("generate_legal_letter_gpt", **request_args)
+    return OPENAI_GATEWAY.chat("generate_legal_letter_gpt", **request_args)
+
+
+def _letter_failure(error):
+    return {
+        "success": False,
+        "error": error,
+        "html_body": None,
+        "text_body": None,
+        "subject": None
+    }
+
+
+def _assemble_letter(company, prepared, sections):
+    """ÉTAGE 2 : remplissage local des gabarits (document HTML + version texte)"""
+    values = prepared["values"]
+    html_body = LETTER_DOCUMENT_TEMPLATE.render({**values, "LETTER_CONTENT": sections.render(values)})
+    # Version texte brut pour fallback
+    text_body = LETTER_TEXT_TEMPLATE.render(prepared["text_values"])
+    return {
+        "success": True,
+        "html_body": html_body,
+        "text_body": text_body,
+        "subject": f"⚖️ MISE EN DEMEURE - {company.upper()} - {prepared['motif'][:50]}",
+        "error": None
+    }
+
+
+def generate_legal_letter_gpt(company, amount, motif, law, client_name, client_email, order_ref=None):
+    """
+    ⚖️ AGENT AVOCAT VIRTUEL - Génère une mise en demeure personnalisée
+    
+    L'argumentaire vient du cache (letter_section_cache) ou, à défaut, de GPT ;
+    les données du client sont ensuite insérées localement dans les gabarits.
+    
+    Args:
+        company: Nom de l'entreprise visée
+        amount: Montant réclamé (ex: "42.99€")
+        motif: Nature du litige (ex: "Colis non reçu depuis 3 semaines")
+        law: Article de loi applicable (ex: "Règlement UE 261/2004")
+        client_name: Nom du client
+        client_email: Email du client
+        order_ref: Numéro de commande (optionnel)
+    
+    Returns:
+        dict: {"success": bool, "html_body": str, "text_body": str, "subject": str, "error": str}
+    """
+    prepared = _prepare_letter(company, amount, motif, law, client_name, client_email, order_ref)
+    motif_class = prepared["motif_class"]
+    
+    # ÉTAGE 1 : Argumentaire juridique (cache ou GPT)
+    sections = letter_cache_get(prepared["cache_key"])
+    if sections is not None:
+        DEBUG_LOGS.append(f"⚖️ Agent Avocat: 🗄️ Argumentaire en cache ({company} / {motif_class})")
+        return _assemble_letter(company, prepared, sections)
+    
+    if not OPENAI_API_KEY:
+        DEBUG_LOGS.append("⚖️ Agent Avocat: ❌ Pas de clé API OpenAI")
+        return _letter_failure("API OpenAI non configurée")
+    
+    try:
+        response = _request_letter_sections(company, law, motif_class)
+        sections_html = response.choices[0].message.content.strip()
     except Exception as e:
         error_msg = str(e)
         DEBUG_LOGS.append(f"⚖️ Agent Avocat: ❌ Erreur GPT: {error_msg[:100]}")
-        return {
-            "success": False,
-            "error": error_msg[:100],
-            "html_body": None,
-            "text_body": None,
-            "subject": None
-        }
+        return _letter_failure(error_msg[:100])
+    
+    DEBUG_LOGS.append(f"⚖️ Agent Avocat: ✅ Argumentaire généré ({len(sections_html)} chars, {motif_class})")
+    _cache_letter_sections(prepared["cache_key"], company, law, motif_class, sections_html)
+    return _assemble_letter(company, prepared, LetterTemplate(sections_html))
+
+
+def stream_legal_letter_gpt(company, amount, motif, law, client_name, client_email, order_ref=None):
+    """
+    ⚖️ Variante streaming de generate_legal_letter_gpt (aperçu en direct)
+    
+    Générateur : ("chunk", fragment_html) au fil de l'eau - marqueurs déjà remplis -
+    puis un unique ("done", dict) au format de generate_legal_letter_gpt.
+    En cache : l'argumentaire complet sort en un seul fragment.
+    """
+    prepared = _prepare_letter(company, amount, motif, law, client_name, client_email, order_ref)
+    motif_class = prepared["motif_class"]
+    
+    sections = letter_cache_get(prepared["cache_key"])
+    if sections is not None:
+        DEBUG_LOGS.append(f"⚖️ Agent Avocat: 🗄️ Argumentaire en cache ({company} / {motif_class})")
+        yield "chunk", sections.render(prepared["values"])
+        yield "done", _assemble_letter(company, prepared, sections)
+        return
+    
+    if not OPENAI_API_KEY:
+        DEBUG_LOGS.append("⚖️ Agent Avocat: ❌ Pas de clé API OpenAI")
+        yield "done", _letter_failure("API OpenAI non configurée")
+        return
+    
+    renderer = LetterStreamRenderer(prepared["values"])
+    try:
+        for event in _request_letter_sections(company, law, motif_class, stream=True):
+            delta = event.choices[0].delta.content if event.choices else None
+            if delta:
+                fragment = renderer.feed(delta)
+                if fragment:
+                    yield "chunk", fragment
+        fragment = renderer.flush()
+        if fragment:
+            yield "chunk", fragment
+    except Exception as e:
+        error_msg = str(e)
+        DEBUG_LOGS.append(f"⚖️ Agent Avocat: ❌ Erreur GPT (stream): {error_msg[:100]}")
+        yield "done", _letter_failure(error_msg[:100])
+        return
+    
+    sections_html = renderer.sections_html
+    DEBUG_LOGS.append(f"⚖️ Agent Avocat: ✅ Argumentaire streamé ({len(sections_html)} chars, {motif_class})")
+    _cache_letter_sections(prepared["cache_key"], company, law, motif_class, sections_html)
+    yield "done", _assemble_letter(company, prepared, LetterTemplate(sections_html))
 
 
 # ════════════════════════════════════════════════════════════════════════════════
@@ -390,30 +806,139 @@ def send_mise_en_demeure_gmail(*args, **kwargs):
 # ════════════════════════════════════════════════════════════════════════════════
 # 📬 ENVOI SMTP VIA BREVO - Mandataire (Article 1984 Code civil)
 # ════════════════════════════════════════════════════════════════════════════════
-
-def send_mise_en_demeure_smtp(user, target_email, subject, html_body, text_body=None,
-                               litigation_id=None, company=None):
+# Les mises en demeure passent par une file durable (table outbound_email) vidée
+# par un thread d'envoi : quelques connexions SMTP authentifiées restent ouvertes
+# et enchaînent les messages, les erreurs temporaires sont rejouées avec backoff.
+
+BREVO_SMTP_HOST = "smtp-relay.brevo.com"
+BREVO_SMTP_PORT = 587
+SMTP_ENVELOPE_FROM = "support@justicio.fr"
+
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "2"))
+SMTP_CONNECTION_MAX_MESSAGES = int(os.environ.get("SMTP_CONNECTION_MAX_MESSAGES", "100"))
+SMTP_CONNECTION_IDLE_SECONDS = int(os.environ.get("SMTP_CONNECTION_IDLE_SECONDS", "120"))
+SMTP_TIMEOUT_SECONDS = int(os.environ.get("SMTP_TIMEOUT_SECONDS", "30"))
+SMTP_MAX_ATTEMPTS = int(os.environ.get("SMTP_MAX_ATTEMPTS", "5"))
+SMTP_RETRY_BASE_SECONDS = int(os.environ.get("SMTP_RETRY_BASE_SECONDS", "30"))
+SMTP_QUEUE_BATCH = int(os.environ.get("SMTP_QUEUE_BATCH", "50"))
+SMTP_QUEUE_POLL_SECONDS = int(os.environ.get("SMTP_QUEUE_POLL_SECONDS", "15"))
+# Pire cas d'UN message : 2 connexions (1re morte) × 6 opérations SMTP bornées par le
+# timeout (connect, ehlo, starttls, ehlo, login, sendmail)
+SMTP_MESSAGE_MAX_SECONDS = 2 * 6 * SMTP_TIMEOUT_SECONDS
+# Un message resté 'sending' plus longtemps vient d'un worker mort → remis en file.
+# Les messages sont réclamés un par connexion juste avant l'envoi : le seuil doit
+# seulement dépasser largement SMTP_MESSAGE_MAX_SECONDS (plancher imposé)
+SMTP_SENDING_STALE_MINUTES = max(int(os.environ.get("SMTP_SENDING_STALE_MINUTES", "30")),
+                                 -(-2 * SMTP_MESSAGE_MAX_SECONDS // 60))
+
+SMTP_STATS = {"connections_opened": 0, "connections_reused": 0, "sent": 0, "retried": 0, "failed": 0}
+
+
+class SMTPConnectionPool:
     """
-    📬 Envoi via SMTP Brevo depuis Justicio en qualité de mandataire.
-    Article 1984 du Code civil français.
+    🔌 Petit pool de connexions SMTP Brevo (STARTTLS + login faits une fois).
+    Une connexion est recyclée après SMTP_CONNECTION_MAX_MESSAGES messages ou
+    SMTP_CONNECTION_IDLE_SECONDS d'inactivité ; une connexion en erreur est jetée.
     """
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart as _MIMEMultipart
 
-    BREVO_SMTP_HOST = "smtp-relay.brevo.com"
-    BREVO_SMTP_PORT = 587
-    BREVO_LOGIN = os.environ.get("BREVO_SMTP_LOGIN", "support@justicio.fr")
-    BREVO_KEY = os.environ.get("BREVO_SMTP_KEY")
+    def __init__(self, size):
+        self.size = size
+        self._idle = []  # [(smtp, messages_envoyés, dernier_usage)]
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
 
-    if not BREVO_KEY:
-        DEBUG_LOGS.append("📬 SMTP ❌ BREVO_SMTP_KEY manquant")
-        return {"success": False, "message_id": None,
-                "error": "BREVO_SMTP_KEY non configuré", "error_type": "CONFIG_ERROR"}
+    def _connect(self):
+        import smtplib
+        login = os.environ.get("BREVO_SMTP_LOGIN", "support@justicio.fr")
+        smtp = smtplib.SMTP(BREVO_SMTP_HOST, BREVO_SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+        try:
+            smtp.ehlo()
+            smtp.starttls()
+            smtp.ehlo()
+            smtp.login(login, os.environ.get("BREVO_SMTP_KEY"))
+        except Exception:
+            self._quit(smtp)
+            raise
+        SMTP_STATS["connections_opened"] += 1
+        return smtp
+
+    @staticmethod
+    def _quit(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
 
-    if not target_email or '@' not in target_email:
-        return {"success": False, "message_id": None,
-                "error": f"Email destinataire invalide: {target_email}", "error_type": "INVALID_EMAIL"}
+    def acquire(self):
+        """Retourne (smtp, messages_envoyés) - bloque si toutes les connexions sont prises"""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    return self._connect(), 0
+                smtp, count, last_used = entry
+                if time.monotonic() - last_used > SMTP_CONNECTION_IDLE_SECONDS:
+                    self._quit(smtp)
+                    continue
+                SMTP_STATS["connections_reused"] += 1
+                return smtp, count
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, smtp, count, broken=False):
+        if broken or count >= SMTP_CONNECTION_MAX_MESSAGES:
+            self._quit(smtp)
+        else:
+            with self._lock:
+                self._idle.append((smtp, count, time.monotonic()))
+        self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _, _ in idle:
+            self._quit(smtp)
+
+    def send(self, envelope_from, recipients, message):
+        """Envoie UN message sur une connexion du pool (relance une fois si la connexion était morte)"""
+        import smtplib
+        for attempt in range(2):
+            smtp, count = self.acquire()
+            try:
+                smtp.sendmail(envelope_from, recipients, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # Connexion réutilisée fermée côté serveur → une seconde chance sur une neuve
+                self.release(smtp, count, broken=True)
+                if attempt or count == 0:
+                    raise
+                continue
+            except smtplib.SMTPRecipientsRefused:
+                self.release(smtp, count + 1)
+                raise
+            except smtplib.SMTPResponseException as e:
+                self.release(smtp, count + 1, broken=e.smtp_code in (421, 451))
+                raise
+            except Exception:
+                self.release(smtp, count, broken=True)
+                raise
+            self.release(smtp, count + 1)
+            return
+
+
+SMTP_POOL = SMTPConnectionPool(SMTP_POOL_SIZE)
+
+
+def build_mise_en_demeure_message(user, target_email, subject, html_body, text_body=None,
+                                  litigation_id=None):
+    """Construit le MIME de la mise en demeure (footer mandataire inclus) → (message, destinataires)"""
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart as _MIMEMultipart
 
     date_mandat = (user.created_at.strftime('%d/%m/%Y')
                    if hasattr(user, 'created_at') and user.created_at else 'inscription Justicio')
@@ -430,25 +955,51 @@ def send_mise_en_demeure_smtp(user, target_email, subject, html_body, text_body=
     """
     full_html = html_body + mandataire_footer
 
+    msg = _MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = f'"Justicio (mandataire)" <{SMTP_ENVELOPE_FROM}>'
+    msg['To'] = target_email
+    msg['Reply-To'] = user.email
+    msg['X-Justicio-Mandant'] = user.email
+    if litigation_id:
+        msg['X-Justicio-Case-ID'] = str(litigation_id)
+
+    if text_body:
+        msg.attach(MIMEText(text_body, 'plain', 'utf-8'))
+    msg.attach(MIMEText(full_html, 'html', 'utf-8'))
+    return msg, [target_email, user.email]
+
+
+def _check_smtp_request(target_email):
+    """Erreurs de configuration / destinataire communes à l'envoi direct et à la file"""
+    if not os.environ.get("BREVO_SMTP_KEY"):
+        DEBUG_LOGS.append("📬 SMTP ❌ BREVO_SMTP_KEY manquant")
+        return {"success": False, "message_id": None,
+                "error": "BREVO_SMTP_KEY non configuré", "error_type": "CONFIG_ERROR"}
+    if not target_email or '@' not in target_email:
+        return {"success": False, "message_id": None,
+                "error": f"Email destinataire invalide: {target_email}", "error_type": "INVALID_EMAIL"}
+    return None
+
+
+def send_mise_en_demeure_smtp(user, target_email, subject, html_body, text_body=None,
+                               litigation_id=None, company=None):
+    """
+    📬 Envoi IMMÉDIAT via SMTP Brevo depuis Justicio en qualité de mandataire.
+    Article 1984 du Code civil français. Réutilise les connexions du pool.
+    Pour les envois depuis une requête utilisateur, préférer enqueue_mise_en_demeure().
+    """
+    import smtplib
+
+    error = _check_smtp_request(target_email)
+    if error:
+        return error
+
     try:
-        msg = _MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        msg['From'] = f'"Justicio (mandataire)" <support@justicio.fr>'
-        msg['To'] = target_email
-        msg['Reply-To'] = user.email
-        msg['X-Justicio-Mandant'] = user.email
-        if litigation_id:
-            msg['X-Justicio-Case-ID'] = str(litigation_id)
-
-        if text_body:
-            msg.attach(MIMEText(text_body, 'plain', 'utf-8'))
-        msg.attach(MIMEText(full_html, 'html', 'utf-8'))
-
-        with smtplib.SMTP(BREVO_SMTP_HOST, BREVO_SMTP_PORT) as smtp:
-            smtp.ehlo()
-            smtp.starttls()
-            smtp.login(BREVO_LOGIN, BREVO_KEY)
-            smtp.sendmail("support@justicio.fr", [target_email, user.email], msg.as_bytes())
+        msg, recipients = build_mise_en_demeure_message(
+            user, target_email, subject, html_body, text_body, litigation_id
+        )
+        SMTP_POOL.send(SMTP_ENVELOPE_FROM, recipients, msg.as_string())
 
         message_id = f"brevo-{litigation_id or 'x'}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
         DEBUG_LOGS.append(f"📬 SMTP ✅ Envoyé → {target_email} (BCC: {user.email})")
@@ -464,6 +1015,219 @@ def send_mise_en_demeure_smtp(user, target_email, subject, html_body, text_body=
                 "error": f"Erreur SMTP: {str(e)[:80]}", "error_type": "SMTP_ERROR"}
 
 
+def enqueue_mise_en_demeure(user, target_email, subject, html_body, text_body=None,
+                            litigation_id=None, company=None, mise_en_demeure_id=None,
+                            notify=False, commit=True):
+    """
+    📥 Met la mise en demeure dans la file d'envoi (table outbound_email) et réveille l'expéditeur.
+    Le dossier / la MiseEnDemeure ne passent à 'envoyé' qu'une fois le message accepté par Brevo.
+    commit=False : l'appelant regroupe plusieurs envois dans sa transaction puis
+    appelle start_outbound_sender() après son commit.
+
+    Retourne {"success": bool, "queued": bool, "outbound_id": int|None, "error": str, "error_type": str}
+    """
+    error = _check_smtp_request(target_email)
+    if error:
+        return {**error, "queued": False, "outbound_id": None}
+
+    msg, recipients = build_mise_en_demeure_message(
+        user, target_email, subject, html_body, text_body, litigation_id
+    )
+    outbound = OutboundEmail(
+        user_email=user.email,
+        litigation_id=litigation_id,
+        mise_en_demeure_id=mise_en_demeure_id,
+        company=company,
+        target_email=target_email,
+        recipients_json=json.dumps(recipients),
+        subject=subject[:300] if subject else None,
+        message=msg.as_string(),
+        notify=notify,
+    )
+    db.session.add(outbound)
+    if not commit:
+        return {"success": True, "queued": True, "outbound_id": None,
+                "message_id": None, "error": None, "error_type": None}
+    db.session.commit()
+
+    DEBUG_LOGS.append(f"📥 SMTP file: #{outbound.id} → {target_email} (dossier #{litigation_id})")
+    start_outbound_sender()
+    return {"success": True, "queued": True, "outbound_id": outbound.id,
+            "message_id": None, "error": None, "error_type": None}
+
+
+# ── Thread d'envoi ───────────────────────────────────────────────────────────
+
+_OUTBOUND_WAKEUP = threading.Event()
+_OUTBOUND_SENDER = {"thread": None}
+_OUTBOUND_SENDER_LOCK = threading.Lock()
+
+
+def start_outbound_sender():
+    """Démarre le thread d'envoi s'il ne tourne pas encore, et le réveille"""
+    with _OUTBOUND_SENDER_LOCK:
+        thread = _OUTBOUND_SENDER["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_outbound_sender_loop, name="smtp-sender", daemon=True)
+            _OUTBOUND_SENDER["thread"] = thread
+            thread.start()
+    _OUTBOUND_WAKEUP.set()
+
+
+def _outbound_sender_loop():
+    while True:
+        _OUTBOUND_WAKEUP.wait(SMTP_QUEUE_POLL_SECONDS)
+        _OUTBOUND_WAKEUP.clear()
+        try:
+            while call_in_app_context(deliver_outbound_batch) >= SMTP_QUEUE_BATCH:
+                pass
+        except Exception as e:
+            DEBUG_LOGS.append(f"📬 SMTP file ❌ {type(e).__name__}: {str(e)[:100]}")
+
+
+def _is_transient_smtp_error(exc) -> bool:
+    """4xx, coupure réseau, timeout → on réessaie ; 5xx (refus définitif) → échec"""
+    import smtplib
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    # SMTPServerDisconnected, timeouts, erreurs réseau (toutes des OSError)
+    return isinstance(exc, OSError)
+
+
+def _send_outbound_one(item):
+    """Envoie un message sur une connexion du pool SMTP → (id, exception|None)"""
+    outbound_id, recipients, message = item
+    try:
+        SMTP_POOL.send(SMTP_ENVELOPE_FROM, recipients, message)
+        return outbound_id, None
+    except Exception as e:
+        return outbound_id, e
+
+
+def deliver_outbound_batch():
+    """
+    📤 Vide un lot de la file (SMTP_QUEUE_BATCH messages dus max) par vagues de
+    SMTP_POOL_SIZE : chaque vague est réclamée ('sending') juste avant l'envoi,
+    envoyée en parallèle puis son résultat appliqué aussitôt. Un message n'est
+    donc jamais 'sending' plus de SMTP_MESSAGE_MAX_SECONDS → pas de double envoi
+    par la remise en file des orphelins.
+    Retourne le nombre de messages traités.
+    """
+    from datetime import timedelta
+    now = datetime.utcnow()
+
+    # Messages 'sending' orphelins (worker tué pendant l'envoi) → remis en file
+    OutboundEmail.query.filter(
+        OutboundEmail.status == 'sending',
+        OutboundEmail.updated_at < now - timedelta(minutes=SMTP_SENDING_STALE_MINUTES)
+    ).update({"status": "queued"}, synchronize_session=False)
+    db.session.commit()
+
+    due_ids = [row.id for row in OutboundEmail.query.with_entities(OutboundEmail.id).filter(
+        OutboundEmail.status == 'queued',
+        OutboundEmail.next_attempt_at <= now
+    ).order_by(OutboundEmail.id).limit(SMTP_QUEUE_BATCH)]
+    if not due_ids:
+        return 0
+
+    processed = 0
+    with ThreadPoolExecutor(max_workers=SMTP_POOL_SIZE, thread_name_prefix="smtp-conn") as pool:
+        for start in range(0, len(due_ids), SMTP_POOL_SIZE):
+            claimed = []
+            for outbound_id in due_ids[start:start + SMTP_POOL_SIZE]:
+                # Réclamation atomique : un autre worker gunicorn a pu prendre le message
+                won = OutboundEmail.query.filter_by(id=outbound_id, status='queued').update(
+                    {"status": "sending", "updated_at": datetime.utcnow()}, synchronize_session=False
+                )
+                if won:
+                    claimed.append(outbound_id)
+            db.session.commit()
+            if not claimed:
+                continue
+
+            outbounds = [OutboundEmail.query.get(outbound_id) for outbound_id in claimed]
+            items = [(o.id, json.loads(o.recipients_json), o.message) for o in outbounds]
+            results = dict(pool.map(_send_outbound_one, items))
+            for outbound in outbounds:
+                _apply_outbound_result(outbound, results.get(outbound.id))
+            processed += len(outbounds)
+    return processed
+
+
+def _apply_outbound_result(outbound, exc):
+    """Met à jour la file, la MiseEnDemeure et le dossier selon le résultat d'envoi"""
+    from datetime import timedelta
+    outbound.attempts = (outbound.attempts or 0) + 1
+
+    if exc is None:
+        outbound.status = 'sent'
+        outbound.sent_at = datetime.utcnow()
+        outbound.message_id = f"brevo-{outbound.litigation_id or 'x'}-{outbound.sent_at.strftime('%Y%m%d%H%M%S')}"
+        outbound.last_error = None
+        _on_outbound_accepted(outbound)
+        db.session.commit()
+        SMTP_STATS["sent"] += 1
+        DEBUG_LOGS.append(f"📬 SMTP ✅ #{outbound.id} accepté → {outbound.target_email} (BCC: {outbound.user_email})")
+        if outbound.notify:
+            send_telegram_notif(
+                f"📧 MISE EN DEMEURE ENVOYÉE !\n\n"
+                f"🏪 {(outbound.company or '').upper()}\n"
+                f"📬 Envoyé à: {outbound.target_email}\n"
+                f"👤 Client: {outbound.user_email}"
+            )
+        return
+
+    outbound.last_error = f"{type(exc).__name__}: {str(exc)[:250]}"
+    if _is_transient_smtp_error(exc) and outbound.attempts < SMTP_MAX_ATTEMPTS:
+        delay = SMTP_RETRY_BASE_SECONDS * (2 ** (outbound.attempts - 1))
+        outbound.status = 'queued'
+        outbound.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
+        SMTP_STATS["retried"] += 1
+        DEBUG_LOGS.append(f"📬 SMTP ⏳ #{outbound.id} réessai dans {delay}s ({outbound.last_error[:80]})")
+        return
+
+    outbound.status = 'failed'
+    _on_outbound_failed(outbound)
+    db.session.commit()
+    SMTP_STATS["failed"] += 1
+    DEBUG_LOGS.append(f"📬 SMTP ❌ #{outbound.id} abandonné après {outbound.attempts} essai(s): {outbound.last_error[:80]}")
+
+
+def _on_outbound_accepted(outbound):
+    """Le relais a accepté le message : la mise en demeure est officiellement envoyée"""
+    if outbound.mise_en_demeure_id:
+        envoi = MiseEnDemeure.query.get(outbound.mise_en_demeure_id)
+        if envoi:
+            envoi.status = 'sent'
+            envoi.sent_at = outbound.sent_at
+            envoi.message_id = outbound.message_id
+    if outbound.litigation_id:
+        lit = Litigation.query.get(outbound.litigation_id)
+        if lit:
+            lit.legal_notice_sent = True
+            lit.legal_notice_date = outbound.sent_at
+            lit.legal_notice_message_id = outbound.message_id
+            if not lit.merchant_email:
+                lit.merchant_email = outbound.target_email
+            if lit.status in ("En traitement", "Détecté", "detected") or (lit.status or "").startswith("Erreur envoi"):
+                lit.status = "En attente de remboursement"  # Statut surveillé par le Cron
+
+
+def _on_outbound_failed(outbound):
+    """Échec définitif : on le reporte sur la MiseEnDemeure et le dossier"""
+    if outbound.mise_en_demeure_id:
+        envoi = MiseEnDemeure.query.get(outbound.mise_en_demeure_id)
+        if envoi:
+            envoi.status = 'failed'
+    if outbound.litigation_id:
+        lit = Litigation.query.get(outbound.litigation_id)
+        if lit and not lit.legal_notice_sent:
+            lit.status = "Erreur envoi: SMTP_ERROR"
+
+
 def send_mise_en_demeure_ar24(user, target_email, target_address, subject, html_body,
                                litigation_id=None, company=None):
     """
@@ -700,6 +1464,42 @@ def normalize_company_key(name: str) -> str:
     return n
 
 
+# Variations (contains) : fallback supplémentaire, COMPANY_EMAIL_OVERRIDE a la priorité
+COMPANY_EMAIL_VARIATIONS = {
+    "air france": "mail.customercare@airfrance.fr",
+    "airfrance": "mail.customercare@airfrance.fr",
+    "easyjet": "customerservices@easyjet.com",
+    "ryanair": "customerqueries@ryanair.com",
+    "transavia": "service.client@transavia.com",
+    "vueling": "clientes@vueling.com",
+    "volotea": "customers@volotea.com",
+    "eurostar": "contactcentre@eurostar.com",
+    "ouigo": "relation.client@ouigo.com",
+    "thalys": "customer.services@thalys.com",
+    "uber": "support@uber.com",
+    "bolt": "support@bolt.eu",
+    "amazon": "cs-reply@amazon.fr",
+    "zalando": "service@zalando.fr",
+    "fnac": "serviceclient@fnac.com",
+    "darty": "serviceclient@darty.com",
+    "cdiscount": "clients@cdiscount.com",
+    "sncf": "reclamation-client@sncf.fr",
+    "tgv": "reclamation-client@sncf.fr",
+    "train": "reclamation-client@sncf.fr",
+    "shein": "frcsteam@shein.com",
+    "booking": "customer.service@booking.com",
+    "airbnb": "support@airbnb.com",
+}
+
+
+def resolve_company_email(company_name):
+    """
+    🔍 Comme get_company_email, mais retourne (email, règle) pour savoir d'où vient l'adresse.
+    Règles : override_exact, override_contains:<clé>, legal_directory, variation:<clé>, fallback
+    """
+    return COMPANY_EMAIL_RESOLVER.resolve(company_name)
+
+
 def get_company_email(company_name, sender_email=None, to_field=None):
     """
     🔍 Trouve l'email de contact d'une entreprise
@@ -710,213 +1510,342 @@ def get_company_email(company_name, sender_email=None, to_field=None):
     3) Variations (contains)
     4) Fallback support
     """
-    company_key = normalize_company_key(company_name)
-
-    if company_key in COMPANY_EMAIL_OVERRIDE:
-        return COMPANY_EMAIL_OVERRIDE[company_key]
-
-    for k, v in COMPANY_EMAIL_OVERRIDE.items():
-        if k and k in company_key:
-            return v
-
-    if company_key in LEGAL_DIRECTORY and LEGAL_DIRECTORY[company_key].get("email"):
-        return LEGAL_DIRECTORY[company_key]["email"]
-
-    variations = {
-        # Ces variations sont un fallback supplémentaire
-        # COMPANY_EMAIL_OVERRIDE a la priorité
-        "air france": "mail.customercare@airfrance.fr",
-        "airfrance": "mail.customercare@airfrance.fr",
-        "easyjet": "customerservices@easyjet.com",
-        "ryanair": "customerqueries@ryanair.com",
-        "transavia": "service.client@transavia.com",
-        "vueling": "clientes@vueling.com",
-        "volotea": "customers@volotea.com",
-        "eurostar": "contactcentre@eurostar.com",
-        "ouigo": "relation.client@ouigo.com",
-        "thalys": "customer.services@thalys.com",
-        "uber": "support@uber.com",
-        "bolt": "support@bolt.eu",
-        "amazon": "cs-reply@amazon.fr",
-        "zalando": "service@zalando.fr",
-        "fnac": "serviceclient@fnac.com",
-        "darty": "serviceclient@darty.com",
-        "cdiscount": "clients@cdiscount.com",
-        "sncf": "reclamation-client@sncf.fr",
-        "tgv": "reclamation-client@sncf.fr",
-        "train": "reclamation-client@sncf.fr",
-        "shein": "frcsteam@shein.com",
-        "booking": "customer.service@booking.com",
-        "airbnb": "support@airbnb.com",
-    }
-    for key, email in variations.items():
-        if key in company_key:
-            return email
+    email, rule = resolve_company_email(company_name)
+    if rule == "fallback":
+        _dbg(f"🔍 Email non trouvé pour {company_name} - fallback support")
+    return email
 
-    _dbg(f"🔍 Email non trouvé pour {company_name} - fallback support")
-    return SUPPORT_EMAIL
 
+# Générations de lettres GPT simultanées pour un même lot de litiges
+LETTER_GEN_WORKERS = int(os.environ.get("LETTER_GEN_WORKERS", "4"))
 
-def process_pending_litigations(user, litigations_data):
+
+def insert_pending_litigations(user, litigations_data):
+    """
+    ÉTAPE 1 du post-paiement, SYNCHRONE dans /success : enregistre tous les dossiers
+    (UNE transaction, savepoint par dossier) avant de rendre la main au worker.
+    Un redémarrage ne peut donc plus faire perdre un dossier payé.
+    
+    Returns:
+        (list[int], list[str]): ids des dossiers créés, erreurs
     """
-    🚀 PROCESSEUR PRINCIPAL - Traite tous les litiges pending après paiement
+    errors = []
+    cases = []  # [(Litigation, lit_data)]
+    
+    for lit_data in litigations_data:
+        company = lit_data.get('company', 'Inconnu')
+        new_lit = Litigation(
+            user_email=user.email,
+            company=company,
+            amount=lit_data.get('amount', '0€'),
+            law=lit_data.get('law', 'Code de la consommation'),
+            subject=lit_data.get('subject', lit_data.get('proof', 'Litige non spécifié')),
+            message_id=lit_data.get('message_id'),
+            status="En traitement"
+        )
+        try:
+            with db.session.begin_nested():
+                db.session.add(new_lit)
+            cases.append((new_lit, lit_data))
+        except IntegrityError:
+            errors.append(f"🔄 {company}: Doublon ignoré")
+        except Exception as e:
+            errors.append(f"❌ {company}: Erreur DB - {str(e)[:30]}")
     
-    Pour chaque litige :
-    1. Génère la mise en demeure (Agent Avocat GPT)
-    2. Envoie l'email (Agent Facteur Gmail)
-    3. Met à jour le statut en base
-    4. Notifie via Telegram
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        errors.append(f"❌ Erreur DB - {str(e)[:30]}")
+        cases = []
+    
+    DEBUG_LOGS.append(f"   ✅ {len(cases)} dossier(s) créé(s)")
+    return [new_lit.id for new_lit, _ in cases], errors
+
+
+def process_pending_litigations(user, litigation_ids, job_id=None):
+    """
+    🚀 PROCESSEUR PRINCIPAL - Traite les dossiers enregistrés après paiement
+    
+    Pipeline par étapes (étape 1 = insert_pending_litigations, dans /success) :
+    2. Génère les mises en demeure en parallèle (Agent Avocat GPT, LETTER_GEN_WORKERS)
+    3. Met toutes les lettres en file d'envoi (UNE transaction)
+    4. Envoi + notification Telegram : thread smtp-sender (statut mis à jour à l'acceptation)
+    
+    Reprenable : un dossier qui a déjà une mise en demeure en file n'est pas retraité.
     
     Args:
         user: Instance User
-        litigations_data: Liste de dicts avec les données des litiges
+        litigation_ids: Ids des dossiers créés à l'étape 1
+        job_id: LitigationJob à tenir à jour (progression), optionnel
     
     Returns:
         dict: {"sent": int, "errors": list, "details": list}
     """
     
-    sent_count = 0
+    def progress(**fields):
+        if job_id:
+            _litigation_job_update(job_id, **fields)
+    
     errors = []
     details = []
     
-    DEBUG_LOGS.append(f"🚀 Traitement de {len(litigations_data)} litige(s) pour {user.email}")
+    DEBUG_LOGS.append(f"🚀 Traitement de {len(litigation_ids)} dossier(s) pour {user.email}")
     
-    for lit_data in litigations_data:
-        company = lit_data.get('company', 'Inconnu')
-        amount = lit_data.get('amount', '0€')
-        motif = lit_data.get('subject', lit_data.get('proof', 'Litige non spécifié'))
-        law = lit_data.get('law', 'Code de la consommation')
-        message_id = lit_data.get('message_id')
-        
-        DEBUG_LOGS.append(f"📝 Traitement: {company} - {amount}")
-        
-        # ═══════════════════════════════════════════════════════════════
-        # ÉTAPE 1 : Enregistrer en base de données
-        # ═══════════════════════════════════════════════════════════════
-        
-        try:
-            new_lit = Litigation(
-                user_email=user.email,
-                company=company,
-                amount=amount,
-                law=law,
-                subject=motif,
-                message_id=message_id,
-                status="En traitement"
-            )
-            db.session.add(new_lit)
-            db.session.commit()
-            litigation_id = new_lit.id
-            DEBUG_LOGS.append(f"   ✅ Dossier #{litigation_id} créé")
-        except IntegrityError:
-            db.session.rollback()
-            errors.append(f"🔄 {company}: Doublon ignoré")
-            continue
-        except Exception as e:
-            db.session.rollback()
-            errors.append(f"❌ {company}: Erreur DB - {str(e)[:30]}")
-            continue
-        
-        # ═══════════════════════════════════════════════════════════════
-        # ÉTAPE 2 : Trouver l'email de l'entreprise
-        # ═══════════════════════════════════════════════════════════════
-        
-        target_email = get_company_email(
-            company,
-            sender_email=lit_data.get("sender", ""),
-            to_field=lit_data.get("to_field", "")
-        )
-        DEBUG_LOGS.append(f"   📧 Email cible: {target_email}")
-        
-        # ═══════════════════════════════════════════════════════════════
-        # ÉTAPE 3 : Générer la mise en demeure (Agent Avocat)
-        # ═══════════════════════════════════════════════════════════════
-        
-        user_name = user.name or user.email.split('@')[0].title()
-        
-        letter_result = generate_legal_letter_gpt(
-            company=company,
-            amount=amount,
-            motif=motif,
-            law=law,
-            client_name=user_name,
-            client_email=user.email,
-            order_ref=None
-        )
+    litigations = Litigation.query.filter(Litigation.id.in_(litigation_ids)).all() if litigation_ids else []
+    already_queued = {
+        row.litigation_id for row in OutboundEmail.query
+        .with_entities(OutboundEmail.litigation_id)
+        .filter(OutboundEmail.litigation_id.in_(litigation_ids))
+    } if litigation_ids else set()
+    cases = []
+    sent_count = 0
+    for new_lit in sorted(litigations, key=lambda lit: lit.id):
+        if new_lit.id in already_queued:
+            # Reprise : déjà mis en file par un run précédent
+            sent_count += 1
+            details.append({
+                "company": new_lit.company,
+                "amount": new_lit.amount,
+                "email": new_lit.merchant_email,
+                "status": "✅ En file d'envoi"
+            })
+        else:
+            cases.append((new_lit, None))
+    
+    # ═══════════════════════════════════════════════════════════════
+    # ÉTAPE 2 : Email de l'entreprise + mise en demeure (Agent Avocat, en parallèle)
+    # ═══════════════════════════════════════════════════════════════
+    
+    progress(phase="Rédaction des mises en demeure", total=len(litigation_ids), letters_done=len(already_queued))
+    user_name = user.name or user.email.split('@')[0].title()
+    letters = {}
+    
+    if cases:
+        with ThreadPoolExecutor(max_workers=min(LETTER_GEN_WORKERS, len(cases)),
+                                thread_name_prefix="letter") as pool:
+            futures = {
+                pool.submit(
+                    call_in_app_context,
+                    generate_legal_letter_gpt,
+                    company=new_lit.company,
+                    amount=new_lit.amount,
+                    motif=new_lit.subject,
+                    law=new_lit.law,
+                    client_name=user_name,
+                    client_email=user.email,
+                    order_ref=None
+                ): new_lit.id
+                for new_lit, _ in cases
+            }
+            for done, future in enumerate(as_completed(futures), start=len(already_queued) + 1):
+                try:
+                    letters[futures[future]] = future.result()
+                except Exception as e:
+                    letters[futures[future]] = {"success": False, "error": str(e)[:100]}
+                progress(letters_done=done)
+    
+    # ═══════════════════════════════════════════════════════════════
+    # ÉTAPE 3 : Mise en file d'envoi (une seule transaction)
+    # ═══════════════════════════════════════════════════════════════
+    # Le thread smtp-sender envoie ; le dossier passe "En attente de
+    # remboursement" (+ notif Telegram) quand Brevo accepte le message.
+    
+    progress(phase="Mise en file d'envoi")
+    resumed_count = sent_count
+    
+    for new_lit, _ in cases:
+        company = new_lit.company
+        letter_result = letters.get(new_lit.id) or {"success": False, "error": "Non générée"}
         
         if not letter_result["success"]:
             errors.append(f"⚠️ {company}: Échec génération lettre - {letter_result['error']}")
             new_lit.status = "Erreur génération"
-            db.session.commit()
             continue
         
-        DEBUG_LOGS.append(f"   ✅ Lettre générée")
+        # Verrou sur le dossier puis nouvelle vérification dans la transaction de mise
+        # en file : un run concurrent du même job attend notre commit et voit la lettre
+        Litigation.query.filter_by(id=new_lit.id).with_for_update().first()
+        if OutboundEmail.query.filter_by(litigation_id=new_lit.id).first():
+            DEBUG_LOGS.append(f"   ⏭️ {company}: déjà en file d'envoi (run concurrent)")
+            sent_count += 1
+            details.append({
+                "company": company,
+                "amount": new_lit.amount,
+                "email": new_lit.merchant_email,
+                "status": "✅ En file d'envoi"
+            })
+            continue
         
-        # ═══════════════════════════════════════════════════════════════
-        # ÉTAPE 4 : Envoyer l'email (Agent Facteur)
-        # ═══════════════════════════════════════════════════════════════
+        target_email, email_rule = resolve_company_email(company)
+        DEBUG_LOGS.append(f"   📧 {company}: email cible {target_email} ({email_rule})")
         
-        send_result = send_mise_en_demeure_smtp(
+        send_result = enqueue_mise_en_demeure(
             user=user,
             target_email=target_email,
             subject=letter_result["subject"],
             html_body=letter_result["html_body"],
             text_body=letter_result["text_body"],
-            litigation_id=litigation_id
+            litigation_id=new_lit.id,
+            company=company,
+            notify=True,
+            commit=False
         )
         
         if send_result["success"]:
-            # Succès !
-            new_lit.status = "En attente de remboursement"  # Statut surveillé par le Cron
-            new_lit.legal_notice_sent = True
-            new_lit.legal_notice_date = datetime.now()
-            new_lit.legal_notice_message_id = send_result["message_id"]
             new_lit.merchant_email = target_email
-            db.session.commit()
-            
             sent_count += 1
             details.append({
                 "company": company,
-                "amount": amount,
+                "amount": new_lit.amount,
                 "email": target_email,
-                "status": "✅ Envoyé"
+                "status": "✅ En file d'envoi"
             })
-            
-            DEBUG_LOGS.append(f"   ✅ ENVOYÉ ! Message ID: {send_result['message_id']}")
-            
-            # Notification Telegram
-            send_telegram_notif(
-                f"📧 MISE EN DEMEURE ENVOYÉE !\n\n"
-                f"🏪 {company.upper()}\n"
-                f"💰 {amount}\n"
-                f"📬 Envoyé à: {target_email}\n"
-                f"👤 Client: {user.email}"
-            )
         else:
-            # Échec
-            error_detail = f"{send_result['error_type']}: {send_result['error']}"
             errors.append(f"❌ {company}: {send_result['error']}")
             new_lit.status = f"Erreur envoi: {send_result['error_type']}"
-            db.session.commit()
-            
             details.append({
                 "company": company,
-                "amount": amount,
+                "amount": new_lit.amount,
                 "email": target_email,
                 "status": f"❌ {send_result['error_type']}"
             })
-            
-            DEBUG_LOGS.append(f"   ❌ Échec: {error_detail}")
+            DEBUG_LOGS.append(f"   ❌ Échec: {send_result['error_type']}: {send_result['error']}")
+    
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        errors.append(f"❌ Erreur DB (file d'envoi) - {str(e)[:30]}")
+        sent_count = resumed_count
+        details = details[:resumed_count] + [dict(d, status="❌ DB_ERROR") for d in details[resumed_count:]]
     
-    DEBUG_LOGS.append(f"🚀 Traitement terminé: {sent_count}/{len(litigations_data)} envoyé(s)")
+    if sent_count:
+        start_outbound_sender()
+    
+    DEBUG_LOGS.append(f"🚀 Traitement terminé: {sent_count}/{len(litigation_ids)} en file d'envoi")
     
     return {
         "sent": sent_count,
-        "total": len(litigations_data),
+        "total": len(litigation_ids),
         "errors": errors,
         "details": details
     }
 
+# ════════════════════════════════════════════════════════════════════════════════
+# 🧵 TRAITEMENT POST-PAIEMENT EN ARRIÈRE-PLAN (table litigation_job)
+# ════════════════════════════════════════════════════════════════════════════════
+# /success crée un LitigationJob et rend la main : la page /litigation-progress/<id>
+# interroge /litigation-status/<id> puis affiche le rapport une fois le lot traité.
+
+LITIGATION_JOB_WORKERS = int(os.environ.get("LITIGATION_JOB_WORKERS", "2"))
+LITIGATION_JOB_STALE_MINUTES = 15
+LITIGATION_JOB_MAX_ATTEMPTS = int(os.environ.get("LITIGATION_JOB_MAX_ATTEMPTS", "3"))
+LITIGATION_EXECUTOR = ThreadPoolExecutor(max_workers=LITIGATION_JOB_WORKERS, thread_name_prefix="litigation")
+
+def _litigation_job_update(job_id, **fields):
+    """Met à jour la ligne LitigationJob - ne crash jamais"""
+    try:
+        job = LitigationJob.query.get(job_id)
+        if not job:
+            return
+        for key, value in fields.items():
+            setattr(job, key, value)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _dbg(f"⚠️ LitigationJob {job_id[:8]}: mise à jour impossible - {str(e)[:60]}")
+
+def _litigation_job_is_stale(job) -> bool:
+    """Vrai si le job est resté bloqué (worker tué, redéploiement...)"""
+    if job.status not in ("queued", "running") or not job.updated_at:
+        return False
+    from datetime import timedelta
+    return datetime.utcnow() - job.updated_at > timedelta(minutes=LITIGATION_JOB_STALE_MINUTES)
+
+def resume_litigation_job(job) -> bool:
+    """
+    Relance un job bloqué (worker tué, redéploiement) : les dossiers sont en base
+    (payload_json), process_pending_litigations saute ceux déjà mis en file.
+    Réclamation atomique (UPDATE conditionnel) → un seul worker relance.
+    """
+    from datetime import timedelta
+    if not _litigation_job_is_stale(job) or not job.payload_json:
+        return False
+    stale_before = datetime.utcnow() - timedelta(minutes=LITIGATION_JOB_STALE_MINUTES)
+    still_stale = LitigationJob.query.filter(
+        LitigationJob.id == job.id,
+        LitigationJob.status.in_(("queued", "running")),
+        LitigationJob.updated_at < stale_before
+    )
+    if (job.attempts or 0) >= LITIGATION_JOB_MAX_ATTEMPTS:
+        still_stale.update({"status": "error", "error": "Traitement interrompu à plusieurs reprises",
+                            "finished_at": datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(job)
+        return False
+    # attempts + 1 invalide aussi la soumission d'origine (run_litigation_job la refusera)
+    claimed = still_stale.update({"status": "queued", "phase": "Reprise après interruption",
+                                  "attempts": (job.attempts or 0) + 1, "updated_at": datetime.utcnow()},
+                                 synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(job)  # Réclamation perdue : l'appelant voit l'état réel du job
+    if not claimed:
+        return False
+    LITIGATION_EXECUTOR.submit(run_litigation_job, job.id, job.user_email,
+                               json.loads(job.payload_json), job.attempts)
+    DEBUG_LOGS.append(f"🔁 LitigationJob {job.id[:8]} relancé (tentative {job.attempts})")
+    return True
+
+def resume_user_litigation_jobs(user_email):
+    """Relance les jobs bloqués d'un utilisateur (appelé à l'affichage de son espace)"""
+    try:
+        for job in LitigationJob.query.filter(LitigationJob.user_email == user_email,
+                                              LitigationJob.status.in_(("queued", "running"))).all():
+            resume_litigation_job(job)
+    except Exception as e:
+        db.session.rollback()
+        _dbg(f"⚠️ Reprise LitigationJob impossible: {str(e)[:60]}")
+
+def run_litigation_job(job_id, user_email, litigation_ids, attempt=0):
+    """
+    🚀 Exécute process_pending_litigations dans LITIGATION_EXECUTOR et stocke le rapport.
+    attempt : tentative pour laquelle le job a été soumis. Le job est réclamé par un
+    UPDATE conditionnel ; une soumission dépassée (job relancé entre-temps) s'arrête.
+    """
+    with app.app_context():
+        try:
+            claimed = LitigationJob.query.filter(
+                LitigationJob.id == job_id,
+                LitigationJob.status == "queued",
+                db.func.coalesce(LitigationJob.attempts, 0) == attempt
+            ).update({"status": "running", "phase": "Démarrage", "updated_at": datetime.utcnow()},
+                     synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                DEBUG_LOGS.append(f"⏭️ LitigationJob {job_id[:8]}: tentative {attempt} dépassée, abandon")
+                return
+            user = User.query.filter_by(email=user_email).first()
+            if not user:
+                raise ValueError("Utilisateur introuvable")
+            result = process_pending_litigations(user, litigation_ids, job_id=job_id)
+            
+            job = LitigationJob.query.get(job_id)
+            pre_errors = json.loads(job.errors_json or "[]") if job else []
+            _litigation_job_update(
+                job_id, status="done", phase="Terminé", sent=result["sent"],
+                details_json=json.dumps(result["details"], ensure_ascii=False),
+                errors_json=json.dumps(pre_errors + result["errors"], ensure_ascii=False),
+                finished_at=datetime.utcnow()
+            )
+        except Exception as e:
+            db.session.rollback()
+            DEBUG_LOGS.append(f"❌ LitigationJob {job_id[:8]}: {type(e).__name__}: {str(e)[:100]}")
+            _litigation_job_update(job_id, status="error", error=f"{type(e).__name__}: {str(e)[:200]}",
+                                   finished_at=datetime.utcnow())
+        finally:
+            db.session.remove()
+
 # ========================================
 # BLACKLIST ANTI-SPAM (PARE-FEU) - CORRIGÉ BUG N°2
 # ========================================
@@ -1144,6 +2073,7 @@ class User(db.Model):
     first_dossier_lre_used = db.Column(db.Boolean, default=False)
     scan_enabled = db.Column(db.Boolean, default=True)
     account_deleted_at = db.Column(db.DateTime, nullable=True)
+    gmail_history_id = db.Column(db.String(50), nullable=True)  # Checkpoint scan incrémental (Gmail historyId)
 
 class Litigation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1180,6 +2110,12 @@ class Litigation(db.Model):
     legal_notice_sent = db.Column(db.Boolean, default=False)  # Mise en demeure envoyée
     legal_notice_date = db.Column(db.DateTime)  # Date d'envoi
     legal_notice_message_id = db.Column(db.String(100))  # ID Gmail du message envoyé
+    
+    # ════════════════════════════════════════════════════════════════
+    # DÉTECTIVE EN ARRIÈRE-PLAN (V7)
+    # ════════════════════════════════════════════════════════════════
+    detective_status = db.Column(db.String(20))  # pending, found, not_found, error (None = non lancé)
+    detective_started_at = db.Column(db.DateTime, nullable=True)  # Lancement du job (V9)
 
 
 class MiseEnDemeure(db.Model):
@@ -1200,6 +2136,124 @@ class MiseEnDemeure(db.Model):
     message_id = db.Column(db.String(200), nullable=True)
 
 
+class OutboundEmail(db.Model):
+    """File d'envoi SMTP durable (vidée par le thread smtp-sender)"""
+    __tablename__ = 'outbound_email'
+    id = db.Column(db.Integer, primary_key=True)
+    user_email = db.Column(db.String(120), nullable=False, index=True)
+    litigation_id = db.Column(db.Integer, db.ForeignKey('litigation.id'), nullable=True)
+    mise_en_demeure_id = db.Column(db.Integer, db.ForeignKey('mise_en_demeure.id'), nullable=True)
+    company = db.Column(db.String(200))
+    target_email = db.Column(db.String(200), nullable=False)
+    recipients_json = db.Column(db.Text, nullable=False)
+    subject = db.Column(db.String(300))
+    message = db.Column(db.Text, nullable=False)  # MIME complet, prêt à envoyer
+    notify = db.Column(db.Boolean, default=False)  # Notification Telegram à l'acceptation
+    status = db.Column(db.String(20), default='queued', index=True)  # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.String(300))
+    message_id = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+
+class LitigationJob(db.Model):
+    """Traitement post-paiement d'un lot de litiges (rédaction + mise en file d'envoi)"""
+    __tablename__ = 'litigation_job'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_email = db.Column(db.String(120), nullable=False, index=True)
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, error
+    phase = db.Column(db.String(100))
+    total = db.Column(db.Integer, default=0)
+    letters_done = db.Column(db.Integer, default=0)
+    sent = db.Column(db.Integer, default=0)  # Mises en demeure en file d'envoi
+    details_json = db.Column(db.Text)
+    errors_json = db.Column(db.Text)
+    payload_json = db.Column(db.Text)  # Ids des dossiers enregistrés → reprise après redémarrage
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(300))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class ScanJob(db.Model):
+    __tablename__ = 'scan_job'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_email = db.Column(db.String(120), nullable=False, index=True)
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, error
+    phase = db.Column(db.String(100))  # Étape affichée sur la page de progression
+    emails_total = db.Column(db.Integer, default=0)
+    emails_scanned = db.Column(db.Integer, default=0)
+    ai_total = db.Column(db.Integer, default=0)
+    ai_calls = db.Column(db.Integer, default=0)
+    existing_cases_count = db.Column(db.Integer, default=0)
+    results_json = db.Column(db.Text)  # Litiges détectés (partiels puis finaux)
+    total_gain = db.Column(db.Float, default=0)
+    error = db.Column(db.String(300))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class AIClassificationCache(db.Model):
+    __tablename__ = 'ai_classification_cache'
+    cache_key = db.Column(db.String(64), primary_key=True)  # sha256 (scan_type, sujet, expéditeur, corps, version prompt)
+    scan_type = db.Column(db.String(20))
+    result_json = db.Column(db.Text, nullable=False)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_hit_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class LetterSectionCache(db.Model):
+    __tablename__ = 'letter_section_cache'
+    cache_key = db.Column(db.String(64), primary_key=True)  # sha256 (version prompt, entreprise, loi, type de litige)
+    company = db.Column(db.String(200))
+    law = db.Column(db.String(300))
+    motif_class = db.Column(db.String(30))
+    prompt_version = db.Column(db.String(20))
+    sections_html = db.Column(db.Text, nullable=False)  # Argumentaire HTML avec marqueurs {{...}}
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_hit_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class RefundRun(db.Model):
+    __tablename__ = 'refund_run'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    shard = db.Column(db.Integer, default=0)  # ?shard=i
+    shard_count = db.Column(db.Integer, default=1)  # ?of=n
+    status = db.Column(db.String(20), default='running')  # running, done, abandoned
+    users_total = db.Column(db.Integer, default=0)
+    users_done_json = db.Column(db.Text)  # Curseur : emails déjà traités dans ce run
+    stats_json = db.Column(db.Text)  # Stats cumulées sur toutes les invocations du run
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class RefundEmailSeen(db.Model):
+    __tablename__ = 'refund_email_seen'
+    __table_args__ = (db.UniqueConstraint('user_email', 'message_id', name='uq_refund_email_seen'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_email = db.Column(db.String(120), nullable=False, index=True)
+    message_id = db.Column(db.String(64), nullable=False)  # ID Gmail déjà évalué par l'Encaisseur
+    evaluated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class MerchantEmailCache(db.Model):
+    __tablename__ = 'merchant_email_cache'
+    domain = db.Column(db.String(255), primary_key=True)  # Domaine enregistrable normalisé (ex: asphalte.com)
+    email = db.Column(db.String(200), nullable=True)  # None = cache négatif (aucun email trouvé)
+    source = db.Column(db.String(300))
+    candidates_json = db.Column(db.Text)  # all_emails du crawl
+    crawled_at = db.Column(db.DateTime, default=datetime.utcnow)
+    hits = db.Column(db.Integer, default=0)
+
+
 with app.app_context():
     db.create_all()
     try:
@@ -1298,8 +2352,73 @@ with app.app_context():
                     conn.commit()
                 print(f"✅ Colonne user.{col_name} ajoutée")
 
+        # ════════════════════════════════════════════════════════════════
+        # MIGRATIONS V6 - Scan incrémental (checkpoint Gmail historyId)
+        # ════════════════════════════════════════════════════════════════
+
+        new_user_columns_v6 = {
+            'gmail_history_id': 'VARCHAR(50)',
+        }
+        for col_name, col_type in new_user_columns_v6.items():
+            if col_name not in user_columns:
+                print(f"🔄 Migration V6 User : Ajout de {col_name}...")
+                with db.engine.connect() as conn:
+                    conn.execute(text(f'ALTER TABLE "user" ADD COLUMN {col_name} {col_type}'))
+                    conn.commit()
+                print(f"✅ Colonne user.{col_name} ajoutée")
+
+        # ════════════════════════════════════════════════════════════════
+        # MIGRATIONS V7 - Détective asynchrone
+        # ════════════════════════════════════════════════════════════════
+
+        new_columns_v7 = {
+            'detective_status': 'VARCHAR(20)',
+        }
+        for col_name, col_type in new_columns_v7.items():
+            if col_name not in columns:
+                print(f"🔄 Migration V7 : Ajout de {col_name}...")
+                with db.engine.connect() as conn:
+                    conn.execute(text(f'ALTER TABLE litigation ADD COLUMN {col_name} {col_type}'))
+                    conn.commit()
+                print(f"✅ Colonne {col_name} ajoutée")
+
+        # ════════════════════════════════════════════════════════════════
+        # MIGRATIONS V8 - Traitement post-paiement reprenable
+        # ════════════════════════════════════════════════════════════════
+
+        job_columns = [c['name'] for c in inspector.get_columns('litigation_job')]
+        new_job_columns_v8 = {
+            'payload_json': 'TEXT',
+            'attempts': 'INTEGER DEFAULT 0',
+        }
+        for col_name, col_type in new_job_columns_v8.items():
+            if col_name not in job_columns:
+                print(f"🔄 Migration V8 LitigationJob : Ajout de {col_name}...")
+                with db.engine.connect() as conn:
+                    conn.execute(text(f'ALTER TABLE litigation_job ADD COLUMN {col_name} {col_type}'))
+                    conn.commit()
+                print(f"✅ Colonne litigation_job.{col_name} ajoutée")
+
+        # ════════════════════════════════════════════════════════════════
+        # MIGRATIONS V9 - Détective : horodatage de lancement
+        # ════════════════════════════════════════════════════════════════
+
+        new_columns_v9 = {
+            'detective_started_at': 'TIMESTAMP',
+        }
+        for col_name, col_type in new_columns_v9.items():
+            if col_name not in columns:
+                print(f"🔄 Migration V9 : Ajout de {col_name}...")
+                with db.engine.connect() as conn:
+                    conn.execute(text(f'ALTER TABLE litigation ADD COLUMN {col_name} {col_type}'))
+                    conn.commit()
+                print(f"✅ Colonne {col_name} ajoutée")
+
         db.create_all()
-        print("✅ Base de données synchronisée (V5 - Mandataire).")
+        print("✅ Base de données synchronisée (V9 - Détective horodaté).")
+        
+        # Mises en demeure restées en file (redémarrage) → reprise de l'envoi
+        start_outbound_sender()
     except Exception as e:
         print(f"❌ Erreur DB : {e}")
 
@@ -1383,7 +2502,7 @@ def send_telegram_notif(message):
     """Envoie une notification Telegram"""
     if TELEGRAM_TOKEN and TELEGRAM_CHAT_ID:
         try:
-            requests.post(
+            get_http_session().post(
                 f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
                 json={"chat_id": TELEGRAM_CHAT_ID, "text": message, "parse_mode": "Markdown"},
                 timeout=5
@@ -1400,29 +2519,25 @@ def get_refreshed_credentials(refresh_token):
         client_id=GOOGLE_CLIENT_ID,
         client_secret=GOOGLE_CLIENT_SECRET
     )
-    creds.refresh(Request())
+    creds.refresh(Request(session=get_http_session()))
     return creds
 
 def is_spam(sender, subject, body_snippet):
     """Vérifie si un email est un spam (PARE-FEU) - VERSION CORRIGÉE"""
-    sender_lower = sender.lower()
-    subject_lower = subject.lower()
-    body_lower = body_snippet.lower()
-    
     # Check expéditeur
-    for black in BLACKLIST_SENDERS:
-        if black in sender_lower:
-            return True, f"Sender blacklist: {black}"
+    black = FILTER_KEYWORDS.scan(sender).get("spam_sender")
+    if black:
+        return True, f"Sender blacklist: {black}"
     
     # Check sujet - on cherche des correspondances plus précises
-    for black in BLACKLIST_SUBJECTS:
-        if black in subject_lower:
-            return True, f"Subject blacklist: {black}"
+    black = FILTER_KEYWORDS.scan(subject).get("spam_subject")
+    if black:
+        return True, f"Subject blacklist: {black}"
     
     # Check body - seulement si la phrase EXACTE est présente
-    for black in BLACKLIST_KEYWORDS:
-        if black in body_lower:
-            return True, f"Body blacklist: {black}"
+    black = FILTER_KEYWORDS.scan(body_snippet).get("spam_body")
+    if black:
+        return True, f"Body blacklist: {black}"
     
     return False, None
 
@@ -1445,6 +2560,138 @@ def contains_any(text: str, keywords) -> bool:
     t = text.lower()
     return any(k.lower() in t for k in keywords)
 
+class KeywordIndex:
+    """
+    🔎 Index de mots-clés multi-catégories, compilé UNE fois à l'import.
+
+    Toutes les listes sont fusionnées dans un trie converti en regex : une seule
+    passe sur le texte retourne toutes les catégories trouvées, quel que soit le
+    nombre de mots-clés. Même sémantique que `kw.lower() in text.lower()` :
+    pour chaque catégorie, on retourne le 1er mot-clé de la liste qui matche.
+    """
+
+    def __init__(self, categories: dict):
+        self.categories = {name: [k for k in kws if k] for name, kws in categories.items()}
+
+        # mot-clé (minuscule) → {catégorie: rang dans la liste d'origine}
+        owners = {}
+        for cat, kws in self.categories.items():
+            for i, kw in enumerate(kws):
+                owners.setdefault(kw.lower(), {}).setdefault(cat, i)
+
+        # La regex donne le match le plus LONG à chaque position : tout mot-clé
+        # qui commence au même endroit en est un préfixe → on fusionne leurs catégories
+        self._hits = {}
+        for kw in owners:
+            merged = {}
+            for other, cats in owners.items():
+                if kw.startswith(other):
+                    for cat, i in cats.items():
+                        merged[cat] = min(merged.get(cat, i), i)
+            self._hits[kw] = merged
+
+        trie = {}
+        for kw in owners:
+            node = trie
+            for ch in kw:
+                node = node.setdefault(ch, {})
+            node[""] = True
+        # Lookahead → matches chevauchants (un mot-clé peut être inclus dans un autre)
+        self._regex = re.compile("(?=(" + self._trie_pattern(trie) + "))")
+
+    @classmethod
+    def _trie_pattern(cls, node) -> str:
+        alts = [re.escape(ch) + cls._trie_pattern(child) for ch, child in sorted(node.items()) if ch != ""]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return "(?:" + body + ")?" if "" in node else body
+
+    def scan(self, text: str) -> dict:
+        """Retourne {catégorie: mot-clé trouvé} en une seule passe"""
+        found = {}
+        if text:
+            for m in self._regex.finditer(text.lower()):
+                for cat, i in self._hits[m.group(1)].items():
+                    if i < found.get(cat, i + 1):
+                        found[cat] = i
+        return {cat: self.categories[cat][i] for cat, i in found.items()}
+
+    def scan_many(self, texts) -> list:
+        """
+        Version batch de scan() : UNE seule passe regex sur tous les textes
+        concaténés (séparateur \\x00, absent des mots-clés → aucun match à cheval).
+        """
+        texts = [(t or "").lower() for t in texts]
+        starts = []
+        pos = 0
+        for t in texts:
+            starts.append(pos)
+            pos += len(t) + 1
+        found = [{} for _ in texts]
+        row = 0
+        # finditer rend les matches dans l'ordre → on avance l'index de ligne au fil de l'eau
+        for m in self._regex.finditer("\x00".join(texts)):
+            while row + 1 < len(starts) and m.start() >= starts[row + 1]:
+                row += 1
+            cur = found[row]
+            for cat, i in self._hits[m.group(1)].items():
+                if i < cur.get(cat, i + 1):
+                    cur[cat] = i
+        return [{cat: self.categories[cat][i] for cat, i in f.items()} for f in found]
+
+# Nombre max de noms d'entreprise mémorisés par le résolveur (vidé au-delà)
+COMPANY_RESOLVER_MEMO_MAX = int(os.environ.get("COMPANY_RESOLVER_MEMO_MAX", "4096"))
+
+class CompanyEmailResolver:
+    """
+    📇 Résolution entreprise → email, compilée UNE fois à l'import.
+
+    Même ordre de priorité que l'ancien get_company_email :
+      1) clé exacte de l'override (dict)
+      2) 1re clé de l'override contenue dans le nom (ordre du dict)
+      3) clé exacte de LEGAL_DIRECTORY avec email
+      4) 1re variation contenue dans le nom
+      5) fallback SUPPORT_EMAIL
+    Les règles "contains" passent par un KeywordIndex (une passe regex) et le
+    résultat est mémorisé par clé normalisée.
+    """
+
+    def __init__(self, override: dict, legal_directory: dict, variations: dict):
+        self.override = dict(override)
+        self.legal = {k: v["email"] for k, v in legal_directory.items() if v.get("email")}
+        self.variations = dict(variations)
+        self.index = KeywordIndex({
+            "override": list(self.override),
+            "variation": list(self.variations),
+        })
+        self._memo = {}
+
+    def _lookup(self, company_key: str):
+        if company_key in self.override:
+            return self.override[company_key], "override_exact"
+        found = self.index.scan(company_key)
+        if "override" in found:
+            return self.override[found["override"]], f"override_contains:{found['override']}"
+        if company_key in self.legal:
+            return self.legal[company_key], "legal_directory"
+        if "variation" in found:
+            return self.variations[found["variation"]], f"variation:{found['variation']}"
+        return SUPPORT_EMAIL, "fallback"
+
+    def resolve(self, company_name):
+        """Retourne (email, règle) pour un nom d'entreprise brut"""
+        company_key = normalize_company_key(company_name)
+        hit = self._memo.get(company_key)
+        if hit is None:
+            hit = self._lookup(company_key)
+            if len(self._memo) >= COMPANY_RESOLVER_MEMO_MAX:
+                self._memo.clear()
+            self._memo[company_key] = hit
+        return hit
+
+COMPANY_EMAIL_RESOLVER = CompanyEmailResolver(COMPANY_EMAIL_OVERRIDE, LEGAL_DIRECTORY, COMPANY_EMAIL_VARIATIONS)
+
 # Mots-clés pour pré-filtrage rapide TRANSPORT
 TRAVEL_FAST_INCLUDE = [
     "sncf", "ouigo", "inoui", "tgv", "ter", "eurostar", "thalys", "trenitalia",
@@ -1473,85 +2720,645 @@ ECOM_FAST_EXCLUDE = [
     "vol ", "flight", "train", "billet", "embarquement", "gate", "boarding pass"
 ]
 
+# Sujets de spam évident (pré-filtre rapide)
+FAST_SPAM_SUBJECT_KEYWORDS = [
+    "newsletter", "unsubscribe", "désabonner", "promo", "soldes", "mot de passe", "password"
+]
+
 def fast_candidate_filter(scan_type: str, sender: str, subject: str, snippet: str) -> tuple:
     """
-    Pré-filtre rapide AVANT appel IA - retourne (bool, reason)
+    Pré-filtre rapide AVANT appel IA - retourne (bool, reason)
+    """
+    subject = subject or ""
+    sender = sender or ""
+    snippet = snippet or ""
+    blob = f"{sender} {subject} {snippet}"
+    hits = FILTER_KEYWORDS.scan(blob)
+
+    if "mise en demeure" in subject.lower():
+        return False, "Notre propre email"
+
+    if "success" in hits:
+        return False, "Déjà résolu (success keyword)"
+    if "refusal" in hits:
+        return False, "Refus détecté (refusal keyword)"
+
+    if "fast_spam_subject" in FILTER_KEYWORDS.scan(subject):
+        return False, "Spam évident"
+
+    if scan_type == "travel":
+        if "travel_fast_exclude" in hits:
+            return False, "Exclusion e-commerce"
+        if "travel_fast_include" not in hits:
+            return False, "Pas assez d'indices transport"
+        return True, "Candidat transport"
+
+    # scan_type == "ecommerce"
+    if "ecom_fast_exclude" in hits:
+        return False, "Exclusion transport"
+    if "ecom_fast_include" not in hits:
+        return False, "Pas assez d'indices e-commerce"
+    return True, "Candidat e-commerce"
+
+def get_gmail_headers(headers, name: str, default=""):
+    """Récupère un header Gmail par son nom"""
+    name = name.lower()
+    for h in headers or []:
+        if h.get("name", "").lower() == name:
+            return h.get("value", default)
+    return default
+
+# Taille max d'un lot Gmail Batch HTTP (Google recommande ≤ 50 requêtes par lot)
+GMAIL_BATCH_SIZE = int(os.environ.get("GMAIL_BATCH_SIZE", "50"))
+
+def gmail_batch_get(service, message_ids, fmt="metadata", metadata_headers=None, batch_size=None):
+    """
+    📦 Récupère des messages Gmail par lots (Batch HTTP) au lieu d'un aller-retour par message.
+
+    Générateur : produit (msg_id, msg_data) dans l'ordre des message_ids, lot par lot,
+    pour que la chaîne de filtres puisse consommer les résultats au fil de l'eau.
+    msg_data vaut None si le message n'a pas pu être récupéré.
+    """
+    batch_size = max(1, min(batch_size or GMAIL_BATCH_SIZE, 100))
+    ids = list(message_ids)
+
+    def _request(msg_id):
+        kwargs = {"userId": "me", "id": msg_id, "format": fmt}
+        if metadata_headers:
+            kwargs["metadataHeaders"] = metadata_headers
+        return service.users().messages().get(**kwargs)
+
+    for start in range(0, len(ids), batch_size):
+        chunk = ids[start:start + batch_size]
+        results = {}
+
+        def _callback(request_id, response, exception):
+            if exception is None:
+                results[int(request_id)] = response
+
+        try:
+            batch = service.new_batch_http_request(callback=_callback)
+            for i, msg_id in enumerate(chunk):
+                batch.add(_request(msg_id), request_id=str(i))
+            batch.execute()
+        except Exception as e:
+            _dbg(f"⚠️ gmail_batch_get: lot {start // batch_size} en échec ({type(e).__name__}), repli unitaire")
+
+        # Repli unitaire pour les messages en échec dans le lot (429, 5xx...)
+        for i, msg_id in enumerate(chunk):
+            if i not in results:
+                try:
+                    results[i] = _request(msg_id).execute()
+                except Exception as e:
+                    _dbg(f"⚠️ gmail_batch_get: {msg_id[:12]} introuvable ({type(e).__name__})")
+                    results[i] = None
+
+        for i, msg_id in enumerate(chunk):
+            yield msg_id, results[i]
+
+def gmail_list_added_since(service, start_history_id, max_results=150):
+    """
+    🔄 Liste les messages ajoutés à INBOX depuis un checkpoint Gmail (users.history.list).
+
+    Retourne (message_ids, truncated) - les plus récents d'abord, comme messages.list.
+    Retourne (None, False) si le checkpoint a expiré (HTTP 404) → rescan complet requis.
+    """
+    added = []
+    seen = set()
+    page_token = None
+    try:
+        while True:
+            kwargs = {"userId": "me", "startHistoryId": start_history_id,
+                      "historyTypes": ["messageAdded"], "labelId": "INBOX"}
+            if page_token:
+                kwargs["pageToken"] = page_token
+            resp = service.users().history().list(**kwargs).execute()
+            for record in resp.get("history", []):
+                for added_msg in record.get("messagesAdded", []):
+                    m = added_msg.get("message", {})
+                    labels = m.get("labelIds", [])
+                    # Même exclusions que la query complète (promotions / réseaux sociaux)
+                    if "CATEGORY_PROMOTIONS" in labels or "CATEGORY_SOCIAL" in labels:
+                        continue
+                    if m.get("id") and m["id"] not in seen:
+                        seen.add(m["id"])
+                        added.append(m["id"])
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        if getattr(e, "resp", None) is not None and e.resp.status == 404:
+            _dbg(f"🔄 Checkpoint Gmail {start_history_id} expiré → rescan complet")
+            return None, False
+        raise
+
+    added.reverse()
+    return added[:max_results], len(added) > max_results
+
+# Taille des tranches base64 décodées à la fois (multiple de 4)
+BODY_DECODE_CHUNK = 16384
+
+class StreamingTextStripper:
+    """
+    ✂️ Nettoyeur de texte en flux : retire les balises <...> et compacte les espaces
+    en UNE passe de tokens, et s'arrête dès que le budget de caractères est atteint.
+    Même résultat que re.sub(r"<[^>]+>", " ") + re.sub(r"\\s+", " ") + strip + [:limit].
+
+    Balise jamais fermée suivie de texte espacé (régression : le tampon était coupé trop tôt) :
+    >>> stripper = StreamingTextStripper(4000)
+    >>> stripper.feed("Bonjour <" + "mot      " * 2000)
+    False
+    >>> len(stripper.result())
+    4000
+    """
+
+    TOKEN = re.compile(r"[^<>\s]+|\s+|<|>")
+
+    def __init__(self, limit_chars: int):
+        self.limit = limit_chars
+        self.out = []
+        self.size = 0
+        self.space = False      # espace en attente (jamais en tête de texte)
+        self.in_tag = False
+        self.tag = []           # contenu de la balise ouverte (rejoué si jamais fermée)
+        self.tag_len = 0        # taille une fois rejoué (un bloc d'espaces compte pour 1)
+
+    def _emit(self, tok: str):
+        if tok[0].isspace():
+            self.space = self.size > 0
+            return
+        if self.space:
+            self.out.append(" ")
+            self.size += 1
+            self.space = False
+        self.out.append(tok)
+        self.size += len(tok)
+
+    def feed(self, text: str) -> bool:
+        """Ajoute un morceau de texte. Retourne True quand le budget est atteint."""
+        for m in self.TOKEN.finditer(text):
+            tok = m.group()
+            if self.in_tag:
+                if tok == ">" and self.tag:
+                    self.in_tag = False
+                    self.tag = []
+                    self.tag_len = 0
+                    self._emit(" ")
+                elif tok == ">":
+                    # "<>" n'est pas une balise → texte brut
+                    self.in_tag = False
+                    self._emit("<")
+                    self._emit(">")
+                elif self.tag_len <= self.limit:
+                    if not tok[0].isspace():
+                        self.tag_len += len(tok)
+                    elif not (self.tag and self.tag[-1][0].isspace()):
+                        self.tag_len += 1  # Même coupé entre deux morceaux, un bloc d'espaces compte pour 1
+                    self.tag.append(tok)
+                continue
+            if tok == "<":
+                self.in_tag = True
+                self.tag_len = 1
+                continue
+            self._emit(tok)
+            if self.size >= self.limit:
+                return True
+        return False
+
+    def result(self) -> str:
+        if self.in_tag:
+            # Balise jamais fermée → le regex d'origine la laissait telle quelle
+            self.in_tag = False
+            for tok in ["<"] + self.tag:
+                self._emit(tok)
+        return "".join(self.out)[:self.limit]
+
+def _iter_body_parts(payload):
+    """Feuilles text/plain et text/html du payload Gmail, dans l'ordre du document"""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if not part:
+            continue
+        if "parts" in part:
+            stack.extend(reversed(part["parts"]))
+            continue
+        if part.get("mimeType") in ("text/plain", "text/html"):
+            data = (part.get("body", {}) or {}).get("data", "")
+            if data:
+                yield part["mimeType"], data
+
+def safe_extract_body_text(msg_data, limit_chars=4000) -> str:
+    """
+    Extrait le texte du body de manière sécurisée.
+    Préfère text/plain (HTML seulement s'il n'y a pas de texte brut), décode le
+    base64 par tranches en UTF-8 incrémental et s'arrête dès limit_chars atteint.
+    """
+    try:
+        parts = list(_iter_body_parts(msg_data.get("payload", {}) or {}))
+        if not parts:
+            return (msg_data.get("snippet") or "")[:limit_chars]
+
+        plain = [data for mt, data in parts if mt == "text/plain"]
+        selected = plain or [data for mt, data in parts]
+
+        stripper = StreamingTextStripper(limit_chars)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        decoded_any = False
+        for data in selected:
+            for i in range(0, len(data), BODY_DECODE_CHUNK):
+                chunk = data[i:i + BODY_DECODE_CHUNK]
+                chunk += "=" * (-len(chunk) % 4)
+                text = decoder.decode(base64.urlsafe_b64decode(chunk))
+                decoded_any = decoded_any or bool(text)
+                if stripper.feed(text):
+                    return stripper.result()
+            tail = decoder.decode(b"", final=True)
+            decoder.reset()
+            if tail:
+                decoded_any = True
+                if stripper.feed(tail):
+                    return stripper.result()
+
+        if not decoded_any:
+            return (msg_data.get("snippet") or "")[:limit_chars]
+        return stripper.result()
+    except Exception as e:
+        _dbg(f"⚠️ safe_extract_body_text error: {type(e).__name__}: {str(e)[:60]}")
+        return (msg_data.get("snippet") or "")[:limit_chars]
+
+# ========================================
+# 🕵️ AGENT DÉTECTIVE - Scraping Email Marchand
+# ========================================
+
+# ════════════════════════════════════════════════════════════════
+# 🗄️ CACHE DU DÉTECTIVE (par nom d'hôte)
+# ════════════════════════════════════════════════════════════════
+# Un crawl coûte 10-60 s : le résultat est partagé par tous les litiges déclarés
+# sur le même site. Négatif mis en cache UNIQUEMENT si le crawl est allé au bout
+# (pas de timeout / blocage anti-bot / deadline). Mémo local en plus de la table → lecture
+# instantanée dans le worker ; le mémo expire vite pour propager les invalidations.
+
+MERCHANT_CACHE_TTL_DAYS = int(os.environ.get("MERCHANT_CACHE_TTL_DAYS", "30"))
+MERCHANT_CACHE_NEGATIVE_TTL_HOURS = int(os.environ.get("MERCHANT_CACHE_NEGATIVE_TTL_HOURS", "24"))
+MERCHANT_CACHE_MEMO_SECONDS = int(os.environ.get("MERCHANT_CACHE_MEMO_SECONDS", "300"))
+MERCHANT_CACHE_STATS = {"memo_hits": 0, "db_hits": 0, "misses": 0, "negative_hits": 0, "errors": 0}
+_MERCHANT_CACHE_MEMO = {}  # domaine → (expire_at, résultat)
+
+def merchant_domain_key(url: str):
+    """
+    'https://www.Asphalte.com/contact' → 'asphalte.com' (None si URL inexploitable).
+    Nom d'hôte complet (hors 'www.') : sur un hébergeur partagé, xxx.myshopify.com et
+    yyy.myshopify.com sont deux boutiques différentes et ne doivent pas partager d'email.
+    """
+    if not url:
+        return None
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    try:
+        host = (urlparse(url).hostname or "").lower().rstrip(".")
+    except ValueError:
+        return None
+    if host.startswith("www."):
+        host = host[4:]
+    if not host or "." not in host:
+        return None
+    return host
+
+def merchant_cache_get(domain):
+    """Résultat en cache (dict find_merchant_email) ou None - expiré = absent"""
+    from datetime import timedelta
+    memo = _MERCHANT_CACHE_MEMO.get(domain)
+    if memo and memo[0] > datetime.utcnow():
+        MERCHANT_CACHE_STATS["memo_hits"] += 1
+        return memo[1]
+    try:
+        entry = MerchantEmailCache.query.get(domain)
+        if entry:
+            ttl = timedelta(days=MERCHANT_CACHE_TTL_DAYS) if entry.email else timedelta(hours=MERCHANT_CACHE_NEGATIVE_TTL_HOURS)
+            if datetime.utcnow() - entry.crawled_at <= ttl:
+                entry.hits = (entry.hits or 0) + 1
+                db.session.commit()
+                result = {
+                    "email": entry.email,
+                    "source": entry.source,
+                    "all_emails": json.loads(entry.candidates_json or "[]"),
+                    "cached_at": entry.crawled_at.isoformat(),
+                }
+                MERCHANT_CACHE_STATS["db_hits"] += 1
+                if not entry.email:
+                    MERCHANT_CACHE_STATS["negative_hits"] += 1
+                _MERCHANT_CACHE_MEMO[domain] = (datetime.utcnow() + timedelta(seconds=MERCHANT_CACHE_MEMO_SECONDS), result)
+                return result
+    except Exception as e:
+        db.session.rollback()
+        MERCHANT_CACHE_STATS["errors"] += 1
+        _dbg(f"⚠️ Cache détective lecture: {type(e).__name__}: {str(e)[:60]}")
+    MERCHANT_CACHE_STATS["misses"] += 1
+    return None
+
+def merchant_cache_set(domain, result):
+    """Enregistre le résultat d'un crawl (positif ou négatif)"""
+    try:
+        entry = MerchantEmailCache.query.get(domain)
+        if entry is None:
+            entry = MerchantEmailCache(domain=domain)
+            db.session.add(entry)
+        entry.email = result.get("email")
+        entry.source = (result.get("source") or "")[:300]
+        entry.candidates_json = json.dumps(result.get("all_emails") or [], ensure_ascii=False)
+        entry.crawled_at = datetime.utcnow()
+        entry.hits = 0
+        db.session.commit()
+        _MERCHANT_CACHE_MEMO.pop(domain, None)
+    except Exception as e:
+        db.session.rollback()
+        MERCHANT_CACHE_STATS["errors"] += 1
+        _dbg(f"⚠️ Cache détective écriture: {type(e).__name__}: {str(e)[:60]}")
+
+def merchant_cache_invalidate(domain=None) -> int:
+    """Invalide un domaine (ou tout le cache si domain=None). Retourne le nb de lignes supprimées."""
+    if domain:
+        _MERCHANT_CACHE_MEMO.pop(domain, None)
+        deleted = MerchantEmailCache.query.filter_by(domain=domain).delete(synchronize_session=False)
+    else:
+        _MERCHANT_CACHE_MEMO.clear()
+        deleted = MerchantEmailCache.query.delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def find_merchant_email(url, use_cache=True):
+    """
+    🕵️ Email de contact d'un site marchand, via le cache par domaine.
+    Crawl complet (_crawl_merchant_email) seulement en cas d'absence ou d'expiration.
+    use_cache=False force un nouveau crawl (et rafraîchit le cache).
+    """
+    domain = merchant_domain_key(url)
+    if domain and use_cache:
+        cached = merchant_cache_get(domain)
+        if cached is not None:
+            DEBUG_LOGS.append(f"🗄️ Détective (cache) {domain} → {cached.get('email') or 'aucun email'}")
+            return dict(cached)
+    
+    result = _crawl_merchant_email(url)
+    # Échec non concluant (site injoignable, 403, deadline...) → pas de négatif en cache
+    if domain and (result.get("email") or result.get("complete")):
+        merchant_cache_set(domain, result)
+    return result
+
+# Crawl concurrent : pages contact / chemins CMS téléchargés en parallèle
+DETECTIVE_FETCH_WORKERS = int(os.environ.get("DETECTIVE_FETCH_WORKERS", "8"))
+# Durée max d'un run du Détective, toutes étapes confondues
+DETECTIVE_DEADLINE_SECONDS = int(os.environ.get("DETECTIVE_DEADLINE_SECONDS", "40"))
+# Score à partir duquel on arrête de chercher (ex: contact@ du domaine en mailto)
+DETECTIVE_STOP_SCORE = int(os.environ.get("DETECTIVE_STOP_SCORE", "150"))
+
+# ════════════════════════════════════════════════════════════════
+# 🧵 DÉTECTIVE EN ARRIÈRE-PLAN (le formulaire n'attend plus les sites tiers)
+# ════════════════════════════════════════════════════════════════
+# Le dossier passe en detective_status='pending' ; le worker écrit merchant_email /
+# merchant_email_source puis lance l'Agent Avocat comme le faisait le flux synchrone.
+
+DETECTIVE_JOB_WORKERS = int(os.environ.get("DETECTIVE_JOB_WORKERS", "2"))
+DETECTIVE_EXECUTOR = ThreadPoolExecutor(max_workers=DETECTIVE_JOB_WORKERS, thread_name_prefix="detective-job")
+# Au-delà, un 'pending' est considéré comme perdu (redémarrage du worker)
+DETECTIVE_PENDING_MINUTES = int(os.environ.get("DETECTIVE_PENDING_MINUTES", "10"))
+
+def is_detective_pending(case) -> bool:
+    """
+    True si la recherche d'email marchand du dossier est encore en cours.
+    Mesuré depuis detective_started_at (une modification du dossier ne relance pas le délai).
     """
-    subject = subject or ""
-    sender = sender or ""
-    snippet = snippet or ""
-    blob = f"{sender} {subject} {snippet}".lower()
+    from datetime import timedelta
+    if getattr(case, "detective_status", None) != "pending" or case.merchant_email:
+        return False
+    started = getattr(case, "detective_started_at", None)
+    return bool(started) and datetime.utcnow() - started < timedelta(minutes=DETECTIVE_PENDING_MINUTES)
 
-    if "mise en demeure" in subject.lower():
-        return False, "Notre propre email"
+def expire_stale_detective_jobs(user_email):
+    """
+    'pending' expirés (job perdu au redémarrage) → 'error' : le dossier repasse en
+    saisie manuelle de l'email. UPDATE conditionnel → un job qui termine enfin garde son résultat.
+    """
+    from datetime import timedelta
+    try:
+        expired_before = datetime.utcnow() - timedelta(minutes=DETECTIVE_PENDING_MINUTES)
+        expired = Litigation.query.filter(
+            Litigation.user_email == user_email,
+            Litigation.detective_status == "pending",
+            db.or_(Litigation.detective_started_at.is_(None), Litigation.detective_started_at < expired_before)
+        ).update({"detective_status": "error"}, synchronize_session=False)
+        db.session.commit()
+        if expired:
+            DEBUG_LOGS.append(f"🕵️ {expired} recherche(s) Détective expirée(s) pour {user_email}")
+    except Exception as e:
+        db.session.rollback()
+        _dbg(f"⚠️ Expiration Détective impossible: {str(e)[:60]}")
+
+DETECTIVE_PENDING_HTML = """
+<div style='background:linear-gradient(135deg, #e0e7ff 0%, #c7d2fe 100%); 
+            padding:15px; border-radius:10px; margin-bottom:15px;
+            border-left:4px solid #6366f1;'>
+    <p style='margin:0; color:#3730a3; font-size:0.9rem;'>
+        <b>🕵️ Agent Détective :</b> Recherche de l'email du marchand en cours…<br>
+        <span style='font-size:0.85rem;'>Suivez l'avancement depuis votre tableau de bord.</span>
+    </p>
+</div>
+"""
 
-    if contains_any(blob, KEYWORDS_SUCCESS):
-        return False, "Déjà résolu (success keyword)"
-    if contains_any(blob, KEYWORDS_REFUSAL):
-        return False, "Refus détecté (refusal keyword)"
+def start_detective_job(litigation_id, url_site, notif_title):
+    """Marque le dossier 'pending' et lance le Détective dans DETECTIVE_EXECUTOR"""
+    case = Litigation.query.get(litigation_id)
+    if not case:
+        return
+    case.detective_status = "pending"
+    case.detective_started_at = datetime.utcnow()
+    db.session.commit()
+    DETECTIVE_EXECUTOR.submit(call_in_app_context, _run_detective_job, litigation_id, url_site, notif_title)
 
-    if contains_any(subject, ["newsletter", "unsubscribe", "désabonner", "promo", "soldes", "mot de passe", "password"]):
-        return False, "Spam évident"
+def _run_detective_job(litigation_id, url_site, notif_title):
+    """Worker : Détective → sauvegarde de l'email → Agent Avocat → notification"""
+    try:
+        DEBUG_LOGS.append(f"🕵️ Job #{litigation_id}: Lancement Agent Détective pour {url_site}")
+        result = find_merchant_email(url_site)
+        
+        case = Litigation.query.get(litigation_id)
+        if not case:
+            return
+        
+        # Email saisi à la main pendant la recherche → on ne l'écrase pas
+        if case.merchant_email:
+            case.detective_status = "found"
+            db.session.commit()
+            return
+        
+        if not result.get("email"):
+            case.detective_status = "not_found"
+            db.session.commit()
+            DEBUG_LOGS.append(f"🕵️ Job #{litigation_id}: ❌ Aucun email trouvé")
+            send_telegram_notif(f"{notif_title}\n\n🏪 {(case.company or '').upper()}\n👤 {case.user_email}\n\n🕵️ Email non trouvé (recherche manuelle requise)")
+            return
+        
+        case.merchant_email = result["email"]
+        case.merchant_email_source = result.get("source") or "Scraping web"
+        case.detective_status = "found"
+        db.session.commit()
+        DEBUG_LOGS.append(f"🕵️ Job #{litigation_id}: ✅ Email trouvé: {case.merchant_email}")
+        
+        # ⚖️ AGENT AVOCAT (même enchaînement que le flux synchrone)
+        detective_notif = f"\n\n🕵️ EMAIL TROUVÉ: {case.merchant_email}"
+        user = User.query.filter_by(email=case.user_email).first()
+        if user and user.refresh_token:
+            legal_notice_result = send_legal_notice(case, user)
+            if legal_notice_result["success"]:
+                DEBUG_LOGS.append(f"⚖️ Job #{litigation_id}: ✅ Mise en demeure envoyée!")
+                detective_notif += "\n⚖️ MISE EN DEMEURE ENVOYÉE ✅"
+            else:
+                DEBUG_LOGS.append(f"⚖️ Job #{litigation_id}: ❌ {legal_notice_result['message']}")
+                detective_notif += f"\n⚖️ Envoi différé: {legal_notice_result['message']}"
+        else:
+            detective_notif += "\n⚖️ Envoi différé: utilisateur non authentifié"
+        
+        send_telegram_notif(f"{notif_title}\n\n🏪 {(case.company or '').upper()}\n👤 {case.user_email}{detective_notif}")
+    
+    except Exception as e:
+        DEBUG_LOGS.append(f"🕵️ Job #{litigation_id}: ❌ {type(e).__name__}: {str(e)[:80]}")
+        db.session.rollback()
+        case = Litigation.query.get(litigation_id)
+        if case and case.detective_status == "pending":
+            case.detective_status = "error"
+            db.session.commit()
 
-    if scan_type == "travel":
-        if contains_any(blob, TRAVEL_FAST_EXCLUDE):
-            return False, "Exclusion e-commerce"
-        if not contains_any(blob, TRAVEL_FAST_INCLUDE):
-            return False, "Pas assez d'indices transport"
-        return True, "Candidat transport"
+# ════════════════════════════════════════════════════════════════
+# 🧾 EXTRACTION EN UNE PASSE (mailto + texte + liens contact)
+# ════════════════════════════════════════════════════════════════
+# Un seul passage du tokenizer html.parser par page, sans arbre BeautifulSoup :
+# le texte visible sert au regex d'emails, les <a> donnent mailto et liens contact.
 
-    # scan_type == "ecommerce"
-    if contains_any(blob, ECOM_FAST_EXCLUDE):
-        return False, "Exclusion transport"
-    if not contains_any(blob, ECOM_FAST_INCLUDE):
-        return False, "Pas assez d'indices e-commerce"
-    return True, "Candidat e-commerce"
+def decode_cloudflare_email(hex_string):
+    """Décode un email protégé par Cloudflare (data-cfemail / #hex) → str ou None"""
+    try:
+        data = bytes.fromhex(hex_string.strip())
+        if len(data) < 2:
+            return None
+        key = data[0]
+        email = bytes(b ^ key for b in data[1:]).decode("utf-8")
+        return email if "@" in email else None
+    except (ValueError, UnicodeDecodeError):
+        return None
 
-def get_gmail_headers(headers, name: str, default=""):
-    """Récupère un header Gmail par son nom"""
-    name = name.lower()
-    for h in headers or []:
-        if h.get("name", "").lower() == name:
-            return h.get("value", default)
-    return default
+class PageEmailExtractor(HTMLParser):
+    """
+    Parcourt une page HTML en flux et collecte en même temps :
+      - mailto : emails des liens mailto: et emails Cloudflare décodés
+      - text   : texte visible (+ scripts et valeurs d'attributs contenant '@',
+                 ex. JSON-LD, <input value=…>, data-email, <meta content=…>)
+      - links  : [(score, href)] des liens dont l'URL ou le texte contient un mot-clé
+    Le score d'un lien dépend du rang du premier mot-clé trouvé (liste par priorité).
+    """
 
-def safe_extract_body_text(msg_data, limit_chars=4000) -> str:
-    """Extrait le texte du body de manière sécurisée"""
-    try:
-        payload = msg_data.get("payload", {}) or {}
-
-        def walk(part):
-            text = ""
-            if not part:
-                return text
-            if "parts" in part:
-                for sp in part["parts"]:
-                    text += walk(sp)
-                return text
-            mt = part.get("mimeType")
-            if mt in ("text/plain", "text/html"):
-                data = (part.get("body", {}) or {}).get("data", "")
-                if data:
-                    decoded = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                    return decoded
-            return ""
+    SKIP_TAGS = {"style", "noscript", "svg"}
+    CF_PROTECTION_PATH = "/cdn-cgi/l/email-protection#"
+
+    def __init__(self, link_keywords):
+        super().__init__(convert_charrefs=True)
+        self.link_keywords = link_keywords
+        self.mailto = []
+        self.links = []
+        self._text = []
+        self._skip_depth = 0
+        self._in_script = False
+        self._href = None       # href du <a> ouvert
+        self._anchor_text = []
+
+    def handle_starttag(self, tag, attrs):
+        # Emails présents uniquement dans un attribut (value, data-email, content...)
+        self._text.extend(value for _, value in attrs if value and "@" in value)
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+            return
+        if tag == "script":
+            self._in_script = True
+            return
+        attrs = dict(attrs)
+        cf_hex = attrs.get("data-cfemail")
+        if cf_hex:
+            email = decode_cloudflare_email(cf_hex)
+            if email:
+                self.mailto.append(email)
+        if tag == "a":
+            self._close_anchor()
+            href = (attrs.get("href") or "").strip()
+            if not href:
+                return
+            href_lower = href.lower()
+            if href_lower.startswith("mailto:"):
+                email = href[7:].split("?")[0].strip()
+                if email:
+                    self.mailto.append(email)
+                return
+            if self.CF_PROTECTION_PATH in href_lower:
+                email = decode_cloudflare_email(href.split("#", 1)[1])
+                if email:
+                    self.mailto.append(email)
+                return
+            if href_lower.startswith(("javascript:", "#", "tel:")):
+                return
+            self._href = href
+            self._anchor_text = []
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag == "script":
+            self._in_script = False
+        elif tag == "a":
+            self._close_anchor()
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+        if self._in_script:
+            if "@" in data:
+                self._text.append(data)
+            return
+        self._text.append(data)
+        if self._href is not None:
+            self._anchor_text.append(data)
+
+    def _close_anchor(self):
+        if self._href is None:
+            return
+        href_lower = self._href.lower()
+        text_lower = "".join(self._anchor_text).lower().strip()
+        for rank, keyword in enumerate(self.link_keywords):
+            if keyword in href_lower or keyword in text_lower:
+                self.links.append((len(self.link_keywords) - rank, self._href))
+                break
+        self._href = None
+        self._anchor_text = []
 
-        body_raw = walk(payload)
-        if not body_raw:
-            return (msg_data.get("snippet") or "")[:limit_chars]
+    def close(self):
+        super().close()
+        self._close_anchor()
 
-        body_clean = re.sub(r"<[^>]+>", " ", body_raw)
-        body_clean = re.sub(r"\s+", " ", body_clean).strip()
-        return body_clean[:limit_chars]
-    except Exception as e:
-        _dbg(f"⚠️ safe_extract_body_text error: {type(e).__name__}: {str(e)[:60]}")
-        return (msg_data.get("snippet") or "")[:limit_chars]
+    @property
+    def text(self) -> str:
+        return " ".join(self._text)
 
-# ========================================
-# 🕵️ AGENT DÉTECTIVE - Scraping Email Marchand
-# ========================================
+    @classmethod
+    def parse(cls, html, link_keywords):
+        """Parse une page complète ; une page mal formée rend ce qui a pu être lu"""
+        parser = cls(link_keywords)
+        try:
+            parser.feed(html)
+            parser.close()
+        except Exception:
+            parser._close_anchor()
+        return parser
 
-def find_merchant_email(url):
+def _crawl_merchant_email(url):
     """
     🕵️ AGENT DÉTECTIVE V3 - Trouve l'email de contact d'un site marchand
     
@@ -1561,7 +3368,9 @@ def find_merchant_email(url):
     3. FALLBACK 2 : Recherche DuckDuckGo/Bing
     4. Priorise les emails "contact", "support", "sav"
     
-    Retourne : {"email": str|None, "source": str, "all_emails": list}
+    Retourne : {"email": str|None, "source": str, "all_emails": list, "complete": bool}
+    complete=False si un incident (timeout, 403/429/5xx, deadline, exception) a pu
+    masquer un email : un résultat négatif n'est alors pas concluant.
     """
     
     # ═══════════════════════════════════════════════════════════════
@@ -1618,6 +3427,15 @@ def find_merchant_email(url):
     # Timeout
     TIMEOUT = 8
     
+    # Deadline globale du run (toutes les requêtes HTTP la respectent)
+    deadline = time.monotonic() + DETECTIVE_DEADLINE_SECONDS
+    
+    def time_left():
+        return deadline - time.monotonic()
+    
+    # Incidents réseau du run (404 = réponse normale, pas un incident)
+    incidents = []
+    
     # ═══════════════════════════════════════════════════════════════
     # BLACKLIST DOMAINES - Emails à rejeter systématiquement
     # ═══════════════════════════════════════════════════════════════
@@ -1818,15 +3636,22 @@ def find_merchant_email(url):
     
     # Regex pour extraire les emails (standard)
     EMAIL_REGEX = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+    EMAIL_RE = re.compile(EMAIL_REGEX, re.IGNORECASE)
     
     # Regex pour emails obfusqués (contact [at] domain [dot] com)
     EMAIL_OBFUSCATED_PATTERNS = [
-        r'([a-zA-Z0-9._%+-]+)\s*\[\s*at\s*\]\s*([a-zA-Z0-9.-]+)\s*\[\s*dot\s*\]\s*([a-zA-Z]{2,})',
-        r'([a-zA-Z0-9._%+-]+)\s*\(\s*at\s*\)\s*([a-zA-Z0-9.-]+)\s*\(\s*dot\s*\)\s*([a-zA-Z]{2,})',
-        r'([a-zA-Z0-9._%+-]+)\s*\[at\]\s*([a-zA-Z0-9.-]+)\s*\[dot\]\s*([a-zA-Z]{2,})',
-        r'([a-zA-Z0-9._%+-]+)\s*arobase\s*([a-zA-Z0-9.-]+)\s*point\s*([a-zA-Z]{2,})',
+        re.compile(r'([a-zA-Z0-9._%+-]+)\s*\[\s*at\s*\]\s*([a-zA-Z0-9.-]+)\s*\[\s*dot\s*\]\s*([a-zA-Z]{2,})', re.IGNORECASE),
+        re.compile(r'([a-zA-Z0-9._%+-]+)\s*\(\s*at\s*\)\s*([a-zA-Z0-9.-]+)\s*\(\s*dot\s*\)\s*([a-zA-Z]{2,})', re.IGNORECASE),
+        re.compile(r'([a-zA-Z0-9._%+-]+)\s*arobase\s*([a-zA-Z0-9.-]+)\s*point\s*([a-zA-Z]{2,})', re.IGNORECASE),
     ]
     
+    # "contact at domain.com", "contact [at] domain.com", "contact(at)domain.com"
+    # "at" / "chez" nus entourés d'espaces : sinon "Chateau-Lafite.fr" → "Ch@eau-Lafite.fr"
+    EMAIL_AT_WORD_RE = re.compile(
+        r'([a-zA-Z0-9._%+-]+)(?:\s*\(\s*at\s*\)\s*|\s*\[\s*at\s*\]\s*|\s+(?:at|chez)\s+|\s*@\s*)([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})',
+        re.IGNORECASE
+    )
+    
     # Emails à ignorer (parasites)
     BLACKLIST_PATTERNS = [
         'example.com', 'domain.com', 'email.com', 'test.com', 'exemple.com',
@@ -1932,43 +3757,35 @@ def find_merchant_email(url):
         
         return True
     
-    def extract_mailto_emails(soup):
-        """Extrait les emails des balises mailto:"""
-        emails = []
-        for a_tag in soup.find_all('a', href=True):
-            href = a_tag.get('href', '')
-            if href.lower().startswith('mailto:'):
-                email = href[7:].split('?')[0].strip()
-                if email and is_valid_email(email):
-                    emails.append(email)
-        return emails
+    def parse_page(page_content):
+        """Une passe html.parser → mailto / texte visible / liens contact"""
+        return PageEmailExtractor.parse(page_content, CONTACT_KEYWORDS)
+    
+    def extract_mailto_emails(parsed):
+        """Emails des balises mailto: (et emails Cloudflare décodés) d'une page parsée"""
+        return [email for email in dict.fromkeys(parsed.mailto) if is_valid_email(email)]
     
     def extract_emails_from_text(text):
         """Extrait tous les emails valides d'un texte (y compris obfusqués)"""
         emails = []
         
         # 1. Emails standards
-        found = re.findall(EMAIL_REGEX, text, re.IGNORECASE)
+        found = EMAIL_RE.findall(text)
         emails.extend([e for e in found if is_valid_email(e)])
         
         # 2. Emails obfusqués ([at], [dot], arobase, etc.)
         for pattern in EMAIL_OBFUSCATED_PATTERNS:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            for match in matches:
-                if len(match) == 3:
-                    reconstructed = f"{match[0]}@{match[1]}.{match[2]}"
-                    if is_valid_email(reconstructed):
-                        emails.append(reconstructed)
-        
-        # 3. Pattern spécial : "contact at domain.com" ou "contact(at)domain.com"
-        special_pattern = r'([a-zA-Z0-9._%+-]+)\s*(?:\(at\)|at|@|chez)\s*([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})'
-        special_matches = re.findall(special_pattern, text, re.IGNORECASE)
-        for match in special_matches:
-            if len(match) == 2:
-                reconstructed = f"{match[0]}@{match[1]}"
-                if is_valid_email(reconstructed) and reconstructed not in emails:
+            for match in pattern.findall(text):
+                reconstructed = f"{match[0]}@{match[1]}.{match[2]}"
+                if is_valid_email(reconstructed):
                     emails.append(reconstructed)
         
+        # 3. Pattern spécial : "contact at domain.com", "contact [at] domain.com"
+        for match in EMAIL_AT_WORD_RE.findall(text):
+            reconstructed = f"{match[0]}@{match[1]}"
+            if is_valid_email(reconstructed):
+                emails.append(reconstructed)
+        
         return list(set(emails))  # Dédupliquer
     
     def score_email(email, site_domain=None):
@@ -1997,10 +3814,14 @@ def find_merchant_email(url):
     
     def get_page_content(page_url, timeout=TIMEOUT):
         """Récupère le contenu d'une page avec gestion des erreurs et logs détaillés"""
+        if time_left() <= 0:
+            incidents.append("deadline")
+            return None
+        timeout = max(1, min(timeout, time_left()))
         debug_log(f"Tentative accès : {page_url}", "HTTP")
         
         try:
-            response = requests.get(
+            response = get_http_session("detective").get(
                 page_url, 
                 headers=HEADERS, 
                 timeout=timeout, 
@@ -2014,7 +3835,9 @@ def find_merchant_email(url):
             if status == 200:
                 debug_log(f"Status: {status} OK | Contenu: {content_length} chars", "SUCCESS")
                 return response.text
-            elif status == 403:
+            if status in (403, 429) or status >= 500:
+                incidents.append(f"http_{status}")
+            if status == 403:
                 debug_log(f"Status: {status} BLOQUÉ (Forbidden) - Anti-bot actif?", "WARNING")
             elif status == 404:
                 debug_log(f"Status: {status} Page non trouvée", "WARNING")
@@ -2026,12 +3849,13 @@ def find_merchant_email(url):
             return None
             
         except requests.exceptions.Timeout:
+            incidents.append("timeout")
             debug_log(f"TIMEOUT après {timeout}s : {page_url[:50]}...", "ERROR")
             return None
         except requests.exceptions.SSLError as e:
             debug_log(f"Erreur SSL : {str(e)[:50]} - Retry sans SSL...", "WARNING")
             try:
-                response = requests.get(page_url, headers=HEADERS, timeout=timeout, verify=False)
+                response = get_http_session("detective").get(page_url, headers=HEADERS, timeout=timeout, verify=False)
                 if response.status_code == 200:
                     debug_log(f"Retry SSL OK | Contenu: {len(response.text)} chars", "SUCCESS")
                     return response.text
@@ -2039,32 +3863,26 @@ def find_merchant_email(url):
                     debug_log(f"Retry SSL échoué : Status {response.status_code}", "ERROR")
             except Exception as e2:
                 debug_log(f"Retry SSL exception : {str(e2)[:50]}", "ERROR")
+            incidents.append("ssl")
             return None
         except requests.exceptions.ConnectionError as e:
+            incidents.append("connection")
             debug_log(f"Erreur connexion : {str(e)[:50]}", "ERROR")
             return None
         except Exception as e:
+            incidents.append(type(e).__name__)
             debug_log(f"Exception inattendue : {type(e).__name__} - {str(e)[:50]}", "ERROR")
             return None
     
-    def find_contact_links(soup, base_url):
-        """Trouve les liens vers les pages de contact"""
-        links = set()
+    def find_contact_links(parsed, base_url):
+        """Liens vers les pages de contact du même domaine, les plus pertinents d'abord"""
+        links = {}
         base_domain = urlparse(base_url).netloc
         
-        for a_tag in soup.find_all('a', href=True):
-            href = a_tag.get('href', '').lower()
-            text = a_tag.get_text().lower().strip()
-            
-            if not href or href.startswith(('javascript:', '#', 'tel:', 'mailto:')):
-                continue
-            
-            for keyword in CONTACT_KEYWORDS:
-                if keyword in href or keyword in text:
-                    full_url = urljoin(base_url, a_tag['href'])
-                    if urlparse(full_url).netloc == base_domain:
-                        links.add(full_url)
-                    break
+        for score, href in sorted(parsed.links, key=lambda link: -link[0]):
+            full_url = urljoin(base_url, href)
+            if full_url not in links and urlparse(full_url).netloc == base_domain:
+                links[full_url] = score
         
         return list(links)[:20]
     
@@ -2098,7 +3916,7 @@ def find_merchant_email(url):
                 'Referer': 'https://duckduckgo.com/',
             }
             
-            response = requests.get(search_url, headers=search_headers, timeout=10)
+            response = get_http_session("detective").get(search_url, headers=search_headers, timeout=max(1, min(10, time_left())))
             debug_log(f"🦆 DuckDuckGo Status: {response.status_code} | Taille: {len(response.text)} chars", "HTTP")
             
             if response.status_code == 200:
@@ -2131,15 +3949,17 @@ def find_merchant_email(url):
                 debug_log(f"🦆 DuckDuckGo: {len(snippets)} snippets extraits", "SUCCESS" if snippets else "WARNING")
                 
                 # Log des emails trouvés dans les résultats
-                found_emails = re.findall(EMAIL_REGEX, result_text, re.IGNORECASE)
+                found_emails = EMAIL_RE.findall(result_text)
                 if found_emails:
                     debug_log(f"🦆 Emails trouvés dans résultats DDG: {found_emails[:3]}", "SUCCESS")
                 
                 return result_text
             else:
+                incidents.append(f"ddg_{response.status_code}")
                 debug_log(f"🦆 DuckDuckGo échec: Status {response.status_code}", "ERROR")
             
         except Exception as e:
+            incidents.append("ddg_error")
             debug_log(f"🦆 DuckDuckGo Exception: {type(e).__name__} - {str(e)[:50]}", "ERROR")
         
         return ""
@@ -2160,22 +3980,83 @@ def find_merchant_email(url):
                 'Referer': 'https://www.bing.com/',
             }
             
-            response = requests.get(search_url, headers=bing_headers, timeout=10)
+            response = get_http_session("detective").get(search_url, headers=bing_headers, timeout=max(1, min(10, time_left())))
             debug_log(f"🔍 Bing Status: {response.status_code} | Taille: {len(response.text)} chars", "HTTP")
             
             if response.status_code == 200:
                 # Log des emails trouvés
-                found_emails = re.findall(EMAIL_REGEX, response.text, re.IGNORECASE)
+                found_emails = EMAIL_RE.findall(response.text)
                 if found_emails:
                     debug_log(f"🔍 Emails trouvés dans Bing: {found_emails[:3]}", "SUCCESS")
                 return response.text
             else:
+                incidents.append(f"bing_{response.status_code}")
                 debug_log(f"🔍 Bing échec: Status {response.status_code}", "ERROR")
                 
         except Exception as e:
+            incidents.append("bing_error")
             debug_log(f"🔍 Bing Exception: {type(e).__name__} - {str(e)[:50]}", "ERROR")
         return ""
     
+    def fetch_pages(urls, timeout=TIMEOUT, ordered=False):
+        """
+        Télécharge les pages en parallèle (DETECTIVE_FETCH_WORKERS) et rend
+        (url, contenu) dans l'ordre d'arrivée - ou dans l'ordre de `urls` si
+        ordered=True (priorité déterministe, indépendante des temps de réponse).
+        Fermer le générateur (ou atteindre la deadline) annule les téléchargements
+        pas encore démarrés.
+        """
+        if not urls or time_left() <= 0:
+            return
+        pool = ThreadPoolExecutor(max_workers=min(DETECTIVE_FETCH_WORKERS, len(urls)), thread_name_prefix="detective")
+        futures = {pool.submit(get_page_content, page_url, timeout): page_url for page_url in urls}
+        ready = {}
+        next_index = 0
+        try:
+            for future in as_completed(futures, timeout=max(0.1, time_left())):
+                if not ordered:
+                    yield futures[future], future.result()
+                    continue
+                ready[futures[future]] = future.result()
+                while next_index < len(urls) and urls[next_index] in ready:
+                    yield urls[next_index], ready.pop(urls[next_index])
+                    next_index += 1
+        except FuturesTimeoutError:
+            incidents.append("deadline")
+            debug_log(f"⏱️ Deadline globale ({DETECTIVE_DEADLINE_SECONDS}s) atteinte - pages restantes abandonnées", "WARNING")
+            # Pages déjà téléchargées mais en attente d'une page prioritaire : rendues quand même
+            for page_url in urls[next_index:]:
+                if page_url in ready:
+                    yield page_url, ready.pop(page_url)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    def harvest_page(page_url, page_content, log_prefix):
+        """Extrait et score les emails d'une page contact / CMS (mailto prioritaires)"""
+        parsed = parse_page(page_content)
+        page_type = get_page_type(page_url)
+        
+        page_mailto = extract_mailto_emails(parsed)
+        if page_mailto:
+            debug_log(f"{log_prefix or page_type} → Mailto: {page_mailto}", "SUCCESS")
+        
+        for email in page_mailto:
+            score = score_email(email, site_domain) + 40
+            if email not in all_emails or all_emails[email]["score"] < score:
+                all_emails[email] = {"score": score, "source": f"{page_type} (mailto)"}
+        
+        page_emails = extract_emails_from_text(parsed.text)
+        if page_emails:
+            debug_log(f"{log_prefix or page_type} → Emails texte: {page_emails}", "SUCCESS")
+        
+        for email in page_emails:
+            score = score_email(email, site_domain) + 20
+            if email not in all_emails or all_emails[email]["score"] < score:
+                all_emails[email] = {"score": score, "source": page_type}
+    
+    def best_score():
+        return max((info["score"] for info in all_emails.values()), default=0)
+    
     # ═══════════════════════════════════════════════════════════════
     # EXÉCUTION DU SCRAPING
     # ═══════════════════════════════════════════════════════════════
@@ -2213,12 +4094,12 @@ def find_merchant_email(url):
             homepage_content = ""
         else:
             pages_visited.add(base_url)
-            soup = BeautifulSoup(homepage_content, 'html.parser')
+            homepage = parse_page(homepage_content)
             debug_log(f"Page d'accueil chargée: {len(homepage_content)} chars", "SUCCESS")
             
             # 3. Extraire mailto: de l'accueil
             debug_log("Recherche des mailto: sur l'accueil...", "INFO")
-            mailto_emails = extract_mailto_emails(soup)
+            mailto_emails = extract_mailto_emails(homepage)
             if mailto_emails:
                 debug_log(f"Mailto trouvés sur accueil: {mailto_emails}", "SUCCESS")
             else:
@@ -2231,7 +4112,7 @@ def find_merchant_email(url):
             
             # 4. Extraire emails du texte
             debug_log("Recherche emails dans le texte de l'accueil...", "INFO")
-            homepage_emails = extract_emails_from_text(homepage_content)
+            homepage_emails = extract_emails_from_text(homepage.text)
             if homepage_emails:
                 debug_log(f"Emails trouvés dans texte accueil: {homepage_emails}", "SUCCESS")
             else:
@@ -2241,38 +4122,23 @@ def find_merchant_email(url):
                 if email not in all_emails:
                     all_emails[email] = {"score": score_email(email, site_domain), "source": "Accueil"}
             
-            # 5. Visiter les liens contact trouvés
+            # 5. Visiter les liens contact trouvés (en parallèle)
             debug_log("═══ ÉTAPE 2: Recherche liens contact ═══", "INFO")
-            contact_links = find_contact_links(soup, base_url)
+            contact_links = [link for link in find_contact_links(homepage, base_url) if link not in pages_visited]
+            pages_visited.update(contact_links)
             debug_log(f"{len(contact_links)} liens contact détectés: {contact_links[:5]}", "INFO")
             
-            for link in contact_links:
-                if link in pages_visited:
-                    continue
-                pages_visited.add(link)
-                
-                page_content = get_page_content(link)
-                if page_content:
-                    page_soup = BeautifulSoup(page_content, 'html.parser')
-                    page_type = get_page_type(link)
-                    
-                    page_mailto = extract_mailto_emails(page_soup)
-                    if page_mailto:
-                        debug_log(f"Mailto trouvés sur {page_type}: {page_mailto}", "SUCCESS")
-                    
-                    for email in page_mailto:
-                        score = score_email(email, site_domain) + 40
-                        if email not in all_emails or all_emails[email]["score"] < score:
-                            all_emails[email] = {"score": score, "source": f"{page_type} (mailto)"}
-                    
-                    page_emails = extract_emails_from_text(page_content)
-                    if page_emails:
-                        debug_log(f"Emails trouvés sur {page_type}: {page_emails}", "SUCCESS")
-                    
-                    for email in page_emails:
-                        score = score_email(email, site_domain) + 20
-                        if email not in all_emails or all_emails[email]["score"] < score:
-                            all_emails[email] = {"score": score, "source": page_type}
+            if best_score() >= DETECTIVE_STOP_SCORE:
+                debug_log(f"Email fort déjà trouvé sur l'accueil (score {best_score()}) - liens contact ignorés", "SUCCESS")
+            else:
+                pages = fetch_pages(contact_links)
+                for link, page_content in pages:
+                    if page_content:
+                        harvest_page(link, page_content, None)
+                    if best_score() >= DETECTIVE_STOP_SCORE:
+                        debug_log(f"Email fort trouvé (score {best_score()}) - fetchs restants annulés", "SUCCESS")
+                        break
+                pages.close()
             
             # Log état actuel
             if all_emails:
@@ -2285,39 +4151,27 @@ def find_merchant_email(url):
         # ═══════════════════════════════════════════════════════════════
         
         if not all_emails:
-            debug_log(f"═══ FALLBACK 1: Test des {len(STANDARD_PATHS)} chemins CMS ═══", "INFO")
+            debug_log(f"═══ FALLBACK 1: Test des {len(STANDARD_PATHS)} chemins CMS (en parallèle) ═══", "INFO")
             
+            cms_urls = []
             for path in STANDARD_PATHS:
                 test_url = base_domain + path
-                if test_url in pages_visited:
-                    continue
-                pages_visited.add(test_url)
-                
-                page_content = get_page_content(test_url, timeout=4)
+                if test_url not in pages_visited:
+                    pages_visited.add(test_url)
+                    cms_urls.append(test_url)
+            
+            # Pages lues dans l'ordre de STANDARD_PATHS (à score égal, /contact l'emporte
+            # sur /policies/privacy-policy) ; arrêt anticipé seulement sur un email fort
+            pages = fetch_pages(cms_urls, timeout=4, ordered=True)
+            for test_url, page_content in pages:
                 if page_content:
-                    page_soup = BeautifulSoup(page_content, 'html.parser')
-                    page_type = get_page_type(test_url)
-                    
-                    page_mailto = extract_mailto_emails(page_soup)
-                    if page_mailto:
-                        debug_log(f"CMS {path} → Mailto: {page_mailto}", "SUCCESS")
-                    
-                    for email in page_mailto:
-                        score = score_email(email, site_domain) + 40
-                        all_emails[email] = {"score": score, "source": f"{page_type} (mailto)"}
-                    
-                    page_emails = extract_emails_from_text(page_content)
-                    if page_emails:
-                        debug_log(f"CMS {path} → Emails texte: {page_emails}", "SUCCESS")
-                    
-                    for email in page_emails:
-                        score = score_email(email, site_domain) + 20
-                        if email not in all_emails or all_emails[email]["score"] < score:
-                            all_emails[email] = {"score": score, "source": page_type}
-                    
-                    if all_emails:
-                        debug_log(f"Email trouvé via CMS path: {path}", "SUCCESS")
+                    harvest_page(test_url, page_content, f"CMS {test_url[len(base_domain):]}")
+                    if best_score() >= DETECTIVE_STOP_SCORE:
+                        debug_log(f"Email fort trouvé via CMS path {test_url[len(base_domain):]} (score {best_score()}) - fetchs restants annulés", "SUCCESS")
                         break
+            pages.close()
+            if all_emails:
+                debug_log(f"Emails trouvés via CMS paths: {len(all_emails)} (meilleur score {best_score()})", "SUCCESS")
             
             if not all_emails:
                 debug_log("Aucun email trouvé après FALLBACK 1 (CMS paths)", "WARNING")
@@ -2343,6 +4197,10 @@ def find_merchant_email(url):
             ]
             
             for query in search_queries:
+                if time_left() <= 0:
+                    incidents.append("deadline")
+                    debug_log(f"⏱️ Deadline globale ({DETECTIVE_DEADLINE_SECONDS}s) atteinte - recherche web interrompue", "WARNING")
+                    break
                 debug_log(f"Requête: {query}", "INFO")
                 
                 # Essayer DuckDuckGo
@@ -2412,13 +4270,16 @@ def find_merchant_email(url):
             return {
                 "email": best_email,
                 "source": best_source,
-                "all_emails": [e[0] for e in sorted_emails[:5]]
+                "all_emails": [e[0] for e in sorted_emails[:5]],
+                "complete": not incidents
             }
         
         debug_log(f"❌ ÉCHEC: Aucun email trouvé pour {site_domain}", "ERROR")
         debug_log(f"   Pages visitées: {len(pages_visited)}", "INFO")
+        if incidents:
+            debug_log(f"   Crawl non concluant ({', '.join(sorted(set(incidents)))}) - résultat non mis en cache", "WARNING")
         debug_log("   Suggestions: Vérifier si le site est accessible, si les emails sont en JS", "INFO")
-        return {"email": None, "source": "Aucun email trouvé", "all_emails": []}
+        return {"email": None, "source": "Aucun email trouvé", "all_emails": [], "complete": not incidents}
         
     except Exception as e:
         debug_log(f"EXCEPTION FATALE: {type(e).__name__} - {str(e)}", "ERROR")
@@ -2869,8 +4730,6 @@ def analyze_litigation_v2(text, subject, sender, to_field, detected_company, ext
     if not OPENAI_API_KEY:
         return ["REJET", "Pas d'API", "Inconnu", ""]
     
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
     # Préparer les infos contextuelles
     company_hint = ""
     if detected_company:
@@ -3042,7 +4901,7 @@ Exemples REJET :
 - "REJET | REFUS | AIR FRANCE | Malheureusement, nous ne pouvons accéder à votre demande"
 """
 
-        response = client.chat.completions.create(
+        response = OPENAI_GATEWAY.chat("analyze_litigation_v2",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0,
@@ -3067,27 +4926,85 @@ Exemples REJET :
 # 🚀 ANALYSE IA PERMISSIVE - MODE VOYAGE (INFAILLIBLE)
 # ════════════════════════════════════════════════════════════════
 
-def analyze_litigation_strict(text, subject, sender, to_field="", scan_type="ecommerce"):
-    """
-    🎯 ANALYSE IA STRICTE AVEC DOUBLE VÉRIFICATION
-    
-    Cette fonction garantit une séparation TOTALE entre :
-    - scan_type="travel" → UNIQUEMENT transports (train/avion/VTC)
-    - scan_type="ecommerce" → UNIQUEMENT produits physiques (colis/commandes)
-    
-    Retourne : {"is_valid": bool, "litige": bool, "company": str, "amount": str, "law": str, "proof": str, "category": str}
-    """
-    if not OPENAI_API_KEY:
-        return {"is_valid": False, "litige": False, "reason": "Pas d'API"}
-    
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
-    # ════════════════════════════════════════════════════════════════
-    # PROMPTS STRICTEMENT SÉPARÉS SELON LE TYPE DE SCAN
-    # ════════════════════════════════════════════════════════════════
-    
-    if scan_type == "travel":
-        system_prompt = """Tu es un AVOCAT EXPERT en Droit des Transports de Passagers (Règlement UE 261/2004 pour l'aérien, Règlement UE 2021/782 pour le ferroviaire).
+# ════════════════════════════════════════════════════════════════
+# 🗄️ CACHE PERSISTANT DES CLASSIFICATIONS IA (analyze_litigation_strict)
+# ════════════════════════════════════════════════════════════════
+# Un même email (ou un corps identique) n'est classé qu'une fois : rescans,
+# /reset-scan et autres workers gunicorn relisent le verdict en base.
+# ⚠️ Incrémenter STRICT_PROMPT_VERSION à chaque modification des prompts !
+
+STRICT_PROMPT_VERSION = "strict-v1"
+AI_CACHE_TTL_DAYS = int(os.environ.get("AI_CACHE_TTL_DAYS", "30"))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_MAX_ENTRIES", "20000"))
+AI_CACHE_STATS = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "errors": 0}
+
+def _ai_cache_key(scan_type, subject, sender, text, to_field=""):
+    """Clé sha256 sur le contenu réellement envoyé au modèle (corps normalisé et tronqué)"""
+    import hashlib
+    body = re.sub(r"\s+", " ", text or "").strip()[:2500]
+    # Le prompt e-commerce inclut le destinataire, le prompt transport non
+    to_part = (to_field or "") if scan_type != "travel" else ""
+    raw = json.dumps([STRICT_PROMPT_VERSION, scan_type, subject or "", sender or "", to_part, body],
+                     ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def ai_cache_get(cache_key):
+    """Retourne le verdict en cache (dict) ou None - expiré = absent"""
+    from datetime import timedelta
+    try:
+        entry = AIClassificationCache.query.get(cache_key)
+        if entry and datetime.utcnow() - entry.created_at <= timedelta(days=AI_CACHE_TTL_DAYS):
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_hit_at = datetime.utcnow()
+            db.session.commit()
+            AI_CACHE_STATS["hits"] += 1
+            return json.loads(entry.result_json)
+    except Exception as e:
+        db.session.rollback()
+        AI_CACHE_STATS["errors"] += 1
+        _dbg(f"⚠️ Cache IA lecture: {type(e).__name__}: {str(e)[:60]}")
+    AI_CACHE_STATS["misses"] += 1
+    return None
+
+def ai_cache_set(cache_key, scan_type, result):
+    """Enregistre un verdict et applique TTL + borne de taille (éviction LRU)"""
+    from datetime import timedelta
+    try:
+        entry = AIClassificationCache.query.get(cache_key)
+        if entry is None:
+            entry = AIClassificationCache(cache_key=cache_key, scan_type=scan_type)
+            db.session.add(entry)
+        entry.result_json = json.dumps(result, ensure_ascii=False)
+        entry.created_at = datetime.utcnow()
+        entry.last_hit_at = datetime.utcnow()
+        db.session.commit()
+        AI_CACHE_STATS["stores"] += 1
+
+        # Éviction périodique (1 écriture sur 50) : expirés puis moins récemment utilisés
+        if AI_CACHE_STATS["stores"] % 50 == 1:
+            expired_before = datetime.utcnow() - timedelta(days=AI_CACHE_TTL_DAYS)
+            evicted = AIClassificationCache.query.filter(
+                AIClassificationCache.created_at < expired_before).delete(synchronize_session=False)
+            overflow = AIClassificationCache.query.count() - AI_CACHE_MAX_ENTRIES
+            if overflow > 0:
+                oldest = [row.cache_key for row in AIClassificationCache.query
+                          .with_entities(AIClassificationCache.cache_key)
+                          .order_by(AIClassificationCache.last_hit_at.asc()).limit(overflow)]
+                evicted += AIClassificationCache.query.filter(
+                    AIClassificationCache.cache_key.in_(oldest)).delete(synchronize_session=False)
+            db.session.commit()
+            AI_CACHE_STATS["evictions"] += evicted
+    except Exception as e:
+        db.session.rollback()
+        AI_CACHE_STATS["errors"] += 1
+        _dbg(f"⚠️ Cache IA écriture: {type(e).__name__}: {str(e)[:60]}")
+
+# ════════════════════════════════════════════════════════════════
+# 📜 PROMPTS STRICTS (partagés par le mode unitaire et le mode lot)
+# ════════════════════════════════════════════════════════════════
+
+STRICT_SYSTEM_PROMPTS = {
+    "travel": """Tu es un AVOCAT EXPERT en Droit des Transports de Passagers (Règlement UE 261/2004 pour l'aérien, Règlement UE 2021/782 pour le ferroviaire).
 
 🚨 RÈGLE ABSOLUE DE FILTRAGE 🚨
 Tu ne traites QUE les problèmes de PASSAGERS :
@@ -3127,15 +5044,30 @@ Si c'est du E-COMMERCE → Réponds UNIQUEMENT : {"is_valid": false, "reason": "
 Mots-clés BON D'ACHAT (= LITIGE) : avoir, voucher, bon, crédit voyage, miles, points, geste commercial, compensation en bons
 Mots-clés VIREMENT (= PAS LITIGE) : virement effectué, crédité sur votre compte bancaire, remboursement par virement, IBAN crédité
 
-Réponds TOUJOURS en JSON valide."""
+Réponds TOUJOURS en JSON valide.""",
+    "ecommerce": """Tu es un EXPERT en Droit de la Consommation et Litiges E-commerce (Directive UE 2011/83, Code de la consommation).
 
-        user_prompt = f"""📧 EMAIL À ANALYSER (SCAN TRANSPORT) :
+🚨 RÈGLE ABSOLUE DE FILTRAGE 🚨
+Tu ne traites QUE les problèmes de PRODUITS PHYSIQUES :
+- Colis non livré
+- Produit défectueux
+- Remboursement non effectué
+- Retour refusé
+- Article non conforme
 
-EXPÉDITEUR: {sender}
-SUJET: {subject}
-CONTENU: {text[:2500]}
+❌ REJETTE IMMÉDIATEMENT si l'email concerne :
+- Un billet de TRAIN ou d'AVION
+- Un retard de VOL ou de TGV
+- SNCF, Air France, EasyJet, Ryanair, Eurostar, Uber, Bolt
+- Un problème de PASSAGER (pas de colis)
 
-═══════════════════════════════════════════════════════════════
+Si c'est du TRANSPORT → Réponds UNIQUEMENT : {"is_valid": false, "reason": "Transport, pas e-commerce"}
+
+Réponds TOUJOURS en JSON valide.""",
+}
+
+STRICT_INSTRUCTIONS = {
+    "travel": """═══════════════════════════════════════════════════════════════
 🔍 ÉTAPE 1 : VÉRIFICATION DU TYPE (OBLIGATOIRE)
 ═══════════════════════════════════════════════════════════════
 
@@ -3148,7 +5080,7 @@ Cet email concerne-t-il un TRANSPORT DE PASSAGERS ?
                  Amazon, Temu, Shein, Zalando, Fnac, AliExpress, Asphalte,
                  Chaussures, T-shirt, Pantalon, Accessoire
 
-Si INVALIDE → {{"is_valid": false, "reason": "E-commerce/Livraison de produit"}}
+Si INVALIDE → {"is_valid": false, "reason": "E-commerce/Livraison de produit"}
 
 ═══════════════════════════════════════════════════════════════
 🔍 ÉTAPE 2 : ANALYSE DU LITIGE TRANSPORT (si valide)
@@ -3190,50 +5122,21 @@ BAGAGE PERDU : jusqu'à 1300€
 ═══════════════════════════════════════════════════════════════
 
 Si E-COMMERCE (invalide) :
-{{"is_valid": false, "reason": "Colis/Commande e-commerce"}}
+{"is_valid": false, "reason": "Colis/Commande e-commerce"}
 
 Si TRANSPORT valide avec litige (retard/annulation) :
-{{"is_valid": true, "litige": true, "company": "SNCF", "amount": "250€", "law": "Règlement UE 261/2004", "proof": "Vol annulé, la compagnie invoque la grève mais l'indemnisation reste due", "category": "transport"}}
+{"is_valid": true, "litige": true, "company": "SNCF", "amount": "250€", "law": "Règlement UE 261/2004", "proof": "Vol annulé, la compagnie invoque la grève mais l'indemnisation reste due", "category": "transport"}
 
 Si TRANSPORT valide avec BON D'ACHAT (= litige !) :
-{{"is_valid": true, "litige": true, "company": "SNCF", "amount": "15€", "law": "Règlement UE 2021/782", "proof": "La compagnie propose un bon d'achat de 15€ au lieu d'un remboursement financier", "category": "transport"}}
+{"is_valid": true, "litige": true, "company": "SNCF", "amount": "15€", "law": "Règlement UE 2021/782", "proof": "La compagnie propose un bon d'achat de 15€ au lieu d'un remboursement financier", "category": "transport"}
 
 Si TRANSPORT valide sans litige (confirmation normale, vrai virement reçu) :
-{{"is_valid": true, "litige": false, "reason": "Confirmation de réservation normale"}}
+{"is_valid": true, "litige": false, "reason": "Confirmation de réservation normale"}
 
 ⚠️ RAPPEL 1 : Même si l'email dit "pas d'indemnisation due", calcule quand même le montant théorique !
 ⚠️ RAPPEL 2 : Un BON D'ACHAT ou AVOIR n'est PAS un remboursement valide → c'est un LITIGE !
-"""
-
-    else:  # scan_type == "ecommerce"
-        system_prompt = """Tu es un EXPERT en Droit de la Consommation et Litiges E-commerce (Directive UE 2011/83, Code de la consommation).
-
-🚨 RÈGLE ABSOLUE DE FILTRAGE 🚨
-Tu ne traites QUE les problèmes de PRODUITS PHYSIQUES :
-- Colis non livré
-- Produit défectueux
-- Remboursement non effectué
-- Retour refusé
-- Article non conforme
-
-❌ REJETTE IMMÉDIATEMENT si l'email concerne :
-- Un billet de TRAIN ou d'AVION
-- Un retard de VOL ou de TGV
-- SNCF, Air France, EasyJet, Ryanair, Eurostar, Uber, Bolt
-- Un problème de PASSAGER (pas de colis)
-
-Si c'est du TRANSPORT → Réponds UNIQUEMENT : {"is_valid": false, "reason": "Transport, pas e-commerce"}
-
-Réponds TOUJOURS en JSON valide."""
-
-        user_prompt = f"""📧 EMAIL À ANALYSER (SCAN E-COMMERCE) :
-
-EXPÉDITEUR: {sender}
-DESTINATAIRE: {to_field}
-SUJET: {subject}
-CONTENU: {text[:2500]}
-
-═══════════════════════════════════════════════════════════════
+""",
+    "ecommerce": """═══════════════════════════════════════════════════════════════
 🔍 ÉTAPE 1 : VÉRIFICATION DU TYPE (OBLIGATOIRE)
 ═══════════════════════════════════════════════════════════════
 
@@ -3245,7 +5148,7 @@ Cet email concerne-t-il un PRODUIT PHYSIQUE / COMMANDE E-COMMERCE ?
 ❌ INVALIDE si : Billet train, Billet avion, Vol, TGV, Eurostar, 
                  SNCF, Air France, EasyJet, Ryanair, Uber, Bolt
 
-Si INVALIDE → {{"is_valid": false, "reason": "Transport/Billet"}}
+Si INVALIDE → {"is_valid": false, "reason": "Transport/Billet"}
 
 ═══════════════════════════════════════════════════════════════
 🔍 ÉTAPE 2 : ANALYSE DU LITIGE E-COMMERCE (si valide)
@@ -3266,17 +5169,104 @@ MOTS-CLÉS DE LITIGE :
 ═══════════════════════════════════════════════════════════════
 
 Si TRANSPORT (invalide) :
-{{"is_valid": false, "reason": "Billet train/avion"}}
+{"is_valid": false, "reason": "Billet train/avion"}
 
 Si E-COMMERCE valide avec litige :
-{{"is_valid": true, "litige": true, "company": "AMAZON", "amount": "42.99€", "law": "Directive UE 2011/83", "proof": "Colis jamais reçu", "category": "ecommerce"}}
+{"is_valid": true, "litige": true, "company": "AMAZON", "amount": "42.99€", "law": "Directive UE 2011/83", "proof": "Colis jamais reçu", "category": "ecommerce"}
 
 Si E-COMMERCE valide sans litige :
-{{"is_valid": true, "litige": false, "reason": "Confirmation de commande normale"}}
-"""
+{"is_valid": true, "litige": false, "reason": "Confirmation de commande normale"}
+""",
+}
+
+STRICT_SCAN_LABELS = {"travel": "SCAN TRANSPORT", "ecommerce": "SCAN E-COMMERCE"}
+
+def _strict_kind(scan_type):
+    """Tout ce qui n'est pas "travel" est traité avec les prompts e-commerce"""
+    return "travel" if scan_type == "travel" else "ecommerce"
+
+def _strict_email_block(scan_type, text, subject, sender, to_field=""):
+    """Champs d'un email tels qu'envoyés au modèle (le prompt transport ignore le destinataire)"""
+    if _strict_kind(scan_type) == "travel":
+        return f"""EXPÉDITEUR: {sender}
+SUJET: {subject}
+CONTENU: {text[:2500]}"""
+    return f"""EXPÉDITEUR: {sender}
+DESTINATAIRE: {to_field}
+SUJET: {subject}
+CONTENU: {text[:2500]}"""
+
+def _finalize_strict_result(result, subject, scan_type):
+    """Valeurs par défaut garanties sur un verdict strict"""
+    result.setdefault("is_valid", False)
+    result.setdefault("litige", False)
+    result.setdefault("reason", "")
+
+    if result.get("is_valid") and result.get("litige"):
+        result.setdefault("company", "Inconnu")
+        result.setdefault("amount", "À déterminer")
+        result.setdefault("law", "Code de la consommation")
+        result.setdefault("proof", subject[:120] if subject else "")
+        result["category"] = scan_type
+    return result
+
+def _batch_verdict_issue(item, known_ids):
+    """
+    Contrôle un verdict du mode lot → None s'il est exploitable, sinon la raison du rejet
+    (l'email concerné repart alors en analyse unitaire).
+    """
+    if not isinstance(item, dict):
+        return "verdict non objet"
+    if not isinstance(item.get("message_id"), str) or item["message_id"] not in known_ids:
+        return "message_id inconnu"
+    if not isinstance(item.get("is_valid"), bool):
+        return "is_valid non booléen"
+    # Hors périmètre ({"is_valid": false, "reason": ...}) : litige absent → False (_finalize_strict_result)
+    if item["is_valid"] and not isinstance(item.get("litige"), bool):
+        return "litige absent ou non booléen"
+    if "litige" in item and not isinstance(item["litige"], bool):
+        return "litige non booléen"
+    for field in ("reason", "company", "amount", "law", "proof"):
+        if field in item and not isinstance(item[field], (str, int, float)):
+            return f"{field} invalide"
+    return None
+
+def analyze_litigation_strict(text, subject, sender, to_field="", scan_type="ecommerce"):
+    """
+    🎯 ANALYSE IA STRICTE AVEC DOUBLE VÉRIFICATION
+    
+    Cette fonction garantit une séparation TOTALE entre :
+    - scan_type="travel" → UNIQUEMENT transports (train/avion/VTC)
+    - scan_type="ecommerce" → UNIQUEMENT produits physiques (colis/commandes)
+    
+    Retourne : {"is_valid": bool, "litige": bool, "company": str, "amount": str, "law": str, "proof": str, "category": str}
+    
+    Les verdicts sont mis en cache (AIClassificationCache) : un email déjà classé
+    ne repart pas chez OpenAI.
+    """
+    if not OPENAI_API_KEY:
+        return {"is_valid": False, "litige": False, "reason": "Pas d'API"}
+    
+    cache_key = _ai_cache_key(scan_type, subject, sender, text, to_field)
+    cached = ai_cache_get(cache_key)
+    if cached is not None:
+        DEBUG_LOGS.append(f"🗄️ Cache IA {scan_type}: hit ({subject[:40] if subject else ''})")
+        return cached
+    
+    # ════════════════════════════════════════════════════════════════
+    # PROMPTS STRICTEMENT SÉPARÉS SELON LE TYPE DE SCAN
+    # ════════════════════════════════════════════════════════════════
+    
+    kind = _strict_kind(scan_type)
+    system_prompt = STRICT_SYSTEM_PROMPTS[kind]
+    user_prompt = f"""📧 EMAIL À ANALYSER ({STRICT_SCAN_LABELS[kind]}) :
+
+{_strict_email_block(scan_type, text, subject, sender, to_field)}
+
+{STRICT_INSTRUCTIONS[kind]}"""
 
     try:
-        response = client.chat.completions.create(
+        response = OPENAI_GATEWAY.chat("analyze_litigation_strict",
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -3289,25 +5279,137 @@ Si E-COMMERCE valide sans litige :
         ai_response = (response.choices[0].message.content or "").strip()
         DEBUG_LOGS.append(f"🤖 AI {scan_type}: {ai_response[:80]}...")
 
-        DEFAULT = {"is_valid": False, "litige": False, "reason": "Parsing error"}
-        result = secure_json_parse(ai_response, DEFAULT)
+        DEFAULT = {"is_valid": False, "litige": False, "reason": "Parsing error"}
+        result = _finalize_strict_result(secure_json_parse(ai_response, DEFAULT), subject, scan_type)
+
+        # Pas de cache sur un échec de parsing (réponse probablement transitoire)
+        if result.get("reason") != "Parsing error":
+            ai_cache_set(cache_key, scan_type, result)
+
+        return result
+            
+    except Exception as e:
+        DEBUG_LOGS.append(f"❌ Erreur IA {scan_type}: {str(e)}")
+        return {"is_valid": False, "litige": False, "reason": str(e)[:50]}
+
+
+# ════════════════════════════════════════════════════════════════
+# 📦 MODE LOT - Plusieurs emails dans une seule requête
+# ════════════════════════════════════════════════════════════════
+# Le long system prompt n'est envoyé qu'une fois pour N emails.
+# Chaque verdict est revalidé individuellement ; un verdict manquant ou
+# invalide repasse par le mode unitaire (analyze_litigation_strict).
+
+STRICT_BATCH_SIZE = int(os.environ.get("STRICT_BATCH_SIZE", "5"))
+
+def analyze_litigation_strict_batch(emails, scan_type="ecommerce"):
+    """
+    📦 ANALYSE IA STRICTE EN LOT
+    
+    emails : liste de dicts {"message_id", "text", "subject", "sender", "to_field"}
+    Retourne : {message_id: verdict} (même format que analyze_litigation_strict)
+    """
+    if not OPENAI_API_KEY:
+        return {e["message_id"]: {"is_valid": False, "litige": False, "reason": "Pas d'API"} for e in emails}
+    
+    verdicts = {}
+    pending = []
+    for email in emails:
+        key = _ai_cache_key(scan_type, email.get("subject"), email.get("sender"),
+                            email.get("text"), email.get("to_field", ""))
+        cached = ai_cache_get(key)
+        if cached is not None:
+            verdicts[email["message_id"]] = cached
+        else:
+            pending.append((email, key))
+    
+    if len(pending) > 1:
+        kind = _strict_kind(scan_type)
+        blocks = "\n\n".join(
+            f"""────────── EMAIL message_id="{email['message_id']}" ──────────
+{_strict_email_block(scan_type, email.get('text') or '', email.get('subject') or '',
+                     email.get('sender') or '', email.get('to_field') or '')}"""
+            for email, _ in pending
+        )
+        user_prompt = f"""📧 {len(pending)} EMAILS À ANALYSER ({STRICT_SCAN_LABELS[kind]}) - analyse CHAQUE email indépendamment :
+
+{blocks}
+
+{STRICT_INSTRUCTIONS[kind]}
+
+═══════════════════════════════════════════════════════════════
+📦 FORMAT DE RÉPONSE EN LOT (OBLIGATOIRE)
+═══════════════════════════════════════════════════════════════
 
-        result.setdefault("is_valid", False)
-        result.setdefault("litige", False)
-        result.setdefault("reason", "")
+Réponds avec UN SEUL objet JSON contenant un verdict par email :
+{{"verdicts": [{{"message_id": "<message_id de l'email>", ...champs du format ci-dessus...}}]}}"""
+        
+        try:
+            response = OPENAI_GATEWAY.chat("analyze_litigation_strict_batch",
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": STRICT_SYSTEM_PROMPTS[kind]},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.1,
+                max_tokens=350 * len(pending)
+            )
+            ai_response = (response.choices[0].message.content or "").strip()
+            DEBUG_LOGS.append(f"📦 AI {scan_type} lot de {len(pending)}: {ai_response[:80]}...")
+            
+            items = secure_json_parse(ai_response, {"verdicts": []}).get("verdicts")
+            known_ids = {str(email["message_id"]) for email, _ in pending}
+            by_id = {}
+            ambiguous = set()
+            for item in items if isinstance(items, list) else []:
+                # Validation item par item : un verdict mal formé renvoie l'email en repli unitaire
+                issue = _batch_verdict_issue(item, known_ids)
+                if issue:
+                    DEBUG_LOGS.append(f"⚠️ Verdict de lot rejeté ({issue})")
+                    continue
+                parsed = dict(item)
+                msg_id = parsed.pop("message_id")
+                if msg_id in by_id:
+                    ambiguous.add(msg_id)  # Deux verdicts pour un même email : aucun n'est retenu
+                by_id[msg_id] = parsed
+            for msg_id in ambiguous:
+                by_id.pop(msg_id, None)
+            
+            still_pending = []
+            for email, key in pending:
+                parsed = by_id.get(str(email["message_id"]))
+                if parsed is None:
+                    still_pending.append((email, key))
+                    continue
+                result = _finalize_strict_result(parsed, email.get("subject"), scan_type)
+                ai_cache_set(key, scan_type, result)
+                verdicts[email["message_id"]] = result
+            pending = still_pending
+        except Exception as e:
+            DEBUG_LOGS.append(f"❌ Erreur IA lot {scan_type}: {str(e)[:100]} → repli unitaire")
+    
+    # Repli unitaire : verdicts absents/invalides du lot (ou lot d'un seul email)
+    if pending:
+        if len(emails) > 1:
+            DEBUG_LOGS.append(f"📦 Repli unitaire pour {len(pending)} email(s)")
+        for email, _ in pending:
+            verdicts[email["message_id"]] = analyze_litigation_strict(
+                email.get("text") or "", email.get("subject") or "", email.get("sender") or "",
+                email.get("to_field") or "", scan_type=scan_type)
+    
+    return verdicts
 
-        if result.get("is_valid") and result.get("litige"):
-            result.setdefault("company", "Inconnu")
-            result.setdefault("amount", "À déterminer")
-            result.setdefault("law", "Code de la consommation")
-            result.setdefault("proof", subject[:120] if subject else "")
-            result["category"] = scan_type
 
-        return result
-            
-    except Exception as e:
-        DEBUG_LOGS.append(f"❌ Erreur IA {scan_type}: {str(e)}")
-        return {"is_valid": False, "litige": False, "reason": str(e)[:50]}
+def call_in_app_context(fn, *args, **kwargs):
+    """
+    Exécute fn depuis un thread de pool : le cache IA (et tout accès BDD)
+    exige un app context propre au thread.
+    """
+    with app.app_context():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db.session.remove()
 
 
 def analyze_ecommerce_flexible(text, subject, sender, to_field=""):
@@ -3348,8 +5450,6 @@ def analyze_ecommerce_flexible(text, subject, sender, to_field=""):
         except:
             pass
     
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
     system_prompt = """Tu es un expert en détection de litiges e-commerce. Tu analyses des emails pour trouver des problèmes de commande.
 
 🎯 TA MISSION : Détecter TOUT problème de livraison/commande, quelle que soit l'entreprise (grande marque OU petite boutique).
@@ -3403,7 +5503,7 @@ CONTENU: {text[:2500]}
 Analyse cet email et réponds UNIQUEMENT en JSON valide (pas de texte avant/après les accolades)."""
 
     try:
-        response = client.chat.completions.create(
+        response = OPENAI_GATEWAY.chat("analyze_ecommerce_flexible",
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -3651,20 +5751,16 @@ def is_invoice_without_dispute(subject: str, snippet: str) -> bool:
     Détecte les factures/confirmations de paiement normales SANS litige.
     Retourne True si c'est une facture normale à ignorer.
     """
-    blob = f"{subject or ''} {snippet or ''}".lower()
-    if any(k in blob for k in INVOICE_KEYWORDS) and not any(t in blob for t in DISPUTE_TRIGGERS):
+    hits = FILTER_KEYWORDS.scan(f"{subject or ''} {snippet or ''}")
+    if "invoice" in hits and "dispute" not in hits:
         return True
     return False
 
-def is_ignored_sender(sender_email):
+def split_sender_address(sender_email):
     """
-    ÉTAPE 1A : Vérification de l'expéditeur (GRATUIT)
-    Retourne (True, raison) si l'expéditeur doit être IGNORÉ
-    Retourne (False, "OK") si c'est un particulier
+    Extrait (préfixe, domaine) en minuscules d'un expéditeur
+    "Nom <email@domain.com>" ou "email@domain.com". None si pas d'@.
     """
-    if not sender_email:
-        return True, "Expéditeur vide"
-    
     sender_lower = sender_email.lower()
     
     # Extraire l'adresse email si format "Nom <email@domain.com>"
@@ -3675,10 +5771,24 @@ def is_ignored_sender(sender_email):
         email_address = sender_lower.strip()
     
     # Extraire le préfixe (avant @) et le domaine (après @)
-    if '@' in email_address:
-        prefix, domain = email_address.split('@', 1)
-    else:
+    if '@' not in email_address:
+        return None
+    prefix, domain = email_address.split('@', 1)
+    return prefix, domain
+
+def is_ignored_sender(sender_email):
+    """
+    ÉTAPE 1A : Vérification de l'expéditeur (GRATUIT)
+    Retourne (True, raison) si l'expéditeur doit être IGNORÉ
+    Retourne (False, "OK") si c'est un particulier
+    """
+    if not sender_email:
+        return True, "Expéditeur vide"
+    
+    parts = split_sender_address(sender_email)
+    if parts is None:
         return True, "Format email invalide"
+    prefix, domain = parts
     
     # CHECK 1 : Vérifier si le DOMAINE est une entreprise blacklistée
     for blacklisted in BLACKLIST_COMPANY_DOMAINS:
@@ -3697,11 +5807,9 @@ def has_required_keywords(subject, body_snippet):
     ÉTAPE 1B : Vérification des mots-clés PROBLÈME (GRATUIT)
     Retourne True si l'email contient au moins un mot-clé de litige
     """
-    text_to_check = (subject + " " + body_snippet).lower()
-    
-    for keyword in REQUIRED_KEYWORDS:
-        if keyword.lower() in text_to_check:
-            return True, keyword
+    keyword = FILTER_KEYWORDS.scan(subject + " " + body_snippet).get("required")
+    if keyword:
+        return True, keyword
     
     return False, None
 
@@ -3712,11 +5820,9 @@ def has_success_keywords(subject, body_snippet):
     → Ces emails doivent être IGNORÉS par le Chasseur (pas de litige à créer)
     → Ils seront traités par l'Encaisseur (CRON) pour valider les paiements
     """
-    text_to_check = (subject + " " + body_snippet).lower()
-    
-    for keyword in KEYWORDS_SUCCESS:
-        if keyword.lower() in text_to_check:
-            return True, keyword
+    keyword = FILTER_KEYWORDS.scan(subject + " " + body_snippet).get("success")
+    if keyword:
+        return True, keyword
     
     return False, None
 
@@ -3726,11 +5832,9 @@ def has_refusal_keywords(subject, body_snippet):
     Retourne True si l'email est un REFUS du service client
     → Ces emails ne sont PAS des litiges gagnables (l'entreprise a dit NON)
     """
-    text_to_check = (subject + " " + body_snippet).lower()
-    
-    for keyword in KEYWORDS_REFUSAL:
-        if keyword.lower() in text_to_check:
-            return True, keyword
+    keyword = FILTER_KEYWORDS.scan(subject + " " + body_snippet).get("refusal")
+    if keyword:
+        return True, keyword
     
     return False, None
 
@@ -3771,6 +5875,92 @@ def pre_filter_email(sender, subject, snippet):
     # L'email a passé le videur ! C'est un PROBLÈME NON RÉSOLU
     return True, f"🎯 Mot-clé litige: '{found_keyword}'"
 
+# ════════════════════════════════════════════════════════════════
+# 🧮 PRÉ-FILTRES EN BATCH (colonnes senders / subjects / snippets)
+# ════════════════════════════════════════════════════════════════
+# Même sémantique (et mêmes raisons) que fast_candidate_filter / pre_filter_email,
+# mais chaque colonne est normalisée une fois et scannée en UNE passe regex.
+# Retour : (masque de booléens "garder", liste des raisons), alignés sur l'entrée.
+
+def fast_candidate_filter_batch(scan_type: str, senders, subjects, snippets) -> tuple:
+    """Version batch de fast_candidate_filter"""
+    senders = [s or "" for s in senders]
+    subjects = [s or "" for s in subjects]
+    snippets = [s or "" for s in snippets]
+    
+    blob_hits = FILTER_KEYWORDS.scan_many(
+        f"{sender} {subject} {snippet}" for sender, subject, snippet in zip(senders, subjects, snippets)
+    )
+    subject_hits = FILTER_KEYWORDS.scan_many(subjects)
+    
+    if scan_type == "travel":
+        exclude, include = "travel_fast_exclude", "travel_fast_include"
+        exclude_reason, include_reason, ok_reason = "Exclusion e-commerce", "Pas assez d'indices transport", "Candidat transport"
+    else:
+        exclude, include = "ecom_fast_exclude", "ecom_fast_include"
+        exclude_reason, include_reason, ok_reason = "Exclusion transport", "Pas assez d'indices e-commerce", "Candidat e-commerce"
+    
+    keep, reasons = [], []
+    for subject, hits, subj_hits in zip(subjects, blob_hits, subject_hits):
+        if "mise en demeure" in subject.lower():
+            reason = "Notre propre email"
+        elif "success" in hits:
+            reason = "Déjà résolu (success keyword)"
+        elif "refusal" in hits:
+            reason = "Refus détecté (refusal keyword)"
+        elif "fast_spam_subject" in subj_hits:
+            reason = "Spam évident"
+        elif exclude in hits:
+            reason = exclude_reason
+        elif include not in hits:
+            reason = include_reason
+        else:
+            keep.append(True)
+            reasons.append(ok_reason)
+            continue
+        keep.append(False)
+        reasons.append(reason)
+    
+    return keep, reasons
+
+def pre_filter_email_batch(senders, subjects, snippets) -> tuple:
+    """Version batch de pre_filter_email"""
+    senders = list(senders)
+    subjects = [s or "" for s in subjects]
+    snippets = [s or "" for s in snippets]
+    
+    text_hits = FILTER_KEYWORDS.scan_many(f"{subject} {snippet}" for subject, snippet in zip(subjects, snippets))
+    addresses = [split_sender_address(s) if s else None for s in senders]
+    prefix_hits = FILTER_KEYWORDS.scan_many(a[0] if a else "" for a in addresses)
+    domain_hits = FILTER_KEYWORDS.scan_many(a[1] if a else "" for a in addresses)
+    
+    keep, reasons = [], []
+    for sender, address, hits, p_hits, d_hits in zip(senders, addresses, text_hits, prefix_hits, domain_hits):
+        # CHECK 1 : expéditeur (même ordre que is_ignored_sender)
+        if not sender:
+            reason = "🤖 Expéditeur bloqué: Expéditeur vide"
+        elif address is None:
+            reason = "🤖 Expéditeur bloqué: Format email invalide"
+        elif "company_domain" in d_hits:
+            reason = f"🤖 Expéditeur bloqué: Domaine entreprise: {d_hits['company_domain']}"
+        elif "email_prefix" in p_hits:
+            reason = f"🤖 Expéditeur bloqué: Préfixe automatisé: {p_hits['email_prefix']}"
+        # CHECK 2-4 : succès, refus, mots-clés litige
+        elif "success" in hits:
+            reason = f"✅ Succès détecté (pour CRON): '{hits['success']}'"
+        elif "refusal" in hits:
+            reason = f"🚫 Refus détecté: '{hits['refusal']}'"
+        elif "required" not in hits:
+            reason = "❌ Aucun mot-clé litige trouvé"
+        else:
+            keep.append(True)
+            reasons.append(f"🎯 Mot-clé litige: '{hits['required']}'")
+            continue
+        keep.append(False)
+        reasons.append(reason)
+    
+    return keep, reasons
+
 def is_company_sender(sender):
     """Alias pour compatibilité - utilise le nouveau filtre strict"""
     is_ignored, reason = is_ignored_sender(sender)
@@ -5228,13 +7418,55 @@ ECOMMERCE_BLACKLIST = [
     "colis perdu", "lost package", "non reçu", "not received"
 ]
 
+# Newsletters / promos à ignorer dans le scan transport
+SCAN_NEWSLETTER_KEYWORDS = ["newsletter", "unsubscribe", "désinscri", "promo", "offre exclusive"]
+
+# Expéditeurs ignorés par l'Encaisseur (newsletters, pubs, e-commerce généraliste)
+REFUND_IGNORED_SENDERS = [
+    "airbnb", "uber", "ubereats", "deliveroo", "netflix", "spotify",
+    "amazon", "linkedin", "facebook", "twitter", "instagram",
+    "newsletter", "noreply", "no-reply", "marketing", "promo",
+    "jow", "yoojo", "leboncoin", "vinted", "cdiscount", "fnac",
+    "darty", "boulanger", "zalando", "asos", "shein", "temu",
+    "aliexpress", "wish", "ebay", "etsy", "paypal"
+]
+
+# ════════════════════════════════════════════════════════════════
+# 🔎 INDEX UNIQUE DES MOTS-CLÉS DE FILTRAGE (compilé à l'import)
+# ════════════════════════════════════════════════════════════════
+# ⚠️ Toute nouvelle liste de filtrage doit être déclarée ici pour être indexée.
+FILTER_KEYWORDS = KeywordIndex({
+    "spam_sender": BLACKLIST_SENDERS,
+    "spam_subject": BLACKLIST_SUBJECTS,
+    "spam_body": BLACKLIST_KEYWORDS,
+    "fast_spam_subject": FAST_SPAM_SUBJECT_KEYWORDS,
+    "travel_fast_include": TRAVEL_FAST_INCLUDE,
+    "travel_fast_exclude": TRAVEL_FAST_EXCLUDE,
+    "ecom_fast_include": ECOM_FAST_INCLUDE,
+    "ecom_fast_exclude": ECOM_FAST_EXCLUDE,
+    "required": REQUIRED_KEYWORDS,
+    "success": KEYWORDS_SUCCESS,
+    "voucher": VOUCHER_KEYWORDS,
+    "refusal": KEYWORDS_REFUSAL,
+    "invoice": INVOICE_KEYWORDS,
+    "dispute": DISPUTE_TRIGGERS,
+    "transport_strong": TRANSPORT_STRONG_KEYWORDS,
+    "transport": TRANSPORT_KEYWORDS,
+    "ecommerce_blacklist": ECOMMERCE_BLACKLIST,
+    "newsletter": SCAN_NEWSLETTER_KEYWORDS,
+    "refund_ignored_sender": REFUND_IGNORED_SENDERS,
+    "company_domain": BLACKLIST_COMPANY_DOMAINS,
+    "email_prefix": BLACKLIST_EMAIL_PREFIXES,
+    "own_notice": ["mise en demeure"],
+    "brand": ["justicio"],
+})
+
 def is_strong_transport(text: str) -> bool:
     """
     🚀 Vérifie si le texte contient un mot-clé TRANSPORT FORT.
     Si oui, on passe outre la blacklist e-commerce.
     """
-    text_lower = text.lower()
-    return any(kw in text_lower for kw in TRANSPORT_STRONG_KEYWORDS)
+    return "transport_strong" in FILTER_KEYWORDS.scan(text)
 
 def is_transport_email(subject: str, snippet: str, sender: str) -> bool:
     """
@@ -5246,26 +7478,134 @@ def is_transport_email(subject: str, snippet: str, sender: str) -> bool:
     3. Sinon, si TRANSPORT générique détecté → True
     4. Sinon → False
     """
-    blob = f"{subject or ''} {snippet or ''} {sender or ''}".lower()
+    hits = FILTER_KEYWORDS.scan(f"{subject or ''} {snippet or ''} {sender or ''}")
     
     # 🚀 PRIORITÉ 1: Transport FORT → On analyse toujours
-    if is_strong_transport(blob):
+    if "transport_strong" in hits:
         return True
     
     # 🚫 PRIORITÉ 2: E-commerce détecté (et pas de transport fort) → Rejeter
-    if any(kw in blob for kw in ECOMMERCE_BLACKLIST):
+    if "ecommerce_blacklist" in hits:
         return False
     
     # ✅ PRIORITÉ 3: Transport générique → Accepter
-    if any(kw in blob for kw in TRANSPORT_KEYWORDS):
+    if "transport" in hits:
         return True
     
     return False
 
-@app.route("/scan-all")
-def scan_all():
+# ════════════════════════════════════════════════════════════════
+# 📐 MOTEUR DE RÈGLES DE PRÉ-FILTRAGE (table déclarative)
+# ════════════════════════════════════════════════════════════════
+# Chaque règle : (id, décision, catégories requises, catégories interdites).
+# Une catégorie est une clé de FILTER_KEYWORDS, trouvée dans n'importe quel champ ;
+# préfixée "texte:" (sujet + snippet) ou "sender:" elle est limitée à ces champs.
+# La PREMIÈRE règle satisfaite décide → l'ordre de la table est la priorité.
+
+KEEP, SKIP = True, False
+
+TRANSPORT_PREFILTER_RULES = [
+    # 🚫 E-commerce (sauf transport fort)
+    ("ecommerce_blacklist", SKIP, ["ecommerce_blacklist"], ["transport_strong"]),
+    # Ni transport fort ni transport générique
+    ("not_transport", SKIP, [], ["transport_strong", "transport"]),
+    # Nos propres mises en demeure
+    ("own_notice", SKIP, ["own_notice", "brand"], []),
+    ("newsletter", SKIP, ["newsletter"], []),
+    # ✅ Vrai virement (sauf transport fort ou voucher → l'IA tranche)
+    ("resolved_success", SKIP, ["success"], ["transport_strong", "voucher"]),
+    # 📄 Facture normale sans litige
+    ("invoice_no_dispute", SKIP, ["texte:invoice"], ["texte:dispute", "transport_strong", "voucher"]),
+    ("strong_transport", KEEP, ["transport_strong"], []),
+    ("voucher", KEEP, ["voucher"], []),
+    ("transport", KEEP, [], []),
+]
+
+REFUND_PREFILTER_RULES = [
+    ("ignored_sender", SKIP, ["sender:refund_ignored_sender"], []),
+    ("financial", KEEP, [], []),
+]
+
+class PrefilterRules:
+    """
+    📐 Table de règles compilée une fois en frozensets.
+    L'évaluation = 3 passes FILTER_KEYWORDS (sujet, snippet, expéditeur)
+    puis des tests d'inclusion d'ensembles, sans aucune boucle sur les mots-clés.
+    """
+
+    def __init__(self, rules, default=(SKIP, "no_rule")):
+        self.rules = [
+            (rule_id, decision, frozenset(required), frozenset(forbidden))
+            for rule_id, decision, required, forbidden in rules
+        ]
+        self.default = default
+
+    @staticmethod
+    def facts(subject: str, snippet: str, sender: str) -> set:
+        """Catégories présentes dans l'email (globales + par champ)"""
+        text_hits = set(FILTER_KEYWORDS.scan(subject or ""))
+        text_hits.update(FILTER_KEYWORDS.scan(snippet or ""))
+        sender_hits = set(FILTER_KEYWORDS.scan(sender or ""))
+        facts = text_hits | sender_hits
+        facts.update("texte:" + cat for cat in text_hits)
+        facts.update("sender:" + cat for cat in sender_hits)
+        return facts
+
+    def evaluate(self, subject: str, snippet: str, sender: str) -> tuple:
+        """Retourne (garder: bool, id de la règle déclenchée)"""
+        facts = self.facts(subject, snippet, sender)
+        for rule_id, decision, required, forbidden in self.rules:
+            if required <= facts and forbidden.isdisjoint(facts):
+                return decision, rule_id
+        return self.default
+
+    def evaluate_many(self, emails) -> list:
+        """Évalue une liste de tuples (subject, snippet, sender) en un appel"""
+        return [self.evaluate(subject, snippet, sender) for subject, snippet, sender in emails]
+
+TRANSPORT_PREFILTER = PrefilterRules(TRANSPORT_PREFILTER_RULES)
+REFUND_PREFILTER = PrefilterRules(REFUND_PREFILTER_RULES)
+
+# ════════════════════════════════════════════════════════════════════════════════
+# 🧵 MOTEUR DE SCAN EN ARRIÈRE-PLAN (pool local + table scan_job)
+# ════════════════════════════════════════════════════════════════════════════════
+# Le scan (Gmail + IA) tourne dans un pool de threads : la requête HTTP rend la main
+# immédiatement et la page de progression interroge /scan-status/<job_id>.
+# La table scan_job porte l'état → lisible depuis n'importe quel worker gunicorn.
+
+SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS", "4"))
+SCAN_JOB_STALE_MINUTES = 15  # Job "running" sans mise à jour depuis X min → considéré mort
+# Job "queued" : l'attente dans SCAN_EXECUTOR est normale, seul un job perdu (redémarrage)
+# reste en file aussi longtemps → mesuré depuis created_at
+SCAN_JOB_QUEUED_STALE_MINUTES = int(os.environ.get("SCAN_JOB_QUEUED_STALE_MINUTES", "120"))
+SCAN_EXECUTOR = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="scan")
+SCAN_AI_CONCURRENCY = int(os.environ.get("SCAN_AI_CONCURRENCY", "8"))  # Appels IA simultanés par scan
+
+def _scan_job_update(job_id, **fields):
+    """Met à jour la ligne ScanJob (progression, résultats partiels) - ne crash jamais"""
+    try:
+        job = ScanJob.query.get(job_id)
+        if not job:
+            return
+        for key, value in fields.items():
+            setattr(job, key, value)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _dbg(f"⚠️ ScanJob {job_id[:8]}: mise à jour impossible - {str(e)[:60]}")
+
+def _scan_job_is_stale(job) -> bool:
+    """Vrai si le job est resté bloqué (worker tué, redéploiement...)"""
+    from datetime import timedelta
+    if job.status == "running" and job.updated_at:
+        return datetime.utcnow() - job.updated_at > timedelta(minutes=SCAN_JOB_STALE_MINUTES)
+    if job.status == "queued" and job.created_at:
+        return datetime.utcnow() - job.created_at > timedelta(minutes=SCAN_JOB_QUEUED_STALE_MINUTES)
+    return False
+
+def run_transport_scan(job_id, credentials, user_email, force_full=False):
     """
-    ✈️ SCAN TRANSPORT V2 - Train / Avion / VTC UNIQUEMENT
+    ✈️ SCAN TRANSPORT V2 - Train / Avion / VTC UNIQUEMENT (exécuté dans SCAN_EXECUTOR)
     
     ⚠️ PIVOT STRATÉGIQUE: Ce scan ne détecte QUE les litiges de transport passagers.
     Les litiges e-commerce sont gérés via /declare (déclaration manuelle).
@@ -5275,22 +7615,33 @@ def scan_all():
     - Exclusion stricte des termes e-commerce
     - Analyse IA uniquement via analyze_litigation_strict(scan_type="travel")
     - Anti-doublon: ignore les emails déjà traités en BDD
+    - Incrémental: si un checkpoint Gmail (user.gmail_history_id) existe, seuls les
+      messages arrivés depuis le dernier scan sont analysés (force_full pour forcer)
+    - Progression + litiges partiels écrits au fil de l'eau dans ScanJob
     """
-    if "credentials" not in session:
-        return redirect("/login")
-    
-    try:
-        creds = Credentials(**session["credentials"])
-        service = build('gmail', 'v1', credentials=creds)
-    except Exception as e:
-        DEBUG_LOGS.append(f"❌ Scan Transport: Erreur auth Gmail - {str(e)[:50]}")
-        return STYLE + f"""
-        <div style='text-align:center; padding:50px;'>
-            <h1 style='color:white;'>❌ Erreur d'authentification</h1>
-            <p style='color:rgba(255,255,255,0.7);'>{str(e)[:100]}</p>
-            <a href='/login' class='btn-success'>Se reconnecter</a>
-        </div>
-        """ + FOOTER
+    with app.app_context():
+        try:
+            # Sortie de file : réclamation atomique (le job a pu être déclaré mort entre-temps)
+            claimed = ScanJob.query.filter_by(id=job_id, status="queued").update(
+                {"status": "running", "phase": "Connexion à Gmail", "updated_at": datetime.utcnow()},
+                synchronize_session=False
+            )
+            db.session.commit()
+            if not claimed:
+                DEBUG_LOGS.append(f"⏭️ ScanJob {job_id[:8]}: plus en file, abandon")
+                return
+            _run_transport_scan(job_id, credentials, user_email, force_full)
+        except Exception as e:
+            db.session.rollback()
+            DEBUG_LOGS.append(f"❌ ScanJob {job_id[:8]}: {type(e).__name__}: {str(e)[:100]}")
+            _scan_job_update(job_id, status="error", error=f"{type(e).__name__}: {str(e)[:200]}",
+                             finished_at=datetime.utcnow())
+        finally:
+            db.session.remove()
+
+def _run_transport_scan(job_id, credentials, user_email, force_full):
+    creds = Credentials(**credentials)
+    service = build('gmail', 'v1', credentials=creds)
     
     # ════════════════════════════════════════════════════════════════
     # 🔒 ANTI-DOUBLON: Récupérer les IDs déjà en base pour cet utilisateur
@@ -5298,7 +7649,6 @@ def scan_all():
     existing_ids = set()
     existing_cases_count = 0
     try:
-        user_email = session.get('email', '')
         if user_email:
             existing_lits = Litigation.query.filter_by(user_email=user_email).all()
             existing_ids = {lit.message_id for lit in existing_lits if lit.message_id}
@@ -5307,6 +7657,22 @@ def scan_all():
     except Exception as e:
         DEBUG_LOGS.append(f"⚠️ Erreur récupération doublons: {str(e)[:50]}")
     
+    # ════════════════════════════════════════════════════════════════
+    # 🔄 CHECKPOINT INCRÉMENTAL: historyId Gmail du dernier scan complet
+    # ════════════════════════════════════════════════════════════════
+    scan_user = None
+    new_history_id = None
+    try:
+        if user_email:
+            scan_user = User.query.filter_by(email=user_email).first()
+        new_history_id = service.users().getProfile(userId='me').execute().get('historyId')
+    except Exception as e:
+        DEBUG_LOGS.append(f"⚠️ Checkpoint Gmail indisponible: {str(e)[:50]}")
+    
+    last_history_id = scan_user.gmail_history_id if scan_user else None
+    if force_full:
+        last_history_id = None
+    
     # ════════════════════════════════════════════════════════════════
     # 📅 Query Gmail TRANSPORT UNIQUEMENT sur 365 jours
     # ════════════════════════════════════════════════════════════════
@@ -5347,14 +7713,30 @@ def scan_all():
     
     DEBUG_LOGS.append(f"✈️ SCAN TRANSPORT lancé - Mode TRANSPORT UNIQUEMENT")
     
+    messages = None
+    scan_truncated = False
+    if last_history_id:
+        try:
+            added_ids, scan_truncated = gmail_list_added_since(service, last_history_id, max_results=150)
+            if added_ids is not None:
+                messages = [{'id': mid} for mid in added_ids]
+                DEBUG_LOGS.append(f"🔄 Scan incrémental depuis historyId {last_history_id}: {len(messages)} nouveau(x) email(s)")
+        except Exception as e:
+            DEBUG_LOGS.append(f"⚠️ Scan incrémental impossible, rescan complet: {str(e)[:50]}")
+    
     try:
-        results = service.users().messages().list(userId='me', q=query, maxResults=150).execute()
-        messages = results.get('messages', [])
+        if messages is None:
+            results = service.users().messages().list(userId='me', q=query, maxResults=150).execute()
+            messages = results.get('messages', [])
     except Exception as e:
         DEBUG_LOGS.append(f"❌ Scan Transport: Erreur liste Gmail - {str(e)[:50]}")
-        return STYLE + f"<h1 style='color:white;'>Erreur lecture Gmail : {str(e)[:100]}</h1><a href='/login'>Se reconnecter</a>" + FOOTER
+        _scan_job_update(job_id, status="error", error=f"Erreur lecture Gmail : {str(e)[:100]}",
+                         finished_at=datetime.utcnow())
+        return
     
     print(f"📧 {len(messages)} emails transport trouvés")
+    _scan_job_update(job_id, phase="Filtrage des emails", emails_total=len(messages),
+                     existing_cases_count=existing_cases_count)
     
     # ════════════════════════════════════════════════════════════════
     # 🔄 Analyse des emails TRANSPORT
@@ -5369,20 +7751,30 @@ def scan_all():
     ai_calls = 0
     MAX_AI_CALLS = 40
     
+    # ════════════════════════════════════════════════════════════════
+    # 🔒 ANTI-DOUBLON: Ignorer si déjà en base (avant tout appel Gmail)
+    # ════════════════════════════════════════════════════════════════
+    pending_ids = []
     for msg in messages:
+        if msg['id'] in existing_ids:
+            emails_skipped_existing += 1
+            DEBUG_LOGS.append(f"⏩ Doublon ignoré (déjà en BDD): {msg['id'][:12]}...")
+            continue
+        pending_ids.append(msg['id'])
+    
+    # ════════════════════════════════════════════════════════════════
+    # 📦 ÉTAPE 1 : Metadata par lots (Batch HTTP) + filtrage local
+    # Les résultats arrivent lot par lot, dans l'ordre des messages
+    # ════════════════════════════════════════════════════════════════
+    candidates = []
+    
+    for msg_id, msg_data in gmail_batch_get(service, pending_ids, fmt='metadata',
+                                            metadata_headers=['Subject', 'From', 'To']):
         try:
-            # ════════════════════════════════════════════════════════════════
-            # 🔒 ANTI-DOUBLON: Ignorer si déjà en base
-            # ════════════════════════════════════════════════════════════════
-            if msg['id'] in existing_ids:
-                emails_skipped_existing += 1
-                DEBUG_LOGS.append(f"⏩ Doublon ignoré (déjà en BDD): {msg['id'][:12]}...")
+            if msg_data is None:
+                emails_errors += 1
                 continue
             
-            # Récupérer metadata (Subject, From, To, snippet)
-            msg_data = service.users().messages().get(userId='me', id=msg['id'], format='metadata',
-                                                       metadataHeaders=['Subject', 'From', 'To']).execute()
-            
             headers = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
             subject = headers.get('Subject', '')
             sender = headers.get('From', '')
@@ -5390,86 +7782,98 @@ def scan_all():
             snippet = msg_data.get('snippet', '')
             
             emails_scanned += 1
+            if emails_scanned % 10 == 0:
+                _scan_job_update(job_id, emails_scanned=emails_scanned)
             
             # ════════════════════════════════════════════════════════════════
             # 🛡️ FILTRAGE LOCAL (GRATUIT) - LOGIQUE AMÉLIORÉE
             # ════════════════════════════════════════════════════════════════
             
-            blob = f"{subject} {snippet} {sender}".lower()
-            
-            # 🚀 PRIORITÉ 1: Vérifier si TRANSPORT FORT (SNCF, Air France, etc.)
-            # Si oui, on passe outre TOUTE la blacklist e-commerce
-            is_strong = is_strong_transport(blob)
+            # Table TRANSPORT_PREFILTER_RULES : transport fort > blacklist e-commerce >
+            # transport générique > propres MED > newsletters > succès > factures
+            keep, rule = TRANSPORT_PREFILTER.evaluate(subject, snippet, sender)
             
-            if is_strong:
-                DEBUG_LOGS.append(f"🚀 Transport FORT détecté: {subject[:40]}...")
-            else:
-                # 🚫 BLOCAGE E-COMMERCE - Seulement si PAS de transport fort
-                if any(kw in blob for kw in ECOMMERCE_BLACKLIST):
+            if not keep:
+                if rule == "ecommerce_blacklist":
                     emails_skipped_ecommerce += 1
                     DEBUG_LOGS.append(f"🚫 E-commerce ignoré: {subject[:40]}...")
-                    continue
-                
-                # Vérifier que c'est bien du transport (générique)
-                if not is_transport_email(subject, snippet, sender):
-                    emails_skipped += 1
-                    continue
-            
-            # Ignorer nos propres mises en demeure
-            if "mise en demeure" in blob and "justicio" in blob:
-                emails_skipped += 1
-                continue
-            
-            # Ignorer newsletters/promos
-            if any(kw in blob for kw in ["newsletter", "unsubscribe", "désinscri", "promo", "offre exclusive"]):
-                emails_skipped += 1
-                continue
-            
-            # ════════════════════════════════════════════════════════════════
-            # 🎫 DÉTECTION VOUCHER/AVOIR - PRIORITÉ ABSOLUE
-            # Si l'email contient des mots de voucher → TOUJOURS envoyer à l'IA
-            # ════════════════════════════════════════════════════════════════
-            has_voucher_keywords = any(kw in blob for kw in VOUCHER_KEYWORDS)
-            
-            if has_voucher_keywords and is_strong:
-                DEBUG_LOGS.append(f"🎫 VOUCHER + Transport détecté → Envoi à l'IA: {subject[:40]}...")
-            
-            # ⚠️ Ignorer SUCCESS (vrai virement) - SAUF SI :
-            # - Transport fort détecté
-            # - OU mots-clés voucher détectés (compensation, bon d'achat, etc.)
-            if any(kw in blob for kw in KEYWORDS_SUCCESS):
-                if is_strong or has_voucher_keywords:
-                    # Transport fort OU voucher → On analyse quand même
-                    DEBUG_LOGS.append(f"🔍 Succès apparent mais transport/voucher → Envoi à l'IA: {subject[:40]}...")
                 else:
-                    # Vrai succès sans transport fort ni voucher → Skip
                     emails_skipped += 1
-                    DEBUG_LOGS.append(f"✅ Vrai virement détecté, skip: {subject[:40]}...")
-                    continue
-            
-            # Ignorer factures normales sans litige (sauf si transport fort OU voucher)
-            if not is_strong and not has_voucher_keywords and is_invoice_without_dispute(subject, snippet):
-                emails_skipped += 1
+                    if rule == "resolved_success":
+                        DEBUG_LOGS.append(f"✅ Vrai virement détecté, skip: {subject[:40]}...")
                 continue
             
-            # ════════════════════════════════════════════════════════════════
-            # 🤖 ANALYSE IA TRANSPORT (si quota pas atteint)
-            # ════════════════════════════════════════════════════════════════
+            if rule == "strong_transport":
+                DEBUG_LOGS.append(f"🚀 Transport FORT détecté: {subject[:40]}...")
+            elif rule == "voucher":
+                DEBUG_LOGS.append(f"🎫 VOUCHER détecté → Envoi à l'IA: {subject[:40]}...")
             
-            if ai_calls >= MAX_AI_CALLS:
+            # Quota IA : on ne retient pas plus de MAX_AI_CALLS candidats
+            if len(candidates) >= MAX_AI_CALLS:
                 DEBUG_LOGS.append(f"⚠️ Quota IA atteint ({MAX_AI_CALLS}), arrêt")
+                scan_truncated = True
                 break
             
-            # Récupérer le corps complet
-            try:
-                full_msg = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-                body_text = safe_extract_body_text(full_msg)
-            except:
-                body_text = snippet
-            
-            # Appeler l'IA - UNIQUEMENT analyze_litigation_strict en mode TRAVEL
+            candidates.append({
+                "message_id": msg_id,
+                "subject": subject,
+                "sender": sender,
+                "to_field": to_field,
+                "snippet": snippet,
+            })
+        
+        except Exception as e:
+            emails_errors += 1
+            tb_str = traceback.format_exc()[:600]
+            DEBUG_LOGS.append(f"❌ Erreur email {msg_id[:8]}: {type(e).__name__}: {str(e)[:100]}")
+            DEBUG_LOGS.append(f"   📋 Traceback: {tb_str}")
+            continue
+    
+    # ════════════════════════════════════════════════════════════════
+    # 📦 ÉTAPE 2 : Corps complets des candidats par lots (Batch HTTP)
+    # ════════════════════════════════════════════════════════════════
+    _scan_job_update(job_id, phase="Lecture des emails candidats",
+                     emails_scanned=emails_scanned, ai_total=len(candidates))
+    full_bodies = {}
+    for msg_id, full_msg in gmail_batch_get(service, [c["message_id"] for c in candidates], fmt='full'):
+        try:
+            full_bodies[msg_id] = safe_extract_body_text(full_msg) if full_msg else None
+        except:
+            full_bodies[msg_id] = None
+    
+    # ════════════════════════════════════════════════════════════════
+    # 🤖 ÉTAPE 3 : ANALYSE IA TRANSPORT
+    # Appels lancés en parallèle (SCAN_AI_CONCURRENCY max), résultats consommés
+    # dans l'ordre des messages → anti-doublon et affichage déterministes
+    # ════════════════════════════════════════════════════════════════
+    _scan_job_update(job_id, phase="Analyse juridique IA")
+    ai_pool = ThreadPoolExecutor(max_workers=max(1, min(SCAN_AI_CONCURRENCY, len(candidates) or 1)),
+                                 thread_name_prefix="scan-ai")
+    # Appeler l'IA - UNIQUEMENT analyze_litigation_strict en mode TRAVEL
+    # (par lots de STRICT_BATCH_SIZE emails par requête)
+    batch_size = max(1, STRICT_BATCH_SIZE)
+    ai_futures = {}
+    for start in range(0, len(candidates), batch_size):
+        chunk = [{
+            "message_id": cand["message_id"],
+            "text": full_bodies.get(cand["message_id"]) or cand["snippet"],
+            "subject": cand["subject"],
+            "sender": cand["sender"],
+            "to_field": cand["to_field"],
+        } for cand in candidates[start:start + batch_size]]
+        future = ai_pool.submit(call_in_app_context, analyze_litigation_strict_batch, chunk, scan_type="travel")
+        for email in chunk:
+            ai_futures[email["message_id"]] = future
+    
+    for cand in candidates:
+        msg_id = cand["message_id"]
+        subject = cand["subject"]
+        sender = cand["sender"]
+        to_field = cand["to_field"]
+        try:
             ai_calls += 1
-            result = analyze_litigation_strict(body_text, subject, sender, to_field, scan_type="travel")
+            result = ai_futures[msg_id].result()[msg_id]
+            _scan_job_update(job_id, ai_calls=ai_calls)
             
             # Vérifier si litige TRANSPORT détecté
             if result.get("is_valid") and result.get("litige"):
@@ -5485,7 +7889,7 @@ def scan_all():
                 # Éviter les doublons
                 is_duplicate = False
                 for existing in detected_litigations:
-                    if existing.get('message_id') == msg['id']:
+                    if existing.get('message_id') == msg_id:
                         is_duplicate = True
                         break
                     if existing.get('company', '').lower() == result.get('company', '').lower() and \
@@ -5499,12 +7903,14 @@ def scan_all():
                         "amount": result.get("amount", "À compléter"),
                         "law": result.get("law", "Règlement CE 261/2004"),
                         "proof": result.get("proof", subject[:100]),
-                        "message_id": msg['id'],
+                        "message_id": msg_id,
                         "category": "travel",  # Toujours travel
                         "sender": sender,
                         "to_field": to_field
                     })
                     DEBUG_LOGS.append(f"✅ LITIGE TRANSPORT: {result.get('company')} - {result.get('amount')}")
+                    # Litiges partiels visibles immédiatement via /scan-status
+                    _scan_job_update(job_id, results_json=json.dumps(detected_litigations, ensure_ascii=False))
             else:
                 # 🔍 DEBUG: Logger les rejets IA pour comprendre pourquoi
                 reason = result.get('reason', 'Pas de motif fourni')
@@ -5522,15 +7928,26 @@ def scan_all():
         except Exception as e:
             emails_errors += 1
             tb_str = traceback.format_exc()[:600]
-            DEBUG_LOGS.append(f"❌ Erreur email {msg.get('id', '?')[:8]}: {type(e).__name__}: {str(e)[:100]}")
+            DEBUG_LOGS.append(f"❌ Erreur email {msg_id[:8]}: {type(e).__name__}: {str(e)[:100]}")
             DEBUG_LOGS.append(f"   📋 Traceback: {tb_str}")
             continue
+    ai_pool.shutdown(wait=False)
     
     # ════════════════════════════════════════════════════════════════
-    # 💾 Stocker en session
+    # 🔄 Avancer le checkpoint Gmail
+    # Les litiges détectés non payés ne vivent qu'en session : tant qu'il en reste
+    # (ou si le scan a été tronqué), on efface le checkpoint → prochain scan complet.
     # ════════════════════════════════════════════════════════════════
-    
-    session['detected_litigations'] = detected_litigations
+    if scan_user:
+        try:
+            if new_history_id and not detected_litigations and not scan_truncated:
+                scan_user.gmail_history_id = str(new_history_id)
+            else:
+                scan_user.gmail_history_id = None
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            DEBUG_LOGS.append(f"⚠️ Checkpoint Gmail non sauvegardé: {str(e)[:50]}")
     
     # Calculer le gain total
     total_gain = 0
@@ -5538,8 +7955,6 @@ def scan_all():
         if is_valid_euro_amount(lit.get('amount', '')):
             total_gain += extract_numeric_amount(lit['amount'])
     
-    session['total_gain'] = total_gain
-    
     new_cases_count = len(detected_litigations)
     
     print(f"\n📊 RÉSUMÉ SCAN TRANSPORT")
@@ -5552,6 +7967,19 @@ def scan_all():
     print(f"   Litiges transport détectés: {new_cases_count}")
     print(f"   Gain potentiel: {total_gain}€")
     
+    # ════════════════════════════════════════════════════════════════
+    # 💾 Résultat final dans ScanJob (copié en session par /scan-results)
+    # ════════════════════════════════════════════════════════════════
+    _scan_job_update(job_id, status="done", phase="Terminé",
+                     emails_scanned=emails_scanned, ai_calls=ai_calls,
+                     results_json=json.dumps(detected_litigations, ensure_ascii=False),
+                     total_gain=total_gain, finished_at=datetime.utcnow())
+
+
+def render_transport_scan_results(detected_litigations, total_gain, existing_cases_count):
+    """🎨 Page résultat du SCAN TRANSPORT (rendue depuis un ScanJob terminé)"""
+    new_cases_count = len(detected_litigations)
+    
     # ════════════════════════════════════════════════════════════════
     # 🎨 Générer l'interface résultat TRANSPORT - DESIGN V2 "TICKET DE VOL"
     # ════════════════════════════════════════════════════════════════
@@ -5846,31 +8274,219 @@ def scan_all():
                     </a>
                 </div>
                 
-                <div style='margin-top:25px;'>
-                    <a href='/' style='color:rgba(255,255,255,0.4); font-size:0.85rem; text-decoration:none;'>← Retour à l'accueil</a>
-                </div>
-            </div>
-            """ + FOOTER
-        
-        # Cas 2: Aucun dossier existant, vraiment rien trouvé
-        else:
-            return STYLE + f"""
-            <div style='text-align:center; padding:50px 20px;'>
-                <div style='font-size:4rem; margin-bottom:20px;'>😊</div>
-                <h1 style='color:white; font-size:1.6rem;'>Bonne nouvelle !</h1>
-                <p style='color:rgba(255,255,255,0.7); font-size:1.1rem; max-width:400px; margin:15px auto;'>
-                    Aucun litige de transport détecté dans vos emails.
-                </p>
-                <p style='color:rgba(255,255,255,0.5); font-size:0.9rem;'>
-                    Vous n'avez pas eu de problème récemment 👍
-                </p>
-                <br>
-                <div style='display:flex; gap:15px; justify-content:center; flex-wrap:wrap;'>
-                    <a href='/' class='btn-success'>Retour à l'accueil</a>
-                    <a href='/declare' class='btn-success' style='background:#a78bfa;'>📦 Déclarer un litige</a>
-                </div>
-            </div>
-            """ + FOOTER
+                <div style='margin-top:25px;'>
+                    <a href='/' style='color:rgba(255,255,255,0.4); font-size:0.85rem; text-decoration:none;'>← Retour à l'accueil</a>
+                </div>
+            </div>
+            """ + FOOTER
+        
+        # Cas 2: Aucun dossier existant, vraiment rien trouvé
+        else:
+            return STYLE + f"""
+            <div style='text-align:center; padding:50px 20px;'>
+                <div style='font-size:4rem; margin-bottom:20px;'>😊</div>
+                <h1 style='color:white; font-size:1.6rem;'>Bonne nouvelle !</h1>
+                <p style='color:rgba(255,255,255,0.7); font-size:1.1rem; max-width:400px; margin:15px auto;'>
+                    Aucun litige de transport détecté dans vos emails.
+                </p>
+                <p style='color:rgba(255,255,255,0.5); font-size:0.9rem;'>
+                    Vous n'avez pas eu de problème récemment 👍
+                </p>
+                <br>
+                <div style='display:flex; gap:15px; justify-content:center; flex-wrap:wrap;'>
+                    <a href='/' class='btn-success'>Retour à l'accueil</a>
+                    <a href='/declare' class='btn-success' style='background:#a78bfa;'>📦 Déclarer un litige</a>
+                </div>
+            </div>
+            """ + FOOTER
+
+
+@app.route("/scan-all")
+def scan_all():
+    """
+    ✈️ SCAN TRANSPORT - Lance le scan en arrière-plan et redirige vers la progression.
+    Un scan déjà en cours pour l'utilisateur est repris au lieu d'en lancer un second.
+    ?full=1 force un rescan complet (ignore le checkpoint incrémental).
+    """
+    if "credentials" not in session:
+        return redirect("/login")
+    
+    try:
+        Credentials(**session["credentials"])
+    except Exception as e:
+        DEBUG_LOGS.append(f"❌ Scan Transport: Erreur auth Gmail - {str(e)[:50]}")
+        return STYLE + f"""
+        <div style='text-align:center; padding:50px;'>
+            <h1 style='color:white;'>❌ Erreur d'authentification</h1>
+            <p style='color:rgba(255,255,255,0.7);'>{str(e)[:100]}</p>
+            <a href='/login' class='btn-success'>Se reconnecter</a>
+        </div>
+        """ + FOOTER
+    
+    user_email = session.get('email', '')
+    
+    active_jobs = ScanJob.query.filter(
+        ScanJob.user_email == user_email,
+        ScanJob.status.in_(["queued", "running"])
+    ).order_by(ScanJob.created_at.desc()).all()
+    for active in active_jobs:
+        if _scan_job_is_stale(active):
+            active.status = "error"
+            active.error = "Scan interrompu (serveur redémarré)"
+        else:
+            return redirect(f"/scan-progress/{active.id}")
+    
+    job = ScanJob(id=uuid.uuid4().hex, user_email=user_email, status="queued", phase="En file d'attente")
+    db.session.add(job)
+    db.session.commit()
+    
+    SCAN_EXECUTOR.submit(run_transport_scan, job.id, dict(session["credentials"]), user_email,
+                         request.args.get('full') == '1')
+    DEBUG_LOGS.append(f"✈️ ScanJob {job.id[:8]} mis en file pour {user_email}")
+    
+    return redirect(f"/scan-progress/{job.id}")
+
+@app.route("/scan-status/<job_id>")
+def scan_status(job_id):
+    """📡 Progression JSON d'un scan (interrogée par /scan-progress)"""
+    if "email" not in session:
+        return jsonify({"error": "Non authentifié"}), 401
+    
+    job = ScanJob.query.get(job_id)
+    if not job or job.user_email != session['email']:
+        return jsonify({"error": "Scan introuvable"}), 404
+    
+    if _scan_job_is_stale(job):
+        job.status = "error"
+        job.error = "Scan interrompu (serveur redémarré)"
+        db.session.commit()
+    
+    try:
+        litigations = json.loads(job.results_json or "[]")
+    except Exception:
+        litigations = []
+    
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "phase": job.phase,
+        "emails_total": job.emails_total or 0,
+        "emails_scanned": job.emails_scanned or 0,
+        "ai_total": job.ai_total or 0,
+        "ai_calls": job.ai_calls or 0,
+        "litigations": [
+            {"company": lit.get("company"), "amount": lit.get("amount"), "proof": (lit.get("proof") or "")[:80]}
+            for lit in litigations
+        ],
+        "total_gain": job.total_gain or 0,
+        "error": job.error,
+    }), 200
+
+@app.route("/scan-progress/<job_id>")
+def scan_progress(job_id):
+    """⏳ Page d'attente : progression + litiges trouvés au fil de l'eau"""
+    if "email" not in session:
+        return redirect("/login")
+    
+    job = ScanJob.query.get(job_id)
+    if not job or job.user_email != session['email']:
+        return redirect("/scan-all")
+    
+    return STYLE + f"""
+    <div style='text-align:center; padding:40px 20px;'>
+        <div style='font-size:4rem; margin-bottom:15px;'>🔍</div>
+        <h1 style='color:white; font-size:1.6rem;'>Analyse de vos emails en cours...</h1>
+        <p id='scan-phase' style='color:rgba(255,255,255,0.7); font-size:1rem;'>{job.phase or "En file d'attente"}</p>
+        
+        <div style='max-width:400px; margin:25px auto; background:rgba(255,255,255,0.1); border-radius:10px; overflow:hidden;'>
+            <div id='scan-bar' style='width:3%; height:12px; background:linear-gradient(90deg, #10b981, #fbbf24); transition:width 0.5s;'></div>
+        </div>
+        <p id='scan-counters' style='color:rgba(255,255,255,0.5); font-size:0.85rem;'></p>
+        
+        <div id='scan-found' style='max-width:450px; margin:25px auto; text-align:left;'></div>
+        <p id='scan-error' style='color:#fca5a5; display:none;'></p>
+    </div>
+    
+    <script>
+    (function() {{
+        const jobId = {json.dumps(job.id)};
+        function esc(s) {{
+            const d = document.createElement('div');
+            d.textContent = s == null ? '' : String(s);
+            return d.innerHTML;
+        }}
+        function poll() {{
+            fetch('/scan-status/' + jobId)
+            .then(r => r.json())
+            .then(data => {{
+                if (data.error && data.status !== 'error') {{ return; }}
+                document.getElementById('scan-phase').textContent = data.phase || '';
+                
+                let pct = 3;
+                if (data.emails_total > 0) pct = 5 + 45 * data.emails_scanned / data.emails_total;
+                if (data.ai_total > 0) pct = 50 + 48 * data.ai_calls / data.ai_total;
+                if (data.status === 'done') pct = 100;
+                document.getElementById('scan-bar').style.width = Math.min(pct, 100) + '%';
+                document.getElementById('scan-counters').textContent =
+                    data.emails_scanned + '/' + data.emails_total + ' emails lus • ' +
+                    data.ai_calls + '/' + data.ai_total + ' analyses IA';
+                
+                document.getElementById('scan-found').innerHTML = (data.litigations || []).map(lit =>
+                    "<div style='background:rgba(16,185,129,0.15); border:1px solid rgba(16,185,129,0.4); " +
+                    "border-radius:12px; padding:12px 15px; margin-bottom:10px; color:white;'>" +
+                    "🎯 <b>" + esc(lit.company) + "</b> — <span style='color:#10b981;'>" + esc(lit.amount) + "</span>" +
+                    "<div style='color:rgba(255,255,255,0.6); font-size:0.85rem;'>" + esc(lit.proof) + "</div></div>"
+                ).join('');
+                
+                if (data.status === 'done') {{
+                    window.location.href = '/scan-results/' + jobId;
+                }} else if (data.status === 'error') {{
+                    const el = document.getElementById('scan-error');
+                    el.style.display = 'block';
+                    el.innerHTML = '❌ ' + esc(data.error) + "<br><br><a href='/scan-all' class='btn-success'>Relancer le scan</a>";
+                }} else {{
+                    setTimeout(poll, 1500);
+                }}
+            }})
+            .catch(() => setTimeout(poll, 3000));
+        }}
+        poll();
+    }})();
+    </script>
+    """ + FOOTER
+
+@app.route("/scan-results/<job_id>")
+def scan_results(job_id):
+    """🎯 Résultat d'un scan terminé - copie les litiges en session (paiement)"""
+    if "email" not in session:
+        return redirect("/login")
+    
+    job = ScanJob.query.get(job_id)
+    if not job or job.user_email != session['email']:
+        return redirect("/scan-all")
+    
+    if job.status in ("queued", "running"):
+        return redirect(f"/scan-progress/{job.id}")
+    
+    if job.status == "error":
+        from html import escape
+        return STYLE + f"<h1 style='color:white;'>Erreur scan : {escape((job.error or '')[:100])}</h1><a href='/login'>Se reconnecter</a>" + FOOTER
+    
+    # Copie en session une seule fois (les montants édités ensuite restent en session)
+    if session.get('scan_job_id') != job.id:
+        try:
+            session['detected_litigations'] = json.loads(job.results_json or "[]")
+        except Exception:
+            session['detected_litigations'] = []
+        session['total_gain'] = job.total_gain or 0
+        session['scan_job_id'] = job.id
+    
+    return render_transport_scan_results(
+        session.get('detected_litigations', []),
+        session.get('total_gain', 0),
+        job.existing_cases_count or 0
+    )
+
 # ========================================
 # MISE À JOUR MONTANT EN SESSION (avant paiement)
 # ========================================
@@ -5935,6 +8551,8 @@ def reset_scan():
         try:
             # Méthode bulk delete (plus efficace)
             deleted_count = Litigation.query.filter_by(user_email=user_email).delete()
+            # Le prochain scan doit repartir de zéro (pas d'incrémental)
+            User.query.filter_by(email=user_email).update({"gmail_history_id": None})
             db.session.commit()
             
             print(f"🗑️ HARD RESET: {deleted_count} litige(s) supprimé(s) de la BDD pour {user_email}")
@@ -5989,6 +8607,11 @@ def dashboard():
     if "credentials" not in session:
         return redirect("/login")
     
+    # Traitement post-paiement interrompu (redéploiement) → relancé
+    resume_user_litigation_jobs(session['email'])
+    # Recherche Détective perdue (redéploiement) → saisie manuelle de l'email
+    expire_stale_detective_jobs(session['email'])
+    
     cases = Litigation.query.filter_by(user_email=session['email']).order_by(Litigation.created_at.desc()).all()
     
     # Stats rapides
@@ -5997,6 +8620,7 @@ def dashboard():
     total_en_cours = sum(1 for c in cases if c.status in ["En attente de remboursement", "En cours juridique", "Envoyé"])
     
     html_rows = ""
+    any_detective_pending = False
     for case in cases:
         # ════════════════════════════════════════════════════════════════
         # GESTION DES STATUTS
@@ -6067,6 +8691,12 @@ def dashboard():
         if case.created_at:
             date_str = case.created_at.strftime("%d/%m")
         
+        # Détective en arrière-plan
+        detective_line = ""
+        if is_detective_pending(case):
+            any_detective_pending = True
+            detective_line = "<div style='font-size:0.75rem; color:#6366f1; margin-bottom:5px;'>🕵️ Recherche du contact marchand…</div>"
+        
         html_rows += f"""
         <div class="case-card" style='
             background: white;
@@ -6094,6 +8724,7 @@ def dashboard():
                 <div style='font-size:0.85rem; color:#64748b; margin-bottom:5px;'>
                     {case.subject[:45]}...
                 </div>
+                {detective_line}
                 <div style='font-size:0.75rem; color:#94a3b8;'>
                     📅 {date_str}
                 </div>
@@ -6156,7 +8787,10 @@ def dashboard():
         </div>
         """
     
-    return STYLE + f"""
+    # Rafraîchissement auto tant qu'un Détective tourne en arrière-plan
+    auto_refresh = "<meta http-equiv='refresh' content='8'>" if any_detective_pending else ""
+    
+    return STYLE + auto_refresh + f"""
     <div style='max-width:600px; margin:0 auto; padding-bottom:100px;'>
         <div style='text-align:center; margin-bottom:30px;'>
             <h1 style='
@@ -6880,19 +9514,12 @@ def submit_litige():
             detective_status = "annuaire"
             DEBUG_LOGS.append(f"📚 Email trouvé dans LEGAL_DIRECTORY: {merchant_result['email']}")
         
-        # ÉTAPE 2 : Si pas trouvé dans l'annuaire, lancer l'Agent Détective
+        # ÉTAPE 2 : Si pas trouvé dans l'annuaire, Agent Détective EN ARRIÈRE-PLAN
+        # (la page répond tout de suite ; le job enverra la mise en demeure)
         if not merchant_result["email"] and url_site:
-            DEBUG_LOGS.append(f"🕵️ Pas dans l'annuaire, lancement Agent Détective pour {url_site}")
-            detective_result = find_merchant_email(url_site)
-            
-            if detective_result.get("email"):
-                merchant_result["email"] = detective_result["email"]
-                merchant_result["source"] = detective_result.get("source", "Scraping web")
-                detective_status = "succes"
-                DEBUG_LOGS.append(f"🕵️ ✅ Email trouvé par le Détective: {merchant_result['email']}")
-            else:
-                detective_status = "echec"
-                DEBUG_LOGS.append(f"🕵️ ❌ Aucun email trouvé")
+            DEBUG_LOGS.append(f"🕵️ Pas dans l'annuaire, Agent Détective en arrière-plan pour {url_site}")
+            start_detective_job(new_case.id, url_site, "🕵️ DÉTECTIVE - LITIGE MANUEL")
+            detective_status = "en_cours"
         
         # Sauvegarder l'email trouvé dans le dossier
         if merchant_result["email"]:
@@ -6939,6 +9566,8 @@ def submit_litige():
                 </p>
             </div>
             """
+        elif detective_status == "en_cours":
+            detective_html = DETECTIVE_PENDING_HTML
         
         # ════════════════════════════════════════════════════════════════
         # ⚖️ AGENT AVOCAT - Envoi automatique de la mise en demeure (V4)
@@ -7000,6 +9629,8 @@ def submit_litige():
                 detective_notif += "\n⚖️ MISE EN DEMEURE ENVOYÉE ✅"
             else:
                 detective_notif += f"\n⚖️ Envoi différé: {legal_notice_result['message']}"
+        elif detective_status == "en_cours":
+            detective_notif = "\n\n🕵️ Détective en cours (résultat dans une notification séparée)"
         else:
             detective_notif = "\n\n🕵️ Email non trouvé (recherche manuelle requise)"
         
@@ -7014,6 +9645,10 @@ def submit_litige():
             success_title = "Procédure lancée !"
             success_icon = "⚡"
             success_subtitle = "L'envoi de la mise en demeure est en préparation."
+        elif detective_status == "en_cours":
+            success_title = "Dossier créé !"
+            success_icon = "🕵️"
+            success_subtitle = "Recherche du contact marchand en cours : la mise en demeure partira automatiquement."
         else:
             success_title = "Dossier créé !"
             success_icon = "📋"
@@ -7428,7 +10063,7 @@ def setup_payment():
 
 @app.route("/success")
 def success_page():
-    """Page de succès - ENREGISTRE les litiges en base ET envoie les mises en demeure"""
+    """Page de succès - lance le traitement des litiges (LitigationJob) qui enregistre et envoie les mises en demeure"""
     if "email" not in session:
         return redirect("/login")
     
@@ -7517,18 +10152,10 @@ def success_page():
             detective_status = "non_lance"
             
             if url_site:
-                DEBUG_LOGS.append(f"🕵️ Callback: Lancement Agent Détective pour {url_site}")
-                merchant_result = find_merchant_email(url_site)
-                
-                if merchant_result["email"]:
-                    new_case.merchant_email = merchant_result["email"]
-                    new_case.merchant_email_source = merchant_result["source"]
-                    db.session.commit()
-                    detective_status = "succes"
-                    DEBUG_LOGS.append(f"🕵️ Callback: ✅ Email trouvé: {merchant_result['email']}")
-                else:
-                    detective_status = "echec"
-                    DEBUG_LOGS.append("🕵️ Callback: ❌ Aucun email trouvé")
+                # En arrière-plan : le job écrit l'email puis envoie la mise en demeure
+                DEBUG_LOGS.append(f"🕵️ Callback: Agent Détective en arrière-plan pour {url_site}")
+                start_detective_job(new_case.id, url_site, "🕵️ DÉTECTIVE - LITIGE MANUEL (post-paiement)")
+                detective_status = "en_cours"
             
             # ═══════════════════════════════════════════════════════════════
             # ⚖️ AGENT AVOCAT
@@ -7554,6 +10181,8 @@ def success_page():
                 detective_notif = f"\n\n🕵️ EMAIL: {merchant_result['email']}"
                 if legal_notice_result["success"]:
                     detective_notif += "\n⚖️ MISE EN DEMEURE ENVOYÉE ✅"
+            elif detective_status == "en_cours":
+                detective_notif = "\n\n🕵️ Détective en cours"
             else:
                 detective_notif = "\n\n🕵️ Email non trouvé"
             
@@ -7593,6 +10222,8 @@ def success_page():
                     </p>
                 </div>
                 """
+            elif detective_status == "en_cours":
+                detective_html = DETECTIVE_PENDING_HTML
             
             legal_html = ""
             if legal_notice_result["success"]:
@@ -7616,6 +10247,10 @@ def success_page():
                 success_icon = "⚡"
                 success_title = "Procédure lancée !"
                 success_subtitle = "L'envoi est en préparation."
+            elif detective_status == "en_cours":
+                success_icon = "🕵️"
+                success_title = "Dossier créé !"
+                success_subtitle = "Recherche du contact marchand en cours : la mise en demeure partira automatiquement."
             else:
                 success_icon = "📋"
                 success_title = "Dossier créé !"
@@ -7726,23 +10361,38 @@ def success_page():
         valid_litigations.append(lit_data)
     
     # ════════════════════════════════════════════════════════════════
-    # 🚀 TRAITEMENT AVEC AGENTS (GPT + GMAIL)
+    # 🚀 TRAITEMENT AVEC AGENTS (GPT + SMTP) - EN ARRIÈRE-PLAN
     # ════════════════════════════════════════════════════════════════
     
-    if valid_litigations:
-        result = process_pending_litigations(user, valid_litigations)
-        sent_count = result["sent"]
-        errors = pre_errors + result["errors"]
-        details = result["details"]
-    else:
-        sent_count = 0
-        errors = pre_errors
-        details = []
-    
     # Vider la session
     session.pop('detected_litigations', None)
     session.pop('total_gain', None)
     
+    if not valid_litigations:
+        return render_litigation_report(0, pre_errors, [], had_valid=False)
+    
+    # Étape 1 en synchrone : les dossiers payés sont en base AVANT le passage au worker
+    litigation_ids, insert_errors = insert_pending_litigations(user, valid_litigations)
+    pre_errors += insert_errors
+    if not litigation_ids:
+        return render_litigation_report(0, pre_errors, [], had_valid=False)
+    
+    job = LitigationJob(id=uuid.uuid4().hex, user_email=user.email, status="queued",
+                        phase="En file d'attente", total=len(litigation_ids),
+                        payload_json=json.dumps(litigation_ids),
+                        errors_json=json.dumps(pre_errors, ensure_ascii=False))
+    db.session.add(job)
+    db.session.commit()
+    
+    LITIGATION_EXECUTOR.submit(run_litigation_job, job.id, user.email, litigation_ids)
+    DEBUG_LOGS.append(f"🚀 LitigationJob {job.id[:8]} mis en file ({len(litigation_ids)} dossier(s))")
+    
+    return redirect(f"/litigation-progress/{job.id}")
+
+
+def render_litigation_report(sent_count, errors, details, had_valid=True):
+    """📊 Rapport détaillé du traitement post-paiement (rendu depuis un LitigationJob)"""
+    
     # ════════════════════════════════════════════════════════════════
     # 📊 AFFICHAGE DU RAPPORT DÉTAILLÉ
     # ════════════════════════════════════════════════════════════════
@@ -7798,10 +10448,10 @@ def success_page():
     # Message principal selon résultat
     if sent_count > 0:
         main_icon = "✅"
-        main_title = f"{sent_count} Mise(s) en demeure envoyée(s) !"
+        main_title = f"{sent_count} Mise(s) en demeure en cours d'envoi !"
         main_color = "#10b981"
-        main_subtitle = "Les réclamations ont été envoyées aux entreprises concernées."
-    elif valid_litigations:
+        main_subtitle = "Les réclamations partent vers les entreprises concernées."
+    elif had_valid:
         main_icon = "⚠️"
         main_title = "Envoi en cours de traitement"
         main_color = "#f59e0b"
@@ -7853,6 +10503,101 @@ def success_page():
     </div>
     """ + FOOTER
 
+
+@app.route("/litigation-status/<job_id>")
+def litigation_status(job_id):
+    """📡 Progression JSON du traitement post-paiement (interrogée par /litigation-progress)"""
+    if "email" not in session:
+        return jsonify({"error": "Non authentifié"}), 401
+    
+    job = LitigationJob.query.get(job_id)
+    if not job or job.user_email != session['email']:
+        return jsonify({"error": "Traitement introuvable"}), 404
+    
+    if _litigation_job_is_stale(job) and not resume_litigation_job(job):
+        db.session.refresh(job)  # Un autre worker a pu relancer le job entre-temps
+        if _litigation_job_is_stale(job):
+            job.status = "error"
+            job.error = "Traitement interrompu (serveur redémarré)"
+            db.session.commit()
+    
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "phase": job.phase,
+        "total": job.total or 0,
+        "letters_done": job.letters_done or 0,
+        "sent": job.sent or 0,
+        "error": job.error,
+    }), 200
+
+@app.route("/litigation-progress/<job_id>")
+def litigation_progress(job_id):
+    """⏳ Page d'attente du traitement post-paiement, puis rapport d'envoi"""
+    if "email" not in session:
+        return redirect("/login")
+    
+    job = LitigationJob.query.get(job_id)
+    if not job or job.user_email != session['email']:
+        return redirect("/dashboard")
+    
+    if job.status == "done":
+        return render_litigation_report(job.sent or 0, json.loads(job.errors_json or "[]"),
+                                        json.loads(job.details_json or "[]"))
+    
+    if _litigation_job_is_stale(job):
+        resume_litigation_job(job)
+    
+    if job.status == "error" or _litigation_job_is_stale(job):
+        from html import escape
+        return STYLE + f"""
+        <div style='text-align:center; padding:50px;'>
+            <h1>⚠️ Traitement interrompu</h1>
+            <p>{escape((job.error or "Traitement interrompu (serveur redémarré)")[:150])}</p>
+            <p>Votre paiement est enregistré : retrouvez vos dossiers dans votre espace.</p>
+            <a href='/dashboard' class='btn-success'>📂 Mes dossiers</a>
+        </div>
+        """ + FOOTER
+    
+    return STYLE + f"""
+    <div style='max-width:550px; margin:0 auto; text-align:center; padding:30px;'>
+        <div style='background:linear-gradient(135deg, #d1fae5 0%, #a7f3d0 100%); 
+                    padding:40px; border-radius:20px; margin-bottom:25px;'>
+            <div style='font-size:4rem; margin-bottom:15px;'>⚖️</div>
+            <h1 style='color:#065f46; margin:0 0 10px 0;'>Paiement sécurisé !</h1>
+            <p id='lit-phase' style='color:#047857; margin:0;'>{job.phase or "En file d'attente"}</p>
+        </div>
+        <div style='max-width:400px; margin:25px auto; background:#e2e8f0; border-radius:10px; overflow:hidden;'>
+            <div id='lit-bar' style='width:3%; height:12px; background:linear-gradient(90deg, #10b981, #fbbf24); transition:width 0.5s;'></div>
+        </div>
+        <p id='lit-counters' style='color:#64748b; font-size:0.85rem;'></p>
+    </div>
+    
+    <script>
+    (function() {{
+        const jobId = {json.dumps(job.id)};
+        function poll() {{
+            fetch('/litigation-status/' + jobId)
+            .then(r => r.json())
+            .then(data => {{
+                if (data.status === 'done' || data.status === 'error') {{
+                    window.location.reload();
+                    return;
+                }}
+                document.getElementById('lit-phase').textContent = data.phase || '';
+                const pct = data.total > 0 ? 5 + 90 * data.letters_done / data.total : 3;
+                document.getElementById('lit-bar').style.width = Math.min(pct, 100) + '%';
+                document.getElementById('lit-counters').textContent =
+                    data.letters_done + '/' + data.total + ' mise(s) en demeure rédigée(s)';
+                setTimeout(poll, 1500);
+            }})
+            .catch(() => setTimeout(poll, 3000));
+        }}
+        poll();
+    }})();
+    </script>
+    """ + FOOTER
+
 # ========================================
 # WEBHOOK STRIPE
 # ========================================
@@ -7983,7 +10728,535 @@ def generate_company_variants(company_name: str) -> list:
     if len(words) > 1:
         variants.extend(words)
     
-    return list(set(variants))  # Dédupliquer
+    return list(set(variants))  # Dédupliquer
+
+# ════════════════════════════════════════════════════════════════
+# 🎯 PRÉ-MATCHING DÉTERMINISTE EMAIL ↔ DOSSIERS (avant l'IA)
+# ════════════════════════════════════════════════════════════════
+# Nombre max de dossiers envoyés à ia_matching_dossier_strict
+REFUND_PREMATCH_TOP_K = int(os.environ.get("REFUND_PREMATCH_TOP_K", "3"))
+
+def _variant_in_text(variant: str, text: str) -> bool:
+    """Variante présente dans le texte (mot entier pour les acronymes courts : af, ter, fr...)"""
+    if len(variant) <= 3:
+        return re.search(r'\b' + re.escape(variant) + r'\b', text) is not None
+    return variant in text
+
+def prematch_refund_dossiers(email_subject: str, email_body: str, email_from: str, dossiers: list, top_k: int = None) -> list:
+    """
+    🎯 Score local email ↔ dossier (GRATUIT) avant l'appel IA.
+    
+    Signaux : variantes de l'entreprise (generate_company_variants) dans l'email,
+    domaine de l'expéditeur, numéro de commande, montant (extract_amount_from_text).
+    
+    Retourne les top_k dossiers plausibles (meilleur score d'abord), ou []
+    si l'email est un non-match évident (aucun montant, ou aucune entreprise/
+    commande reconnue) → pas d'appel IA.
+    """
+    top_k = top_k or REFUND_PREMATCH_TOP_K
+    text = f"{email_subject or ''} {email_from or ''} {email_body or ''}".lower()
+    
+    # Règle 3 du prompt IA : pas de montant clair → pas de match possible
+    amount_found = extract_amount_from_text(text)
+    if not amount_found:
+        return []
+    email_amount = extract_numeric_amount(amount_found)
+    
+    parts = split_sender_address(email_from) if email_from else None
+    sender_domain = parts[1] if parts else ""
+    # Emails de test : l'entreprise n'est pas exigée (même exception que le double-check Python)
+    is_test = "test" in (email_subject or "").lower()
+    
+    scored = []
+    for rank, dossier in enumerate(dossiers):
+        score = 0
+        company = (dossier.company or "").strip().lower()
+        variants = generate_company_variants(company) if company else []
+        
+        if any(_variant_in_text(v, text) for v in variants if len(v) > 3):
+            score += 3
+        elif any(_variant_in_text(v, text) for v in variants if v):
+            score += 1
+        
+        # Domaine de l'expéditeur (ex: "sncf" dans "info.sncf.com")
+        if sender_domain and any(len(v) > 2 and v.replace(" ", "") in sender_domain for v in variants):
+            score += 3
+        
+        # Numéro de commande cité tel quel → signal le plus fort
+        order_id = (dossier.order_id or "").strip().lower()
+        if len(order_id) >= 4 and order_id in text:
+            score += 5
+        
+        if score == 0 and not is_test:
+            continue
+        
+        # Départage : montant proche de l'estimation du dossier
+        dossier_amount = extract_numeric_amount(dossier.amount) if dossier.amount else 0
+        if dossier_amount and email_amount and abs(dossier_amount - email_amount) <= 1:
+            score += 1
+        
+        scored.append((score, -rank, dossier))
+    
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    return [dossier for _, _, dossier in scored[:top_k]]
+
+
+
+# ════════════════════════════════════════════════════════════════
+# 💰 ENCAISSEUR - TRAITEMENT D'UN UTILISATEUR (exécuté dans le pool)
+# ════════════════════════════════════════════════════════════════
+# Nombre d'utilisateurs traités en parallèle par /cron/check-refunds
+REFUND_CRON_WORKERS = int(os.environ.get("REFUND_CRON_WORKERS", "4"))
+
+# Nombre max d'utilisateurs par invocation (0 = tous) → le reste au prochain appel
+REFUND_CRON_MAX_USERS = int(os.environ.get("REFUND_CRON_MAX_USERS", "0"))
+# Un run "running" sans progrès depuis plus longtemps est abandonné (crash, shard supprimé...)
+REFUND_RUN_STALE_HOURS = int(os.environ.get("REFUND_RUN_STALE_HOURS", "24"))
+
+def refund_shard_of(user_email: str, shard_count: int) -> int:
+    """Shard d'un utilisateur : hash stable de l'email (identique sur tous les nœuds)"""
+    import hashlib
+    digest = hashlib.sha256((user_email or "").strip().lower().encode("utf-8")).hexdigest()
+    return int(digest, 16) % shard_count
+
+def get_or_create_refund_run(shard: int, shard_count: int, users_total: int):
+    """
+    Reprend le run "running" de ce shard s'il existe (curseur = utilisateurs déjà
+    traités), sinon en ouvre un nouveau. Retourne (run, resumed).
+    """
+    from datetime import timedelta
+    run = RefundRun.query.filter_by(shard=shard, shard_count=shard_count, status='running') \
+        .order_by(RefundRun.created_at.desc()).first()
+    if run and run.updated_at and run.updated_at < datetime.utcnow() - timedelta(hours=REFUND_RUN_STALE_HOURS):
+        run.status = 'abandoned'
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+        run = None
+    if run:
+        return run, True
+    
+    run = RefundRun(
+        id=uuid.uuid4().hex,
+        shard=shard,
+        shard_count=shard_count,
+        status='running',
+        users_total=users_total,
+        users_done_json="[]",
+        stats_json=json.dumps(dict.fromkeys(REFUND_STATS_KEYS, 0)),
+    )
+    db.session.add(run)
+    db.session.commit()
+    return run, False
+
+# Durée de conservation des IDs d'emails déjà évalués (la requête Gmail couvre 7 jours)
+REFUND_SEEN_RETENTION_DAYS = int(os.environ.get("REFUND_SEEN_RETENTION_DAYS", "30"))
+
+def get_seen_refund_email_ids(user_email, message_ids) -> set:
+    """IDs Gmail de cette liste déjà évalués par un run précédent"""
+    if not message_ids:
+        return set()
+    rows = RefundEmailSeen.query.with_entities(RefundEmailSeen.message_id).filter(
+        RefundEmailSeen.user_email == user_email,
+        RefundEmailSeen.message_id.in_(list(message_ids))
+    ).all()
+    return {r.message_id for r in rows}
+
+def remember_refund_email_ids(user_email, message_ids):
+    """Marque des emails comme évalués (plus jamais re-téléchargés ni envoyés à l'IA)"""
+    if not message_ids:
+        return
+    try:
+        for msg_id in message_ids:
+            db.session.add(RefundEmailSeen(user_email=user_email, message_id=msg_id))
+        db.session.commit()
+    except IntegrityError:
+        # Run concurrent (autre shard / double appel) → insertion une par une
+        db.session.rollback()
+        for msg_id in message_ids:
+            try:
+                db.session.add(RefundEmailSeen(user_email=user_email, message_id=msg_id))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
+def purge_seen_refund_emails():
+    """Supprime les IDs plus vieux que REFUND_SEEN_RETENTION_DAYS"""
+    from datetime import timedelta
+    cutoff = datetime.utcnow() - timedelta(days=REFUND_SEEN_RETENTION_DAYS)
+    deleted = RefundEmailSeen.query.filter(RefundEmailSeen.evaluated_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+REFUND_STATS_KEYS = [
+    "utilisateurs_scannes", "emails_analyses", "emails_deja_vus", "prematch_ecartes", "matchs_ia",
+    "matchs_bloques_doublon", "matchs_bloques_entreprise",
+    "commissions_prelevees", "total_commission", "montants_mis_a_jour", "erreurs"
+]
+
+def _check_refunds_for_user(user_email, case_ids, processed_case_ids_this_run, processed_lock):
+    """
+    Traite UN utilisateur de l'Encaisseur. Appelé via call_in_app_context :
+    chaque worker a sa propre session BDD. Retourne (logs, stats) de cet
+    utilisateur, fusionnés par check_refunds() à la fin.
+    processed_case_ids_this_run est partagé entre workers (protégé par processed_lock).
+    """
+    logs = []
+    stats = dict.fromkeys(REFUND_STATS_KEYS, 0)
+    evaluated_ids = []  # Emails Gmail évalués dans ce run (persistés à la fin)
+    
+    stats["utilisateurs_scannes"] += 1
+    
+    # Dossiers rechargés dans la session BDD propre à ce thread
+    cases = Litigation.query.filter(Litigation.id.in_(case_ids)).all()
+    
+    # Filtrer les dossiers déjà traités dans cette exécution
+    with processed_lock:
+        cases_to_process = [c for c in cases if c.id not in processed_case_ids_this_run]
+    
+    if not cases_to_process:
+        return logs, stats
+    
+    logs.append(f"<hr><h4>👤 {user_email}</h4>")
+    logs.append(f"<p style='margin-left:20px;'>📂 {len(cases_to_process)} dossier(s) à surveiller</p>")
+    
+    # Afficher les dossiers
+    dossiers_info = []
+    for c in cases_to_process:
+        montant = extract_numeric_amount(c.amount) if c.amount else 0
+        dossiers_info.append(f"- ID #{c.id}: {c.company.upper()} (estimé: {montant}€) [Status: {c.status}]")
+    
+    logs.append(f"<pre style='margin-left:20px; font-size:0.8rem; background:#f1f5f9; padding:10px; border-radius:5px;'>" + "\n".join(dossiers_info) + "</pre>")
+    
+    # Récupérer l'utilisateur
+    user = User.query.filter_by(email=user_email).first()
+    if not user or not user.refresh_token:
+        logs.append("<p style='margin-left:20px; color:#dc2626;'>❌ Pas de refresh token</p>")
+        return logs, stats
+    
+    try:
+        creds = get_refreshed_credentials(user.refresh_token)
+        service = build('gmail', 'v1', credentials=creds)
+        
+        # ════════════════════════════════════════════════════════════════
+        # 🎣 QUERY GMAIL - RÉDUITE À 7 JOURS (plus précis)
+        # ════════════════════════════════════════════════════════════════
+        
+        query = '''(
+            subject:virement OR subject:remboursement OR subject:refund 
+            OR subject:indemnisation OR subject:compensation
+            OR "avis de virement" OR "compte crédité" OR "a été crédité"
+            OR "remboursement effectué" OR "montant remboursé"
+            OR subject:test OR subject:TEST
+        ) newer_than:7d'''
+        
+        results = service.users().messages().list(userId='me', q=query, maxResults=30).execute()
+        messages = results.get('messages', [])
+        
+        logs.append(f"<p style='margin-left:20px;'>📧 {len(messages)} email(s) financiers (7 derniers jours)</p>")
+        
+        # 🧾 Ne garder que les emails jamais évalués par un run précédent
+        seen_ids = get_seen_refund_email_ids(user_email, [m['id'] for m in messages])
+        if seen_ids:
+            stats["emails_deja_vus"] += len(seen_ids)
+            messages = [m for m in messages if m['id'] not in seen_ids]
+            logs.append(f"<p style='margin-left:20px; color:#6b7280;'>🧾 {len(seen_ids)} déjà évalué(s) → {len(messages)} nouveau(x)</p>")
+        
+        if not messages:
+            logs.append("<p style='margin-left:20px; color:#6b7280;'>Aucun email financier récent</p>")
+            return logs, stats
+        
+        # ════════════════════════════════════════════════════════════════
+        # 🧠 ANALYSE IA - Avec vérifications de sécurité
+        # ════════════════════════════════════════════════════════════════
+        
+        for msg in messages[:15]:  # Limiter à 15 emails (nouveaux uniquement)
+            msg_id = msg['id']
+            
+            try:
+                msg_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+                snippet = msg_data.get('snippet', '')
+                
+                headers = msg_data['payload'].get('headers', [])
+                email_subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), "Sans sujet")
+                email_from = next((h['value'] for h in headers if h['name'].lower() == 'from'), "")
+                
+                # Ignorer les newsletters/pubs (REFUND_PREFILTER_RULES)
+                keep, _rule = REFUND_PREFILTER.evaluate(email_subject, snippet, email_from)
+                if not keep:
+                    evaluated_ids.append(msg_id)
+                    continue
+                
+                # Extraire le body
+                try:
+                    body_text = safe_extract_body_text(msg_data)
+                except:
+                    body_text = snippet
+                
+                stats["emails_analyses"] += 1
+                
+                # ════════════════════════════════════════════════════════════════
+                # 🤖 APPEL IA - MATCHING STRICT
+                # ════════════════════════════════════════════════════════════════
+                
+                if not OPENAI_API_KEY:
+                    continue
+                
+                # Ne passer que les dossiers NON TRAITÉS à l'IA
+                with processed_lock:
+                    dossiers_pour_ia = [c for c in cases_to_process if c.id not in processed_case_ids_this_run]
+                
+                if not dossiers_pour_ia:
+                    logs.append("<p style='margin-left:30px; color:#6b7280;'>Tous les dossiers déjà traités - fin du scan</p>")
+                    break
+                
+                # 🎯 Pré-matching local : non-match évident → pas d'appel IA,
+                # sinon l'IA ne voit que les top-k dossiers plausibles
+                dossiers_candidats = prematch_refund_dossiers(email_subject, body_text, email_from, dossiers_pour_ia)
+                if not dossiers_candidats:
+                    stats["prematch_ecartes"] += 1
+                    evaluated_ids.append(msg_id)
+                    DEBUG_LOGS.append(f"🎯 Pré-match: aucun dossier plausible → skip IA: {email_subject[:40]}...")
+                    continue
+                
+                match_result = ia_matching_dossier_strict(
+                    email_subject=email_subject,
+                    email_body=body_text[:2000],
+                    email_from=email_from,
+                    dossiers=dossiers_candidats
+                )
+                # Pas de verdict (panne, 429, JSON illisible) → email réévalué au prochain run
+                if match_result.get("error"):
+                    stats["erreurs"] += 1
+                    DEBUG_LOGS.append(f"⚠️ Matching IA sans verdict ({match_result.get('reason', '')}) → réessai au prochain run")
+                    continue
+                
+                # Email tranché par l'IA → ne sera plus jamais renvoyé (sauf erreur plus bas)
+                evaluated_ids.append(msg_id)
+                
+                if match_result.get("match"):
+                    stats["matchs_ia"] += 1
+                    dossier_id = match_result.get("dossier_id")
+                    real_amount = match_result.get("real_amount", 0)
+                    match_reason = match_result.get("reason", "")
+                    company_matched = match_result.get("company_matched", "")
+                    
+                    logs.append(f"<p style='margin-left:30px; color:#10b981; font-weight:bold;'>✅ MATCH IA : {email_subject[:40]}...</p>")
+                    logs.append(f"<p style='margin-left:40px;'>📂 Dossier: <b>#{dossier_id}</b> | Entreprise: <b>{company_matched}</b></p>")
+                    logs.append(f"<p style='margin-left:40px;'>💰 Montant trouvé: <b>{real_amount}€</b></p>")
+                    
+                    # ════════════════════════════════════════════════════════════════
+                    # 🛡️ RÈGLE 1 : VÉRIFICATION D'UNICITÉ (Idempotence)
+                    # ════════════════════════════════════════════════════════════════
+                    
+                    # Rafraîchir le dossier depuis la BDD (état le plus récent)
+                    matched_case = Litigation.query.get(dossier_id)
+                    if not matched_case:
+                        logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Dossier #{dossier_id} introuvable</p>")
+                        stats["erreurs"] += 1
+                        continue
+                    
+                    # Forcer le refresh depuis la BDD
+                    db.session.refresh(matched_case)
+                    
+                    # Vérifier que le dossier appartient bien à l'utilisateur
+                    if matched_case.user_email != user_email:
+                        logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Dossier #{dossier_id} n'appartient pas à {user_email}</p>")
+                        stats["erreurs"] += 1
+                        continue
+                    
+                    # 🛡️ RÈGLE 2 : Vérifier si déjà traité DANS CETTE EXÉCUTION
+                    with processed_lock:
+                        already_processed = dossier_id in processed_case_ids_this_run
+                    if already_processed:
+                        logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>🔒 BLOQUÉ : Dossier #{dossier_id} déjà traité dans ce Cron</p>")
+                        stats["matchs_bloques_doublon"] += 1
+                        continue
+                    
+                    # 🛡️ RÈGLE 1 : Vérifier si déjà remboursé EN BASE
+                    # ATTENTION : Ne bloquer QUE les statuts FINAUX (pas "En attente de remboursement")
+                    current_status = (matched_case.status or "").strip().lower()
+                    
+                    # Liste des statuts FINAUX qui bloquent le prélèvement
+                    STATUTS_FINALISES = [
+                        "remboursé",
+                        "refunded",
+                        "résolu",
+                        "annulé",
+                        "fermé",
+                        "payé",
+                        "annulé (sans débit)"
+                    ]
+                    
+                    # Vérifier si c'est un statut final (pas "en attente de remboursement" !)
+                    is_already_refunded = (
+                        current_status in STATUTS_FINALISES or
+                        current_status.startswith("remboursé") or  # "Remboursé (Partiel: 100€/200€)"
+                        current_status.startswith("résolu")        # "Résolu (Bon d'achat: 50€)"
+                    )
+                    
+                    current_amount = extract_numeric_amount(matched_case.amount) if matched_case.amount else 0
+                    new_amount = int(real_amount) if real_amount else 0
+                    
+                    if is_already_refunded:
+                        # Vérifier si c'est un complément (montant supérieur)
+                        if new_amount > 0 and new_amount > current_amount:
+                            # Complément détecté - mise à jour du montant SANS prélèvement
+                            old_amount_str = matched_case.amount
+                            matched_case.amount = f"{new_amount}€"
+                            matched_case.updated_at = datetime.utcnow()
+                            db.session.commit()
+                            
+                            stats["montants_mis_a_jour"] += 1
+                            logs.append(f"<p style='margin-left:40px; color:#3b82f6;'>📝 Complément détecté: {old_amount_str} → {new_amount}€</p>")
+                            logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ PAS de commission supplémentaire (sécurité)</p>")
+                        else:
+                            logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>🔒 BLOQUÉ : Dossier #{dossier_id} DÉJÀ remboursé (status: {matched_case.status})</p>")
+                        
+                        stats["matchs_bloques_doublon"] += 1
+                        with processed_lock:
+                            processed_case_ids_this_run.add(dossier_id)
+                        continue
+                    
+                    # 🛡️ RÈGLE 3 : Vérification de liaison stricte (double-check Python)
+                    company_in_case = (matched_case.company or "").lower()
+                    company_in_email = (company_matched or "").lower()
+                    email_content_lower = f"{email_subject} {email_from} {body_text[:500]}".lower()
+                    
+                    # Mapping des variantes d'entreprises
+                    COMPANY_ALIASES = {
+                        "sncf": ["sncf", "tgv", "ouigo", "ter", "intercités", "train", "inoui", "voyages-sncf", "oui.sncf"],
+                        "air france": ["air france", "airfrance", "af ", "transavia", "hop!"],
+                        "easyjet": ["easyjet", "easy jet", "u2"],
+                        "ryanair": ["ryanair", "fr "],
+                        "vueling": ["vueling", "vl "],
+                        "volotea": ["volotea"],
+                        "lufthansa": ["lufthansa", "lh "],
+                        "klm": ["klm", "kl "],
+                    }
+                    
+                    # Trouver les aliases de l'entreprise du dossier
+                    company_aliases = [company_in_case]
+                    for main_name, aliases in COMPANY_ALIASES.items():
+                        if any(alias in company_in_case for alias in aliases):
+                            company_aliases.extend(aliases)
+                            break
+                    
+                    # Vérifier que l'email mentionne bien l'entreprise
+                    company_found_in_email = any(alias in email_content_lower for alias in company_aliases)
+                    
+                    if not company_found_in_email and "test" not in email_subject.lower():
+                        logs.append(f"<p style='margin-left:40px; color:#dc2626;'>🚫 BLOQUÉ : L'email ne mentionne pas '{matched_case.company}'</p>")
+                        stats["matchs_bloques_entreprise"] += 1
+                        continue
+                    
+                    # ════════════════════════════════════════════════════════════════
+                    # ✅ TOUTES LES VÉRIFICATIONS PASSÉES - PRÉLÈVEMENT AUTORISÉ
+                    # ════════════════════════════════════════════════════════════════
+                    
+                    logs.append(f"<p style='margin-left:40px; color:#10b981;'>✅ Toutes les vérifications passées</p>")
+                    
+                    # Mise à jour du montant
+                    old_amount = matched_case.amount
+                    if new_amount > 0:
+                        matched_case.amount = f"{new_amount}€"
+                        stats["montants_mis_a_jour"] += 1
+                        logs.append(f"<p style='margin-left:40px; color:#3b82f6;'>📝 Montant: {old_amount} → {new_amount}€</p>")
+                    
+                    # ⚡ MARQUER COMME REMBOURSÉ IMMÉDIATEMENT (avant Stripe)
+                    matched_case.status = "Remboursé"
+                    matched_case.updated_at = datetime.utcnow()
+                    with processed_lock:
+                        if dossier_id in processed_case_ids_this_run:
+                            # Réclamé entre-temps par un autre worker → on ne prélève pas
+                            db.session.rollback()
+                            stats["matchs_bloques_doublon"] += 1
+                            continue
+                        processed_case_ids_this_run.add(dossier_id)
+
+                    # Mettre à jour les MiseEnDemeure liées
+                    envois_lies = MiseEnDemeure.query.filter_by(litigation_id=dossier_id).all()
+                    for envoi in envois_lies:
+                        envoi.status = 'refunded'
+                        envoi.refunded_at = datetime.utcnow()
+
+                    db.session.commit()
+                    
+                    # ════════════════════════════════════════════════════════════════
+                    # 💳 PRÉLÈVEMENT STRIPE (une seule fois)
+                    # ════════════════════════════════════════════════════════════════
+                    
+                    commission_base = new_amount if new_amount > 0 else current_amount
+                    
+                    if commission_base > 0 and user.stripe_customer_id:
+                        commission = max(1, int(commission_base * 0.30))
+                        
+                        logs.append(f"<p style='margin-left:40px;'>💳 Commission: <b>{commission}€</b> (30% de {commission_base}€)</p>")
+                        
+                        try:
+                            payment_methods = stripe.PaymentMethod.list(
+                                customer=user.stripe_customer_id, 
+                                type="card"
+                            )
+                            
+                            if payment_methods.data:
+                                payment_intent = stripe.PaymentIntent.create(
+                                    amount=commission * 100,
+                                    currency='eur',
+                                    customer=user.stripe_customer_id,
+                                    payment_method=payment_methods.data[0].id,
+                                    off_session=True,
+                                    confirm=True,
+                                    description=f"Commission Justicio 30% - {matched_case.company} - Dossier #{dossier_id}",
+                                    idempotency_key=f"justicio-{dossier_id}-{datetime.utcnow().strftime('%Y%m%d')}"  # Anti-doublon Stripe
+                                )
+                                
+                                if payment_intent.status == "succeeded":
+                                    stats["commissions_prelevees"] += 1
+                                    stats["total_commission"] += commission
+                                    
+                                    logs.append(f"<p style='margin-left:40px; color:#10b981; font-weight:bold;'>💰 JACKPOT ! {commission}€ PRÉLEVÉS !</p>")
+                                    
+                                    send_telegram_notif(
+                                        f"💰 JUSTICIO JACKPOT 💰\n\n"
+                                        f"Commission: {commission}€\n"
+                                        f"Entreprise: {matched_case.company}\n"
+                                        f"Montant: {commission_base}€\n"
+                                        f"Client: {user_email}\n"
+                                        f"Dossier #{dossier_id}\n"
+                                        f"🛡️ V4 Sécurisé"
+                                    )
+                                else:
+                                    logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ Paiement: {payment_intent.status}</p>")
+                            else:
+                                logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Aucune carte</p>")
+                                
+                        except stripe.error.CardError as e:
+                            logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Carte: {e.user_message}</p>")
+                            stats["erreurs"] += 1
+                        except stripe.error.IdempotencyError:
+                            logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>🔒 Paiement déjà effectué (idempotency)</p>")
+                        except Exception as e:
+                            logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Stripe: {str(e)[:50]}</p>")
+                            stats["erreurs"] += 1
+                    elif not user.stripe_customer_id:
+                        logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ Pas de carte Stripe</p>")
+                    else:
+                        logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ Montant = 0€</p>")
+                
+            except Exception as e:
+                stats["erreurs"] += 1
+                DEBUG_LOGS.append(f"❌ Erreur email: {str(e)[:50]}")
+                # Traitement interrompu → l'email sera réévalué au prochain run
+                if evaluated_ids and evaluated_ids[-1] == msg_id:
+                    evaluated_ids.pop()
+                continue
+                
+    except Exception as e:
+        stats["erreurs"] += 1
+        logs.append(f"<p style='margin-left:20px; color:#dc2626;'>❌ Erreur Gmail: {str(e)[:80]}</p>")
+    
+    remember_refund_email_ids(user_email, evaluated_ids)
+    return logs, stats
 
 
 
@@ -8008,28 +11281,32 @@ def check_refunds():
     if SCAN_TOKEN and token != SCAN_TOKEN:
         return "⛔ Accès refusé - Token invalide", 403
     
+    # Sharding : ?shard=i&of=n → ce nœud ne traite que les utilisateurs de son shard
+    try:
+        shard = int(request.args.get("shard", 0))
+        shard_count = int(request.args.get("of", 1))
+    except ValueError:
+        return "⛔ Paramètres shard/of invalides", 400
+    if shard_count < 1 or not 0 <= shard < shard_count:
+        return "⛔ Paramètres shard/of invalides", 400
+    try:
+        max_users = int(request.args.get("limit", REFUND_CRON_MAX_USERS))
+    except ValueError:
+        max_users = REFUND_CRON_MAX_USERS
+    
     logs = ["<h3>💰 AGENT ENCAISSEUR V4 - SÉCURISÉ</h3>"]
     logs.append(f"<p>🕐 Scan lancé à {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC</p>")
     logs.append("<p style='color:#f59e0b;'>🛡️ Mode sécurisé : Anti-doublons activé</p>")
     
-    # Statistiques
-    stats = {
-        "utilisateurs_scannes": 0,
-        "emails_analyses": 0,
-        "matchs_ia": 0,
-        "matchs_bloques_doublon": 0,  # NOUVEAU : Compteur anti-doublon
-        "matchs_bloques_entreprise": 0,  # NOUVEAU : Compteur liaison stricte
-        "commissions_prelevees": 0,
-        "total_commission": 0,
-        "montants_mis_a_jour": 0,
-        "erreurs": 0
-    }
+    # Statistiques (additionnées depuis les workers)
+    stats = dict.fromkeys(REFUND_STATS_KEYS, 0)
 
     # ════════════════════════════════════════════════════════════════
     # 🛡️ RÈGLE 2 : PROTECTION BATCH
     # Un dossier ne peut être traité qu'UNE FOIS par exécution du Cron
     # ════════════════════════════════════════════════════════════════
     processed_case_ids_this_run = set()
+    processed_lock = threading.Lock()
     
     # ════════════════════════════════════════════════════════════════
     # STATUTS QUI PERMETTENT UN PRÉLÈVEMENT
@@ -8059,11 +11336,13 @@ def check_refunds():
     # Filtrer les users avec scan_enabled = True
     users_with_scan = {u.email for u in User.query.filter_by(scan_enabled=True).all()}
 
-    # Grouper par utilisateur (scan_enabled uniquement)
+    # Grouper par utilisateur (scan_enabled uniquement, shard courant uniquement)
     users_cases = {}
     for case in active_cases:
         if case.user_email not in users_with_scan:
             continue
+        if shard_count > 1 and refund_shard_of(case.user_email, shard_count) != shard:
+            continue
         if case.user_email not in users_cases:
             users_cases[case.user_email] = []
         users_cases[case.user_email].append(case)
@@ -8071,329 +11350,61 @@ def check_refunds():
     logs.append(f"<p>👥 {len(users_cases)} utilisateur(s) avec dossiers actifs</p>")
     logs.append(f"<p>📂 {len(active_cases)} dossier(s) NON remboursés à surveiller</p>")
     
-    # Liste des expéditeurs à ignorer (newsletters, pubs, e-commerce généraliste)
-    IGNORED_SENDERS = [
-        "airbnb", "uber", "ubereats", "deliveroo", "netflix", "spotify",
-        "amazon", "linkedin", "facebook", "twitter", "instagram",
-        "newsletter", "noreply", "no-reply", "marketing", "promo",
-        "jow", "yoojo", "leboncoin", "vinted", "cdiscount", "fnac",
-        "darty", "boulanger", "zalando", "asos", "shein", "temu",
-        "aliexpress", "wish", "ebay", "etsy", "paypal"
-    ]
+    # ════════════════════════════════════════════════════════════════
+    # 🧭 RUN PERSISTÉ : reprise là où la dernière invocation s'est arrêtée
+    # ════════════════════════════════════════════════════════════════
+    run, resumed = get_or_create_refund_run(shard, shard_count, len(users_cases))
+    if not resumed:
+        purge_seen_refund_emails()
+    users_done = json.loads(run.users_done_json or "[]")
+    done_set = set(users_done)
+    pending_users = sorted(u for u in users_cases if u not in done_set)
+    batch_users = pending_users[:max_users] if max_users > 0 else pending_users
+    
+    logs.append(
+        f"<p>🧭 Run <code>{run.id[:8]}</code> (shard {shard + 1}/{shard_count}) : "
+        f"{'reprise, ' + str(len(done_set)) + ' utilisateur(s) déjà traité(s)' if resumed else 'nouveau run'} "
+        f"→ {len(batch_users)}/{len(pending_users)} utilisateur(s) dans cette invocation</p>"
+    )
     
     # ════════════════════════════════════════════════════════════════
-    # BOUCLE PRINCIPALE : Pour chaque utilisateur
+    # BOUCLE PRINCIPALE : Pour chaque utilisateur (en parallèle, REFUND_CRON_WORKERS)
     # ════════════════════════════════════════════════════════════════
     
-    for user_email, cases in users_cases.items():
-        stats["utilisateurs_scannes"] += 1
-        
-        # Filtrer les dossiers déjà traités dans cette exécution
-        cases_to_process = [c for c in cases if c.id not in processed_case_ids_this_run]
-        
-        if not cases_to_process:
-            continue
-        
-        logs.append(f"<hr><h4>👤 {user_email}</h4>")
-        logs.append(f"<p style='margin-left:20px;'>📂 {len(cases_to_process)} dossier(s) à surveiller</p>")
-        
-        # Afficher les dossiers
-        dossiers_info = []
-        for c in cases_to_process:
-            montant = extract_numeric_amount(c.amount) if c.amount else 0
-            dossiers_info.append(f"- ID #{c.id}: {c.company.upper()} (estimé: {montant}€) [Status: {c.status}]")
-        
-        logs.append(f"<pre style='margin-left:20px; font-size:0.8rem; background:#f1f5f9; padding:10px; border-radius:5px;'>" + "\n".join(dossiers_info) + "</pre>")
-        
-        # Récupérer l'utilisateur
-        user = User.query.filter_by(email=user_email).first()
-        if not user or not user.refresh_token:
-            logs.append("<p style='margin-left:20px; color:#dc2626;'>❌ Pas de refresh token</p>")
-            continue
+    with ThreadPoolExecutor(max_workers=max(1, REFUND_CRON_WORKERS), thread_name_prefix="refunds") as pool:
+        futures = [
+            (user_email, pool.submit(call_in_app_context, _check_refunds_for_user, user_email,
+                                     [c.id for c in users_cases[user_email]], processed_case_ids_this_run, processed_lock))
+            for user_email in batch_users
+        ]
         
-        try:
-            creds = get_refreshed_credentials(user.refresh_token)
-            service = build('gmail', 'v1', credentials=creds)
-            
-            # ════════════════════════════════════════════════════════════════
-            # 🎣 QUERY GMAIL - RÉDUITE À 7 JOURS (plus précis)
-            # ════════════════════════════════════════════════════════════════
-            
-            query = '''(
-                subject:virement OR subject:remboursement OR subject:refund 
-                OR subject:indemnisation OR subject:compensation
-                OR "avis de virement" OR "compte crédité" OR "a été crédité"
-                OR "remboursement effectué" OR "montant remboursé"
-                OR subject:test OR subject:TEST
-            ) newer_than:7d'''
-            
-            results = service.users().messages().list(userId='me', q=query, maxResults=30).execute()
-            messages = results.get('messages', [])
-            
-            logs.append(f"<p style='margin-left:20px;'>📧 {len(messages)} email(s) financiers (7 derniers jours)</p>")
-            
-            if not messages:
-                logs.append("<p style='margin-left:20px; color:#6b7280;'>Aucun email financier récent</p>")
-                continue
-            
-            # ════════════════════════════════════════════════════════════════
-            # 🧠 ANALYSE IA - Avec vérifications de sécurité
-            # ════════════════════════════════════════════════════════════════
-            
-            for msg in messages[:15]:  # Limiter à 15 emails
-                msg_id = msg['id']
-                
-                try:
-                    msg_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-                    snippet = msg_data.get('snippet', '')
-                    
-                    headers = msg_data['payload'].get('headers', [])
-                    email_subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), "Sans sujet")
-                    email_from = next((h['value'] for h in headers if h['name'].lower() == 'from'), "")
-                    
-                    # Ignorer les newsletters/pubs
-                    email_from_lower = email_from.lower()
-                    if any(ignored in email_from_lower for ignored in IGNORED_SENDERS):
-                        continue
-                    
-                    # Extraire le body
-                    try:
-                        body_text = safe_extract_body_text(msg_data)
-                    except:
-                        body_text = snippet
-                    
-                    stats["emails_analyses"] += 1
-                    
-                    # ════════════════════════════════════════════════════════════════
-                    # 🤖 APPEL IA - MATCHING STRICT
-                    # ════════════════════════════════════════════════════════════════
-                    
-                    if not OPENAI_API_KEY:
-                        continue
-                    
-                    # Ne passer que les dossiers NON TRAITÉS à l'IA
-                    dossiers_pour_ia = [c for c in cases_to_process if c.id not in processed_case_ids_this_run]
-                    
-                    if not dossiers_pour_ia:
-                        logs.append("<p style='margin-left:30px; color:#6b7280;'>Tous les dossiers déjà traités - fin du scan</p>")
-                        break
-                    
-                    match_result = ia_matching_dossier_strict(
-                        email_subject=email_subject,
-                        email_body=body_text[:2000],
-                        email_from=email_from,
-                        dossiers=dossiers_pour_ia
-                    )
-                    
-                    if match_result.get("match"):
-                        stats["matchs_ia"] += 1
-                        dossier_id = match_result.get("dossier_id")
-                        real_amount = match_result.get("real_amount", 0)
-                        match_reason = match_result.get("reason", "")
-                        company_matched = match_result.get("company_matched", "")
-                        
-                        logs.append(f"<p style='margin-left:30px; color:#10b981; font-weight:bold;'>✅ MATCH IA : {email_subject[:40]}...</p>")
-                        logs.append(f"<p style='margin-left:40px;'>📂 Dossier: <b>#{dossier_id}</b> | Entreprise: <b>{company_matched}</b></p>")
-                        logs.append(f"<p style='margin-left:40px;'>💰 Montant trouvé: <b>{real_amount}€</b></p>")
-                        
-                        # ════════════════════════════════════════════════════════════════
-                        # 🛡️ RÈGLE 1 : VÉRIFICATION D'UNICITÉ (Idempotence)
-                        # ════════════════════════════════════════════════════════════════
-                        
-                        # Rafraîchir le dossier depuis la BDD (état le plus récent)
-                        matched_case = Litigation.query.get(dossier_id)
-                        if not matched_case:
-                            logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Dossier #{dossier_id} introuvable</p>")
-                            stats["erreurs"] += 1
-                            continue
-                        
-                        # Forcer le refresh depuis la BDD
-                        db.session.refresh(matched_case)
-                        
-                        # Vérifier que le dossier appartient bien à l'utilisateur
-                        if matched_case.user_email != user_email:
-                            logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Dossier #{dossier_id} n'appartient pas à {user_email}</p>")
-                            stats["erreurs"] += 1
-                            continue
-                        
-                        # 🛡️ RÈGLE 2 : Vérifier si déjà traité DANS CETTE EXÉCUTION
-                        if dossier_id in processed_case_ids_this_run:
-                            logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>🔒 BLOQUÉ : Dossier #{dossier_id} déjà traité dans ce Cron</p>")
-                            stats["matchs_bloques_doublon"] += 1
-                            continue
-                        
-                        # 🛡️ RÈGLE 1 : Vérifier si déjà remboursé EN BASE
-                        # ATTENTION : Ne bloquer QUE les statuts FINAUX (pas "En attente de remboursement")
-                        current_status = (matched_case.status or "").strip().lower()
-                        
-                        # Liste des statuts FINAUX qui bloquent le prélèvement
-                        STATUTS_FINALISES = [
-                            "remboursé",
-                            "refunded",
-                            "résolu",
-                            "annulé",
-                            "fermé",
-                            "payé",
-                            "annulé (sans débit)"
-                        ]
-                        
-                        # Vérifier si c'est un statut final (pas "en attente de remboursement" !)
-                        is_already_refunded = (
-                            current_status in STATUTS_FINALISES or
-                            current_status.startswith("remboursé") or  # "Remboursé (Partiel: 100€/200€)"
-                            current_status.startswith("résolu")        # "Résolu (Bon d'achat: 50€)"
-                        )
-                        
-                        current_amount = extract_numeric_amount(matched_case.amount) if matched_case.amount else 0
-                        new_amount = int(real_amount) if real_amount else 0
-                        
-                        if is_already_refunded:
-                            # Vérifier si c'est un complément (montant supérieur)
-                            if new_amount > 0 and new_amount > current_amount:
-                                # Complément détecté - mise à jour du montant SANS prélèvement
-                                old_amount_str = matched_case.amount
-                                matched_case.amount = f"{new_amount}€"
-                                matched_case.updated_at = datetime.utcnow()
-                                db.session.commit()
-                                
-                                stats["montants_mis_a_jour"] += 1
-                                logs.append(f"<p style='margin-left:40px; color:#3b82f6;'>📝 Complément détecté: {old_amount_str} → {new_amount}€</p>")
-                                logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ PAS de commission supplémentaire (sécurité)</p>")
-                            else:
-                                logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>🔒 BLOQUÉ : Dossier #{dossier_id} DÉJÀ remboursé (status: {matched_case.status})</p>")
-                            
-                            stats["matchs_bloques_doublon"] += 1
-                            processed_case_ids_this_run.add(dossier_id)
-                            continue
-                        
-                        # 🛡️ RÈGLE 3 : Vérification de liaison stricte (double-check Python)
-                        company_in_case = (matched_case.company or "").lower()
-                        company_in_email = (company_matched or "").lower()
-                        email_content_lower = f"{email_subject} {email_from} {body_text[:500]}".lower()
-                        
-                        # Mapping des variantes d'entreprises
-                        COMPANY_ALIASES = {
-                            "sncf": ["sncf", "tgv", "ouigo", "ter", "intercités", "train", "inoui", "voyages-sncf", "oui.sncf"],
-                            "air france": ["air france", "airfrance", "af ", "transavia", "hop!"],
-                            "easyjet": ["easyjet", "easy jet", "u2"],
-                            "ryanair": ["ryanair", "fr "],
-                            "vueling": ["vueling", "vl "],
-                            "volotea": ["volotea"],
-                            "lufthansa": ["lufthansa", "lh "],
-                            "klm": ["klm", "kl "],
-                        }
-                        
-                        # Trouver les aliases de l'entreprise du dossier
-                        company_aliases = [company_in_case]
-                        for main_name, aliases in COMPANY_ALIASES.items():
-                            if any(alias in company_in_case for alias in aliases):
-                                company_aliases.extend(aliases)
-                                break
-                        
-                        # Vérifier que l'email mentionne bien l'entreprise
-                        company_found_in_email = any(alias in email_content_lower for alias in company_aliases)
-                        
-                        if not company_found_in_email and "test" not in email_subject.lower():
-                            logs.append(f"<p style='margin-left:40px; color:#dc2626;'>🚫 BLOQUÉ : L'email ne mentionne pas '{matched_case.company}'</p>")
-                            stats["matchs_bloques_entreprise"] += 1
-                            continue
-                        
-                        # ════════════════════════════════════════════════════════════════
-                        # ✅ TOUTES LES VÉRIFICATIONS PASSÉES - PRÉLÈVEMENT AUTORISÉ
-                        # ════════════════════════════════════════════════════════════════
-                        
-                        logs.append(f"<p style='margin-left:40px; color:#10b981;'>✅ Toutes les vérifications passées</p>")
-                        
-                        # Mise à jour du montant
-                        old_amount = matched_case.amount
-                        if new_amount > 0:
-                            matched_case.amount = f"{new_amount}€"
-                            stats["montants_mis_a_jour"] += 1
-                            logs.append(f"<p style='margin-left:40px; color:#3b82f6;'>📝 Montant: {old_amount} → {new_amount}€</p>")
-                        
-                        # ⚡ MARQUER COMME REMBOURSÉ IMMÉDIATEMENT (avant Stripe)
-                        matched_case.status = "Remboursé"
-                        matched_case.updated_at = datetime.utcnow()
-                        processed_case_ids_this_run.add(dossier_id)
-
-                        # Mettre à jour les MiseEnDemeure liées
-                        envois_lies = MiseEnDemeure.query.filter_by(litigation_id=dossier_id).all()
-                        for envoi in envois_lies:
-                            envoi.status = 'refunded'
-                            envoi.refunded_at = datetime.utcnow()
-
-                        db.session.commit()
-                        
-                        # ════════════════════════════════════════════════════════════════
-                        # 💳 PRÉLÈVEMENT STRIPE (une seule fois)
-                        # ════════════════════════════════════════════════════════════════
-                        
-                        commission_base = new_amount if new_amount > 0 else current_amount
-                        
-                        if commission_base > 0 and user.stripe_customer_id:
-                            commission = max(1, int(commission_base * 0.30))
-                            
-                            logs.append(f"<p style='margin-left:40px;'>💳 Commission: <b>{commission}€</b> (30% de {commission_base}€)</p>")
-                            
-                            try:
-                                payment_methods = stripe.PaymentMethod.list(
-                                    customer=user.stripe_customer_id, 
-                                    type="card"
-                                )
-                                
-                                if payment_methods.data:
-                                    payment_intent = stripe.PaymentIntent.create(
-                                        amount=commission * 100,
-                                        currency='eur',
-                                        customer=user.stripe_customer_id,
-                                        payment_method=payment_methods.data[0].id,
-                                        off_session=True,
-                                        confirm=True,
-                                        description=f"Commission Justicio 30% - {matched_case.company} - Dossier #{dossier_id}",
-                                        idempotency_key=f"justicio-{dossier_id}-{datetime.utcnow().strftime('%Y%m%d')}"  # Anti-doublon Stripe
-                                    )
-                                    
-                                    if payment_intent.status == "succeeded":
-                                        stats["commissions_prelevees"] += 1
-                                        stats["total_commission"] += commission
-                                        
-                                        logs.append(f"<p style='margin-left:40px; color:#10b981; font-weight:bold;'>💰 JACKPOT ! {commission}€ PRÉLEVÉS !</p>")
-                                        
-                                        send_telegram_notif(
-                                            f"💰 JUSTICIO JACKPOT 💰\n\n"
-                                            f"Commission: {commission}€\n"
-                                            f"Entreprise: {matched_case.company}\n"
-                                            f"Montant: {commission_base}€\n"
-                                            f"Client: {user_email}\n"
-                                            f"Dossier #{dossier_id}\n"
-                                            f"🛡️ V4 Sécurisé"
-                                        )
-                                    else:
-                                        logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ Paiement: {payment_intent.status}</p>")
-                                else:
-                                    logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Aucune carte</p>")
-                                    
-                            except stripe.error.CardError as e:
-                                logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Carte: {e.user_message}</p>")
-                                stats["erreurs"] += 1
-                            except stripe.error.IdempotencyError:
-                                logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>🔒 Paiement déjà effectué (idempotency)</p>")
-                            except Exception as e:
-                                logs.append(f"<p style='margin-left:40px; color:#dc2626;'>❌ Stripe: {str(e)[:50]}</p>")
-                                stats["erreurs"] += 1
-                        elif not user.stripe_customer_id:
-                            logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ Pas de carte Stripe</p>")
-                        else:
-                            logs.append(f"<p style='margin-left:40px; color:#f59e0b;'>⚠️ Montant = 0€</p>")
-                    
-                except Exception as e:
-                    stats["erreurs"] += 1
-                    DEBUG_LOGS.append(f"❌ Erreur email: {str(e)[:50]}")
-                    continue
-                    
-        except Exception as e:
-            stats["erreurs"] += 1
-            logs.append(f"<p style='margin-left:20px; color:#dc2626;'>❌ Erreur Gmail: {str(e)[:80]}</p>")
+        # Agrégation dans l'ordre des utilisateurs (logs lisibles, stats additionnées).
+        # Le curseur du run est persisté après CHAQUE utilisateur → reprise après crash.
+        run_stats = json.loads(run.stats_json or "{}")
+        for user_email, future in futures:
+            try:
+                user_logs, user_stats = future.result()
+            except Exception as e:
+                user_logs = [f"<hr><h4>👤 {user_email}</h4><p style='margin-left:20px; color:#dc2626;'>❌ Erreur worker: {str(e)[:80]}</p>"]
+                user_stats = {"erreurs": 1}
+            logs.extend(user_logs)
+            for key, value in user_stats.items():
+                stats[key] += value
+                run_stats[key] = run_stats.get(key, 0) + value
+            
+            users_done.append(user_email)
+            run.users_done_json = json.dumps(users_done)
+            run.stats_json = json.dumps(run_stats)
+            db.session.commit()
+    
+    remaining = len(pending_users) - len(batch_users)
+    if remaining == 0:
+        run.status = 'done'
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+        logs.append(f"<p>🏁 Run <code>{run.id[:8]}</code> terminé ({len(users_done)} utilisateur(s))</p>")
+    else:
+        logs.append(f"<p>⏸️ {remaining} utilisateur(s) restant(s) → reprise au prochain appel</p>")
     
     # ════════════════════════════════════════════════════════════════
     # 📊 RAPPORT FINAL
@@ -8405,6 +11416,8 @@ def check_refunds():
     <div style='background:#f8fafc; padding:15px; border-radius:10px; margin:10px 0;'>
         <p>👥 Utilisateurs scannés : <b>{stats['utilisateurs_scannes']}</b></p>
         <p>📧 Emails analysés : <b>{stats['emails_analyses']}</b></p>
+        <p style='color:#6b7280;'>🧾 Déjà évalués (ignorés) : <b>{stats['emails_deja_vus']}</b></p>
+        <p style='color:#6b7280;'>🎯 Écartés sans IA (pré-matching) : <b>{stats['prematch_ecartes']}</b></p>
         <p style='color:#10b981;'>🎯 Matchs IA : <b>{stats['matchs_ia']}</b></p>
         <p style='color:#f59e0b;'>🔒 Bloqués (doublon) : <b>{stats['matchs_bloques_doublon']}</b></p>
         <p style='color:#f59e0b;'>🚫 Bloqués (entreprise) : <b>{stats['matchs_bloques_entreprise']}</b></p>
@@ -8434,10 +11447,11 @@ def ia_matching_dossier_strict(email_subject: str, email_body: str, email_from:
     
     Returns:
         {"match": bool, "dossier_id": int, "real_amount": float, "reason": str, "company_matched": str}
+        En cas d'échec (API, JSON) : {"match": False, "error": True, "reason": str} → aucun verdict
     """
     
     if not OPENAI_API_KEY:
-        return {"match": False, "reason": "Pas d'API OpenAI"}
+        return {"match": False, "error": True, "reason": "Pas d'API OpenAI"}
     
     if not dossiers:
         return {"match": False, "reason": "Aucun dossier actif"}
@@ -8520,9 +11534,7 @@ CONTENU:
 Réponds UNIQUEMENT en JSON valide."""
 
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        
-        response = client.chat.completions.create(
+        response = OPENAI_GATEWAY.chat("ia_matching_dossier_strict",
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -8541,6 +11553,8 @@ Réponds UNIQUEMENT en JSON valide."""
             content = content.split("```")[1].split("```")[0].strip()
         
         result = json.loads(content)
+        if not isinstance(result, dict):
+            raise json.JSONDecodeError("verdict non objet", content, 0)
         
         # Log pour debug
         match_status = "✅ MATCH" if result.get("match") else "❌ No match"
@@ -8551,10 +11565,10 @@ Réponds UNIQUEMENT en JSON valide."""
         
     except json.JSONDecodeError as e:
         DEBUG_LOGS.append(f"❌ IA JSON error: {str(e)[:30]}")
-        return {"match": False, "reason": f"Erreur JSON: {str(e)[:30]}"}
+        return {"match": False, "error": True, "reason": f"Erreur JSON: {str(e)[:30]}"}
     except Exception as e:
         DEBUG_LOGS.append(f"❌ IA error: {str(e)[:50]}")
-        return {"match": False, "reason": f"Erreur IA: {str(e)[:30]}"}
+        return {"match": False, "error": True, "reason": f"Erreur IA: {str(e)[:30]}"}
 
 
 # Garder l'ancienne fonction pour compatibilité (alias)
@@ -8588,8 +11602,6 @@ def analyze_refund_email(company, expected_amount, subject, snippet, email_from,
     if not OPENAI_API_KEY:
         return {"verdict": "NON", "montant_reel": 0, "type": "NONE", "order_id": None, "is_credit": False, "is_partial": False, "is_cancelled": False, "confidence": "LOW", "raison": "Pas d'API"}
     
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
     prompt = f"""Tu es un AUDITEUR FINANCIER EXPERT. Analyse cet email pour déterminer s'il confirme un REMBOURSEMENT EFFECTUÉ.
 
 DOSSIER EN ATTENTE :
@@ -8768,7 +11780,7 @@ Ta réponse (UNE SEULE LIGNE) :"""
     ]
 
     try:
-        response = client.chat.completions.create(
+        response = OPENAI_GATEWAY.chat("analyze_refund_email",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0,
@@ -9201,6 +12213,144 @@ def show_debug_logs():
 # 🔐 ESPACE ADMINISTRATEUR
 # ========================================
 
+@app.route("/admin/ai-cache")
+def admin_ai_cache():
+    """🗄️ Statistiques du cache des classifications IA (hit/miss, taille)"""
+    if not session.get('admin_authenticated'):
+        return jsonify({"error": "Accès admin requis"}), 403
+    
+    try:
+        entries = AIClassificationCache.query.count()
+    except Exception:
+        entries = None
+    lookups = AI_CACHE_STATS["hits"] + AI_CACHE_STATS["misses"]
+    return jsonify({
+        **AI_CACHE_STATS,
+        "hit_rate": round(AI_CACHE_STATS["hits"] / lookups, 3) if lookups else None,
+        "entries": entries,
+        "max_entries": AI_CACHE_MAX_ENTRIES,
+        "ttl_days": AI_CACHE_TTL_DAYS,
+        "prompt_version": STRICT_PROMPT_VERSION,
+    }), 200
+
+@app.route("/admin/openai")
+def admin_openai():
+    """🤖 Métriques de la passerelle OpenAI par appelant (appels, retries, latence, tokens, coût)"""
+    if not session.get('admin_authenticated'):
+        return jsonify({"error": "Accès admin requis"}), 403
+    return jsonify(OPENAI_GATEWAY.stats()), 200
+
+@app.route("/admin/letter-cache", methods=["GET", "POST"])
+def admin_letter_cache():
+    """
+    ⚖️ Cache des argumentaires de mises en demeure : GET = stats, POST = invalidation.
+    POST ?company=amazon → une entreprise ; sans paramètre → tout le cache.
+    """
+    if not session.get('admin_authenticated'):
+        return jsonify({"error": "Accès admin requis"}), 403
+    
+    if request.method == "POST":
+        company = normalize_company_key(request.values.get("company") or "")
+        try:
+            query = LetterSectionCache.query
+            if company:
+                query = query.filter(LetterSectionCache.company == company)
+            deleted = query.delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)[:100]}), 500
+        _LETTER_SECTIONS_MEMO.clear()
+        return jsonify({"invalidated": company or "*", "deleted": deleted}), 200
+    
+    try:
+        entries = LetterSectionCache.query.count()
+    except Exception:
+        entries = None
+    lookups = LETTER_CACHE_STATS["hits"] + LETTER_CACHE_STATS["misses"]
+    return jsonify({
+        **LETTER_CACHE_STATS,
+        "hit_rate": round(LETTER_CACHE_STATS["hits"] / lookups, 3) if lookups else None,
+        "entries": entries,
+        "memo_templates": len(_LETTER_SECTIONS_MEMO),
+        "max_entries": LETTER_CACHE_MAX_ENTRIES,
+        "ttl_days": LETTER_CACHE_TTL_DAYS,
+        "prompt_version": LETTER_PROMPT_VERSION,
+    }), 200
+
+@app.route("/admin/merchant-cache", methods=["GET", "POST"])
+def admin_merchant_cache():
+    """
+    🗄️ Cache du Détective : GET = stats, POST = invalidation.
+    POST ?domain=asphalte.com (ou ?url=...) → un domaine ; sans paramètre → tout le cache.
+    """
+    if not session.get('admin_authenticated'):
+        return jsonify({"error": "Accès admin requis"}), 403
+    
+    if request.method == "POST":
+        target = request.values.get("domain") or request.values.get("url")
+        domain = merchant_domain_key(target) if target else None
+        if target and not domain:
+            return jsonify({"error": "Domaine invalide"}), 400
+        try:
+            deleted = merchant_cache_invalidate(domain)
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)[:100]}), 500
+        return jsonify({"invalidated": domain or "*", "deleted": deleted}), 200
+    
+    try:
+        entries = MerchantEmailCache.query.count()
+        negatives = MerchantEmailCache.query.filter(MerchantEmailCache.email.is_(None)).count()
+    except Exception:
+        entries = negatives = None
+    return jsonify({
+        **MERCHANT_CACHE_STATS,
+        "entries": entries,
+        "negative_entries": negatives,
+        "ttl_days": MERCHANT_CACHE_TTL_DAYS,
+        "negative_ttl_hours": MERCHANT_CACHE_NEGATIVE_TTL_HOURS,
+        "memo_seconds": MERCHANT_CACHE_MEMO_SECONDS,
+    }), 200
+
+@app.route("/admin/outbound-mail", methods=["GET", "POST"])
+def admin_outbound_mail():
+    """
+    📬 File d'envoi SMTP : GET = stats, POST = remet les envois 'failed' en file
+    (?id=123 pour un seul) et réveille l'expéditeur.
+    """
+    if not session.get('admin_authenticated'):
+        return jsonify({"error": "Accès admin requis"}), 403
+    
+    if request.method == "POST":
+        query = OutboundEmail.query.filter_by(status='failed')
+        outbound_id = request.values.get("id", type=int)
+        if outbound_id:
+            query = query.filter_by(id=outbound_id)
+        try:
+            requeued = query.update({"status": "queued", "attempts": 0, "next_attempt_at": datetime.utcnow()},
+                                    synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)[:100]}), 500
+        start_outbound_sender()
+        return jsonify({"requeued": requeued}), 200
+    
+    try:
+        by_status = dict(db.session.query(OutboundEmail.status, db.func.count(OutboundEmail.id))
+                         .group_by(OutboundEmail.status).all())
+    except Exception:
+        by_status = None
+    sender = _OUTBOUND_SENDER["thread"]
+    return jsonify({
+        **SMTP_STATS,
+        "queue": by_status,
+        "sender_alive": bool(sender and sender.is_alive()),
+        "pool_size": SMTP_POOL_SIZE,
+        "max_attempts": SMTP_MAX_ATTEMPTS,
+    }), 200
+
 @app.route("/admin_panel", methods=["GET", "POST"])
 def admin_panel():
     """
@@ -9787,8 +12937,8 @@ def test_detective():
     # Marquer le début des logs pour ce test
     log_start_index = len(DEBUG_LOGS)
     
-    # Lancer l'analyse
-    result = find_merchant_email(url)
+    # Lancer l'analyse (?refresh=1 → ignore le cache et relance le crawl)
+    result = find_merchant_email(url, use_cache=request.args.get("refresh") != "1")
     
     # Récupérer les logs générés pendant l'analyse
     test_logs = DEBUG_LOGS[log_start_index:]
@@ -9915,9 +13065,11 @@ def admin_test_scan():
     passed = 0
     failed = 0
     
+    # Même moteur de règles que /scan-all, évalué en un seul appel
+    decisions = TRANSPORT_PREFILTER.evaluate_many([(subj, snip, snd) for subj, snip, snd, _, _ in test_cases])
+    
     for i, (subject, snippet, sender, should_be_transport, description) in enumerate(test_cases):
-        # Test: is_transport_email
-        actual_is_transport = is_transport_email(subject, snippet, sender)
+        actual_is_transport, fired_rule = decisions[i]
         test_pass = (actual_is_transport == should_be_transport)
         
         if test_pass:
@@ -9939,14 +13091,49 @@ def admin_test_scan():
                 <div>📧 Subject: <code>{subject[:50]}...</code></div>
                 <div>👤 Sender: <code>{sender}</code></div>
                 <div style='margin-top:5px;'>
-                    ✈️ is_transport_email: <span style='color:{"#10b981" if test_pass else "#ef4444"};'>
+                    ✈️ TRANSPORT_PREFILTER: <span style='color:{"#10b981" if test_pass else "#ef4444"};'>
                         attendu={should_be_transport}, obtenu={actual_is_transport}
                     </span>
+                    <span style='color:rgba(255,255,255,0.4);'>(règle: {fired_rule})</span>
                 </div>
             </div>
         </div>
         """
     
+    # ════════════════════════════════════════════════════════════════
+    # 🧮 COHÉRENCE BATCH vs UNITAIRE (pré-filtres)
+    # ════════════════════════════════════════════════════════════════
+    
+    col_subjects = [c[0] for c in test_cases]
+    col_snippets = [c[1] for c in test_cases]
+    col_senders = [c[2] for c in test_cases]
+    batch_mismatches = 0
+    for scan_type in ("travel", "ecommerce"):
+        keep, reasons = fast_candidate_filter_batch(scan_type, col_senders, col_subjects, col_snippets)
+        for j, (subject, snippet, sender, _, _) in enumerate(test_cases):
+            if (keep[j], reasons[j]) != fast_candidate_filter(scan_type, sender, subject, snippet):
+                batch_mismatches += 1
+    keep, reasons = pre_filter_email_batch(col_senders, col_subjects, col_snippets)
+    for j, (subject, snippet, sender, _, _) in enumerate(test_cases):
+        if (keep[j], reasons[j]) != pre_filter_email(sender, subject, snippet):
+            batch_mismatches += 1
+    
+    if batch_mismatches == 0:
+        passed += 1
+        batch_color, batch_icon = "#10b981", "✅"
+    else:
+        failed += 1
+        batch_color, batch_icon = "#ef4444", "❌"
+    results_html += f"""
+    <div style='background:rgba(255,255,255,0.05); border-radius:10px; padding:15px; margin-bottom:10px;
+                border-left:4px solid {batch_color};'>
+        <span style='color:white; font-weight:600;'>{batch_icon} Pré-filtres batch vs unitaires</span>
+        <div style='color:rgba(255,255,255,0.6); font-size:0.85rem; margin-top:8px;'>
+            {3 * len(test_cases) - batch_mismatches}/{3 * len(test_cases)} décisions identiques
+        </div>
+    </div>
+    """
+    
     # ════════════════════════════════════════════════════════════════
     # 📊 RÉSUMÉ
     # ════════════════════════════════════════════════════════════════
@@ -11898,12 +15085,38 @@ def envoyer_mise_en_demeure(litigation_id):
     if litigation.user_email != session["email"]:
         return STYLE + "<p style='color:red;'>Accès refusé.</p>" + FOOTER
 
-    return STYLE + f"""
+    # Détective en arrière-plan : on attend l'email du marchand avant l'envoi
+    detective_pending = is_detective_pending(litigation)
+    auto_refresh = ""
+    pending_banner = ""
+    if detective_pending:
+        auto_refresh = "<meta http-equiv='refresh' content='5'>"
+        pending_banner = DETECTIVE_PENDING_HTML
+        email_button = """
+                <div style='width:100%; background:#e0e7ff; color:#4f46e5; padding:14px;
+                            border-radius:12px; font-size:1rem; font-weight:600; text-align:center;'>
+                    🕵️ Recherche du contact…
+                </div>"""
+    else:
+        email_button = f"""
+                <form method='POST' action='/confirmer-envoi'>
+                    <input type='hidden' name='litigation_id' value='{litigation.id}'>
+                    <input type='hidden' name='send_type' value='email'>
+                    <button type='submit'
+                        style='width:100%; background:#4f46e5; color:white; padding:14px;
+                               border:none; border-radius:12px; font-size:1rem;
+                               font-weight:600; cursor:pointer;'>
+                        ✉️ Envoyer par email
+                    </button>
+                </form>"""
+
+    return STYLE + auto_refresh + f"""
     <div style='max-width:1000px; margin:40px auto; padding:20px;'>
         <h1 style='color:#1e293b; margin-bottom:8px;'>📬 Envoyer une mise en demeure</h1>
         <p style='color:#64748b; margin-bottom:30px;'>
             Dossier #{litigation.id} — <b>{litigation.company}</b> — {litigation.amount}
         </p>
+        {pending_banner}
 
         <div style='display:grid; grid-template-columns:1fr 1fr; gap:20px; max-width:1000px;'>
 
@@ -11920,17 +15133,7 @@ def envoyer_mise_en_demeure(litigation_id):
                     <li>Copie BCC à votre adresse</li>
                     <li>En-tête mandataire légal (Art. 1984 Code civil)</li>
                     <li>Gratuit</li>
-                </ul>
-                <form method='POST' action='/confirmer-envoi'>
-                    <input type='hidden' name='litigation_id' value='{litigation.id}'>
-                    <input type='hidden' name='send_type' value='email'>
-                    <button type='submit'
-                        style='width:100%; background:#4f46e5; color:white; padding:14px;
-                               border:none; border-radius:12px; font-size:1rem;
-                               font-weight:600; cursor:pointer;'>
-                        ✉️ Envoyer par email
-                    </button>
-                </form>
+                </ul>{email_button}
             </div>
 
             <!-- OPTION 2 : LRE (désactivée) -->
@@ -12000,35 +15203,22 @@ def confirmer_envoi():
         </div>
         """ + FOOTER
 
-    # Génération de la lettre via GPT
-    company = litigation.company or "Entreprise"
-    amount = litigation.amount or "montant inconnu"
-    motif = litigation.description or litigation.problem_type or "litige commercial"
-    law = litigation.law or "Code de la consommation"
-    client_name = user.name or user.email.split('@')[0].title()
-    client_email = user.email
-    order_ref = litigation.order_id
-
-    letter_result = generate_legal_letter_gpt(
-        company=company, amount=amount, motif=motif, law=law,
-        client_name=client_name, client_email=client_email, order_ref=order_ref
-    )
-
-    if not letter_result.get("success"):
+    # Détective encore en cours : inutile de générer la lettre sans destinataire
+    if not litigation.merchant_email and is_detective_pending(litigation):
         return STYLE + f"""
         <div style='max-width:600px; margin:80px auto; padding:40px; background:white;
                     border-radius:20px; box-shadow:0 4px 20px rgba(0,0,0,0.1); text-align:center;'>
-            <div style='font-size:3rem; margin-bottom:20px;'>❌</div>
-            <h2 style='color:#dc2626;'>Erreur de génération</h2>
-            <p style='color:#64748b;'>{letter_result.get('error', 'Erreur inconnue')}</p>
-            <a href='/envoyer-mise-en-demeure/{litigation.id}'
-               style='display:inline-block; margin-top:20px; background:#4f46e5; color:white;
-                      padding:12px 30px; border-radius:10px; text-decoration:none; font-weight:600;'>
-                Réessayer
+            <div style='font-size:3rem; margin-bottom:20px;'>🕵️</div>
+            <h2 style='color:#4f46e5;'>Recherche en cours</h2>
+            <p style='color:#64748b;'>L'Agent Détective cherche encore l'email de {litigation.company}. Réessayez dans quelques instants.</p>
+            <a href='/envoyer-mise-en-demeure/{litigation.id}' style='display:inline-block; margin-top:20px; background:#4f46e5; color:white;
+                padding:12px 30px; border-radius:10px; text-decoration:none; font-weight:600;'>
+                Retour
             </a>
         </div>
         """ + FOOTER
 
+    company = litigation.company or "Entreprise"
     target_email = (litigation.merchant_email or
                     COMPANY_EMAIL_OVERRIDE.get(company.lower().strip()))
     if not target_email:
@@ -12045,18 +15235,57 @@ def confirmer_envoi():
         </div>
         """ + FOOTER
 
-    send_result = send_mise_en_demeure_smtp(
-        user=user,
-        target_email=target_email,
-        subject=letter_result["subject"],
-        html_body=letter_result["html_body"],
-        text_body=letter_result.get("text_body"),
-        litigation_id=litigation.id,
-        company=company
-    )
+    # Génération de la lettre via GPT, streamée vers le navigateur (aperçu en direct)
+    amount = litigation.amount or "montant inconnu"
+    motif = litigation.description or litigation.problem_type or "litige commercial"
+    law = litigation.law or "Code de la consommation"
+    client_name = user.name or user.email.split('@')[0].title()
+    client_email = user.email
+    order_ref = litigation.order_id
+
+    def stream_page():
+        yield STYLE + f"""
+        <div style='max-width:800px; margin:40px auto 0; padding:20px;'>
+            <h1 style='color:#1e293b; margin-bottom:8px;'>⚖️ Votre mise en demeure</h1>
+            <p id='letter-status' style='color:#4f46e5; font-weight:600; margin-bottom:20px;'>✍️ Rédaction en cours…</p>
+            <div id='letter-preview' style='background:white; border-radius:16px; padding:30px; min-height:120px;
+                 box-shadow:0 4px 20px rgba(0,0,0,0.08); font-family:Georgia, serif; line-height:1.6; color:#1e293b;'></div>
+        </div>
+        <script>
+            var _lp = document.getElementById('letter-preview'), _lb = '';
+            function _l(c) {{ _lb += c; _lp.innerHTML = _lb; }}
+            function _ls(t) {{ document.getElementById('letter-status').textContent = t; }}
+        </script>
+        """
+
+        letter_result = None
+        for kind, payload in stream_legal_letter_gpt(
+                company=company, amount=amount, motif=motif, law=law,
+                client_name=client_name, client_email=client_email, order_ref=order_ref):
+            if kind == "chunk":
+                yield "<script>_l(" + json.dumps(payload).replace("<", "\\u003c") + ");</script>\n"
+            else:
+                letter_result = payload
+
+        if not letter_result or not letter_result.get("success"):
+            error = (letter_result or {}).get('error') or 'Erreur inconnue'
+            yield "<script>_ls('❌ Rédaction interrompue');</script>" + f"""
+        <div style='max-width:600px; margin:40px auto; padding:40px; background:white;
+                    border-radius:20px; box-shadow:0 4px 20px rgba(0,0,0,0.1); text-align:center;'>
+            <div style='font-size:3rem; margin-bottom:20px;'>❌</div>
+            <h2 style='color:#dc2626;'>Erreur de génération</h2>
+            <p style='color:#64748b;'>{error}</p>
+            <a href='/envoyer-mise-en-demeure/{litigation.id}'
+               style='display:inline-block; margin-top:20px; background:#4f46e5; color:white;
+                      padding:12px 30px; border-radius:10px; text-decoration:none; font-weight:600;'>
+                Réessayer
+            </a>
+        </div>
+        """ + FOOTER
+            return
 
-    if send_result["success"]:
-        # Enregistrer en base
+        # Enregistrer en base ('queued') puis mettre en file : le thread smtp-sender
+        # passe l'envoi en 'sent' (et met à jour le dossier) quand Brevo l'accepte
         envoi = MiseEnDemeure(
             user_email=user.email,
             litigation_id=litigation.id,
@@ -12065,24 +15294,30 @@ def confirmer_envoi():
             send_type=send_type,
             subject=letter_result["subject"],
             html_body=letter_result["html_body"],
-            status='sent',
-            message_id=send_result.get("message_id")
+            status='queued'
         )
         db.session.add(envoi)
-        litigation.legal_notice_sent = True
-        litigation.legal_notice_date = datetime.utcnow()
-        litigation.legal_notice_message_id = send_result.get("message_id")
-        if litigation.status in ("Détecté", "detected"):
-            litigation.status = "En attente de remboursement"
-        db.session.commit()
+        db.session.flush()
 
-        return STYLE + f"""
-        <div style='max-width:600px; margin:80px auto; padding:40px; background:white;
+        send_result = enqueue_mise_en_demeure(
+            user=user,
+            target_email=target_email,
+            subject=letter_result["subject"],
+            html_body=letter_result["html_body"],
+            text_body=letter_result.get("text_body"),
+            litigation_id=litigation.id,
+            company=company,
+            mise_en_demeure_id=envoi.id
+        )
+
+        if send_result["success"]:
+            yield "<script>_ls('✅ Lettre rédigée');</script>" + f"""
+        <div style='max-width:600px; margin:40px auto; padding:40px; background:white;
                     border-radius:20px; box-shadow:0 4px 20px rgba(79,70,229,0.12); text-align:center;'>
             <div style='font-size:3rem; margin-bottom:20px;'>✅</div>
-            <h2 style='color:#10b981;'>Mise en demeure envoyée !</h2>
+            <h2 style='color:#10b981;'>Mise en demeure en cours d'envoi !</h2>
             <p style='color:#64748b; margin-bottom:5px;'>Destinataire : <b>{target_email}</b></p>
-            <p style='color:#64748b; margin-bottom:20px;'>Une copie a été envoyée à <b>{user.email}</b></p>
+            <p style='color:#64748b; margin-bottom:20px;'>Une copie sera envoyée à <b>{user.email}</b></p>
             <div style='display:flex; gap:10px; justify-content:center;'>
                 <a href='/mes-envois' style='background:#4f46e5; color:white; padding:12px 25px;
                     border-radius:10px; text-decoration:none; font-weight:600;'>
@@ -12095,9 +15330,10 @@ def confirmer_envoi():
             </div>
         </div>
         """ + FOOTER
-    else:
-        return STYLE + f"""
-        <div style='max-width:600px; margin:80px auto; padding:40px; background:white;
+        else:
+            db.session.rollback()
+            yield "<script>_ls('✅ Lettre rédigée');</script>" + f"""
+        <div style='max-width:600px; margin:40px auto; padding:40px; background:white;
                     border-radius:20px; box-shadow:0 4px 20px rgba(0,0,0,0.1); text-align:center;'>
             <div style='font-size:3rem; margin-bottom:20px;'>❌</div>
             <h2 style='color:#dc2626;'>Échec de l'envoi</h2>
@@ -12110,6 +15346,13 @@ def confirmer_envoi():
         </div>
         """ + FOOTER
 
+    from flask import Response, stream_with_context
+    return Response(
+        stream_with_context(stream_page()),
+        mimetype='text/html',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # Pas de buffering proxy
+    )
+
 
 # ════════════════════════════════════════════════════════════════════════════════
 # 📊 ROUTE /mes-envois - Historique des mises en demeure
@@ -12129,6 +15372,7 @@ def mes_envois():
     rembourses = sum(1 for e in envois if e.status == 'refunded')
 
     STATUS_BADGES = {
+        'queued':   ("<span style='background:#e0e7ff; color:#3730a3; padding:3px 10px; border-radius:20px; font-size:0.8rem;'>⏳ En cours d'envoi</span>"),
         'sent':     ("<span style='background:#dbeafe; color:#1e40af; padding:3px 10px; border-radius:20px; font-size:0.8rem;'>📤 Envoyé</span>"),
         'refunded': ("<span style='background:#dcfce7; color:#166534; padding:3px 10px; border-radius:20px; font-size:0.8rem;'>✅ Remboursé</span>"),
         'failed':   ("<span style='background:#fee2e2; color:#991b1b; padding:3px 10px; border-radius:20px; font-size:0.8rem;'>❌ Échoué</span>"),
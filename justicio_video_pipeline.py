@@ -13,9 +13,7 @@ import tempfile
 import shutil
 from datetime import datetime, timedelta
 from pathlib import Path
-from openai import OpenAI
-
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+from openai_gateway import OPENAI_GATEWAY
 
 # ─── Formats vidéo ────────────────────────────────────────────────────────────
 
@@ -162,7 +160,8 @@ async def _record_playwright(video_dir: str) -> str:
 def generate_tts_audio(text: str, output_path: str, speed: float = 1.15) -> str:
     """Génère l'audio voix-off via OpenAI TTS-1 (voix nova, ~25s)."""
     print("  Generation voix TTS (OpenAI nova)...")
-    response = client.audio.speech.create(
+    response = OPENAI_GATEWAY.speech(
+        "video_tts",
         model="tts-1-hd",
         voice="nova",
         input=text,
@@ -371,7 +370,8 @@ Réponds en JSON avec ces clés :
 - cta: call-to-action final
 - estimated_duration: durée estimée en secondes"""
 
-    response = client.chat.completions.create(
+    response = OPENAI_GATEWAY.chat(
+        "video_script",
         model="gpt-4o",
         messages=[
             {"role": "system", "content": system_prompt},
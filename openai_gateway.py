@@ -0,0 +1,223 @@
+"""
+Passerelle OpenAI partagée (Justicio)
+Un seul client par process : pool de connexions HTTP réutilisé (plus de handshake TLS par appel),
+limite de concurrence par modèle, retry/backoff sur 429/5xx et métriques par appelant
+(latence, tokens, coût). Utilisée par app.py et justicio_video_pipeline.py.
+"""
+
+import os
+import random
+import threading
+import time
+from openai import OpenAI, APIConnectionError
+
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_SECONDS = float(os.environ.get("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.environ.get("OPENAI_RETRY_MAX_SECONDS", "20"))
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_TIMEOUT_SECONDS", "60"))
+OPENAI_DEFAULT_CONCURRENCY = int(os.environ.get("OPENAI_DEFAULT_CONCURRENCY", "8"))
+# Appels simultanés max par modèle, format "modele=N,modele=N"
+OPENAI_MODEL_CONCURRENCY = os.environ.get("OPENAI_MODEL_CONCURRENCY", "gpt-4o-mini=16,gpt-4o=4,tts-1-hd=2")
+
+# Tarifs USD par million d'unités : (entrée, sortie) en tokens ; caractères pour la TTS
+OPENAI_PRICING = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "tts-1-hd": (30.00, 0.0),
+    "tts-1": (15.00, 0.0),
+}
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+def parse_model_limits(spec: str) -> dict:
+    """ "gpt-4o-mini=16,gpt-4o=4" → {"gpt-4o-mini": 16, "gpt-4o": 4} (entrées invalides ignorées)"""
+    limits = {}
+    for item in (spec or "").split(","):
+        model, _, value = item.partition("=")
+        try:
+            if model.strip() and int(value) > 0:
+                limits[model.strip()] = int(value)
+        except ValueError:
+            continue
+    return limits
+
+
+def model_pricing(model: str):
+    """Tarif du modèle (préfixe le plus long : 'gpt-4o-mini-2024-07-18' → gpt-4o-mini)"""
+    for name in sorted(OPENAI_PRICING, key=len, reverse=True):
+        if (model or "").startswith(name):
+            return OPENAI_PRICING[name]
+    return (0.0, 0.0)
+
+
+def is_retryable_openai_error(error) -> bool:
+    """Erreurs transitoires : réseau/timeout, 408/409/429 et 5xx"""
+    if isinstance(error, APIConnectionError):
+        return True
+    status = getattr(error, "status_code", None)
+    return status in RETRYABLE_STATUS_CODES or (status is not None and status >= 500)
+
+
+def retry_delay(error, attempt: int) -> float:
+    """Délai avant nouvel essai : Retry-After s'il est fourni, sinon backoff exponentiel + jitter"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after"))
+        if retry_after >= 0:
+            return min(retry_after, OPENAI_RETRY_MAX_SECONDS)
+    except (TypeError, ValueError):
+        pass
+    delay = OPENAI_RETRY_BASE_SECONDS * (2 ** attempt)
+    return min(delay + random.uniform(0, delay / 2), OPENAI_RETRY_MAX_SECONDS)
+
+
+class OpenAIGateway:
+    """
+    Point de passage unique de tous les appels LLM du process.
+
+    chat(call_site, **kwargs)        → chat.completions.create
+    chat_stream(call_site, **kwargs) → itérateur de fragments (le quota du modèle est tenu jusqu'à la fin)
+    speech(call_site, **kwargs)      → audio.speech.create
+    stats()                          → métriques par appelant
+    """
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._client = None
+        self._lock = threading.Lock()
+        self._limits = parse_model_limits(OPENAI_MODEL_CONCURRENCY)
+        self._semaphores = {}
+        self._metrics = {}
+
+    @property
+    def client(self) -> OpenAI:
+        """Client partagé, créé au premier appel (retries désactivés : gérés par la passerelle)"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = OpenAI(api_key=self.api_key or os.environ.get("OPENAI_API_KEY"),
+                                          max_retries=0, timeout=OPENAI_TIMEOUT_SECONDS)
+        return self._client
+
+    def _semaphore(self, model: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            semaphore = self._semaphores.get(model)
+            if semaphore is None:
+                limit = self._limits.get(model, OPENAI_DEFAULT_CONCURRENCY)
+                semaphore = self._semaphores[model] = threading.BoundedSemaphore(limit)
+            return semaphore
+
+    def _run(self, model, fn, state, keep_slot=False):
+        """Exécute fn() dans le quota du modèle avec retry/backoff (quota relâché pendant l'attente)"""
+        semaphore = self._semaphore(model)
+        while True:
+            semaphore.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                semaphore.release()
+                if state["retries"] >= OPENAI_MAX_RETRIES or not is_retryable_openai_error(e):
+                    raise
+                time.sleep(retry_delay(e, state["retries"]))
+                state["retries"] += 1
+                continue
+            if not keep_slot:
+                semaphore.release()
+            return result
+
+    def _record(self, call_site, model, started, retries, usage=None, characters=0, error=None):
+        latency_ms = (time.monotonic() - started) * 1000
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        price_in, price_out = model_pricing(model)
+        cost = ((prompt_tokens + characters) * price_in + completion_tokens * price_out) / 1_000_000
+        with self._lock:
+            metrics = self._metrics.setdefault(call_site, {
+                "calls": 0, "errors": 0, "retries": 0,
+                "latency_ms_total": 0.0, "latency_ms_max": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "characters": 0,
+                "cost_usd": 0.0, "models": {},
+            })
+            metrics["calls"] += 1
+            metrics["errors"] += 1 if error is not None else 0
+            metrics["retries"] += retries
+            metrics["latency_ms_total"] += latency_ms
+            metrics["latency_ms_max"] = max(metrics["latency_ms_max"], latency_ms)
+            metrics["prompt_tokens"] += prompt_tokens
+            metrics["completion_tokens"] += completion_tokens
+            metrics["characters"] += characters
+            metrics["cost_usd"] += cost
+            metrics["models"][model] = metrics["models"].get(model, 0) + 1
+
+    def chat(self, call_site: str, **kwargs):
+        model = kwargs.get("model", "")
+        state = {"retries": 0}
+        started = time.monotonic()
+        try:
+            response = self._run(model, lambda: self.client.chat.completions.create(**kwargs), state)
+        except Exception as e:
+            self._record(call_site, model, started, state["retries"], error=e)
+            raise
+        self._record(call_site, model, started, state["retries"], usage=getattr(response, "usage", None))
+        return response
+
+    def chat_stream(self, call_site: str, **kwargs):
+        model = kwargs.get("model", "")
+        kwargs["stream"] = True
+        kwargs.setdefault("stream_options", {"include_usage": True})  # Usage dans le dernier fragment
+        state = {"retries": 0}
+        started = time.monotonic()
+        try:
+            stream = self._run(model, lambda: self.client.chat.completions.create(**kwargs), state, keep_slot=True)
+        except Exception as e:
+            self._record(call_site, model, started, state["retries"], error=e)
+            raise
+        usage = None
+        error = None
+        try:
+            for event in stream:
+                if getattr(event, "usage", None):
+                    usage = event.usage
+                yield event
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._semaphore(model).release()
+            self._record(call_site, model, started, state["retries"], usage=usage, error=error)
+
+    def speech(self, call_site: str, **kwargs):
+        model = kwargs.get("model", "")
+        characters = len(kwargs.get("input") or "")
+        state = {"retries": 0}
+        started = time.monotonic()
+        try:
+            response = self._run(model, lambda: self.client.audio.speech.create(**kwargs), state)
+        except Exception as e:
+            self._record(call_site, model, started, state["retries"], characters=characters, error=e)
+            raise
+        self._record(call_site, model, started, state["retries"], characters=characters)
+        return response
+
+    def stats(self) -> dict:
+        """Copie des métriques par appelant (+ latence moyenne) et limites de concurrence"""
+        with self._lock:
+            call_sites = {}
+            for call_site, metrics in self._metrics.items():
+                snapshot = {**metrics, "models": dict(metrics["models"])}
+                snapshot["latency_ms_avg"] = round(metrics["latency_ms_total"] / metrics["calls"], 1) if metrics["calls"] else None
+                snapshot["latency_ms_total"] = round(metrics["latency_ms_total"], 1)
+                snapshot["latency_ms_max"] = round(metrics["latency_ms_max"], 1)
+                snapshot["cost_usd"] = round(metrics["cost_usd"], 6)
+                call_sites[call_site] = snapshot
+        return {
+            "call_sites": call_sites,
+            "total_cost_usd": round(sum(m["cost_usd"] for m in call_sites.values()), 6),
+            "concurrency": {**self._limits, "*": OPENAI_DEFAULT_CONCURRENCY},
+            "max_retries": OPENAI_MAX_RETRIES,
+        }
+
+
+# Instance unique du process
+OPENAI_GATEWAY = OpenAIGateway()